@@ -1,12 +1,16 @@
 import flask
 
 import routers
+from base_module import metrics
+from config import config
 from injectors.connections import pg
 
 
 def setup_app():
     current = flask.Flask(__name__)
     pg.setup(current)
+    metrics.REGISTRY.configure(config.metrics.multiprocess_dir)
+    metrics.setup_flask(current)
 
     return current
 
@@ -9,6 +9,10 @@ class ModuleException(Exception):
         self.data = data
         self.code = code
 
+    def __reduce__(self):
+        # Исключение передается из пула процессов вместе с data и code
+        return type(self), (self.msg, self.data, self.code)
+
     def json(self) -> dict:
         return {"error": self.msg, "data": self.data or {}}
 
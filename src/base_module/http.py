@@ -0,0 +1,17 @@
+import dataclasses as dc
+
+from base_module.models import Model
+
+
+@dc.dataclass
+class HttpClientConfig(Model):
+    """."""
+
+    url: str = dc.field(default="")
+    # Количество пулов (хостов) и соединений keep-alive в пуле на процесс
+    pool_connections: int = dc.field(default=4)
+    pool_maxsize: int = dc.field(default=16)
+    connect_timeout: float = dc.field(default=5)
+    read_timeout: float = dc.field(default=60)
+    retries: int = dc.field(default=2)
+    chunk_size: int = dc.field(default=256 * 1024)
@@ -0,0 +1,413 @@
+"""Счетчики и гистограммы в текстовом формате Prometheus.
+
+Значения хранятся в памяти процесса. Если задан общий каталог, каждый процесс
+(uWSGI, воркеры) периодически сохраняет туда снимок своих значений, а выдача
+суммирует снимки всех процессов, поэтому любой процесс отдает общие цифры.
+Снимки завершившихся процессов сводятся в один файл: накопительные значения
+(счетчики, гистограммы) сохраняются, прочие отбрасываются.
+"""
+
+import fcntl
+import json
+import math
+import os
+import re
+import threading
+import time
+import typing as t
+from contextlib import contextmanager, suppress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import flask
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SNAPSHOT_NAME = re.compile(r"metrics_(\d+)\.json")
+# Сводный снимок завершившихся процессов
+ARCHIVE_NAME = "metrics_archive.json"
+LOCK_NAME = ".lock"
+# Типы, значения которых остаются в сумме после завершения процесса
+CUMULATIVE_TYPES = ("counter", "histogram")
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(snapshots: t.Iterable[dict], types: t.Container[str] = None) -> dict:
+    """Сумма значений снимков по метрикам и меткам"""
+    merged: t.Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            if types is not None and data["type"] not in types:
+                continue
+            target = merged.setdefault(
+                name, {**data, "samples": {}, "buckets": data.get("buckets")}
+            )
+            for key, value in data["samples"]:
+                key = tuple(key)
+                if isinstance(value, list):
+                    current = target["samples"].get(key) or [0] * len(value)
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0) + value
+    return merged
+
+
+def _format_labels(names: t.Sequence[str], values: t.Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    """."""
+
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labels: t.Sequence[str] = ()):
+        """."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: t.Dict[tuple, t.Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "type": self.TYPE,
+                "help": self.documentation,
+                "labels": list(self.label_names),
+                "samples": [[list(key), value] for key, value in self._values.items()],
+            }
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    TYPE = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам"""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: t.Sequence[str] = (),
+        buckets: t.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """."""
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Счетчики по корзинам (не накопительные), сумма, количество
+            sample = self._values.get(key)
+            if sample is None:
+                sample = self._values[key] = [0] * len(self.buckets) + [0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[index] += 1
+                    break
+            sample[-2] += value
+            sample[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> dict:
+        data = super().snapshot()
+        data["buckets"] = [b if b != math.inf else "+Inf" for b in self.buckets]
+        return data
+
+
+class MetricsRegistry:
+    """Набор метрик процесса с выдачей в формате Prometheus"""
+
+    def __init__(self, multiprocess_dir: str = None, flush_interval: float = 1):
+        """."""
+        self._metrics: t.Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._multiprocess_dir = multiprocess_dir
+        self._flush_interval = flush_interval
+        self._flushed_at = 0.0
+
+    def configure(self, multiprocess_dir: str = None, flush_interval: float = 1):
+        """Общий каталог снимков для нескольких процессов. Снимок с pid этого
+        процесса остался от прежнего процесса и сводится вместе с другими
+        снимками завершившихся процессов"""
+        if multiprocess_dir:
+            os.makedirs(multiprocess_dir, exist_ok=True)
+        self._multiprocess_dir = multiprocess_dir or None
+        self._flush_interval = flush_interval
+        if self._multiprocess_dir:
+            self._archive_dead(own=True)
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(
+        self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self._multiprocess_dir, f"metrics_{pid}.json")
+
+    def flush(self, force: bool = False):
+        """Сохранение снимка процесса в общий каталог (не чаще flush_interval)"""
+        if not self._multiprocess_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self._flush_interval:
+            return
+        self._flushed_at = now
+        path = self._snapshot_path(os.getpid())
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temp_path, path)
+
+    @contextmanager
+    def _dir_lock(self, operation: int):
+        """Блокировка каталога: сведение снимков не пересекается с чтением"""
+        with open(os.path.join(self._multiprocess_dir, LOCK_NAME), "ab") as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    def _dead_snapshots(self, own: bool = False) -> t.List[str]:
+        """Снимки завершившихся процессов, own - и снимок с pid этого процесса"""
+        paths = []
+        for file_name in os.listdir(self._multiprocess_dir):
+            match = SNAPSHOT_NAME.fullmatch(file_name)
+            if not match:
+                continue
+            pid = int(match.group(1))
+            if pid == os.getpid() and not own:
+                continue
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            paths.append(os.path.join(self._multiprocess_dir, file_name))
+        return paths
+
+    @staticmethod
+    def _load(path: str) -> t.Optional[dict]:
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _archive_dead(self, own: bool = False):
+        """Сведение снимков завершившихся процессов в сводный снимок: счетчики
+        и гистограммы суммируются, прочие значения отбрасываются"""
+        if not self._dead_snapshots(own):
+            return
+        with self._dir_lock(fcntl.LOCK_EX):
+            # Снимки мог уже свести другой процесс
+            dead = self._dead_snapshots(own)
+            if not dead:
+                return
+            archive_path = os.path.join(self._multiprocess_dir, ARCHIVE_NAME)
+            snapshots = [self._load(path) for path in [archive_path, *dead]]
+            merged = _merge(filter(None, snapshots), CUMULATIVE_TYPES)
+            archive = {
+                name: {
+                    **data,
+                    "samples": [
+                        [list(key), value] for key, value in data["samples"].items()
+                    ],
+                }
+                for name, data in merged.items()
+            }
+            temp_path = f"{archive_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump(archive, file)
+            os.replace(temp_path, archive_path)
+            for path in dead:
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+
+    def _collect(self) -> t.List[dict]:
+        snapshots = [self.snapshot()]
+        if not self._multiprocess_dir:
+            return snapshots
+        self._archive_dead()
+        own = os.path.basename(self._snapshot_path(os.getpid()))
+        with self._dir_lock(fcntl.LOCK_SH):
+            for file_name in sorted(os.listdir(self._multiprocess_dir)):
+                if file_name == own or not file_name.endswith(".json"):
+                    continue
+                snapshot = self._load(os.path.join(self._multiprocess_dir, file_name))
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        return snapshots
+
+    def render(self) -> str:
+        """Сумма значений всех процессов в текстовом формате Prometheus"""
+        merged = _merge(self._collect())
+
+        lines = []
+        for name, data in sorted(merged.items()):
+            lines.append(f"# HELP {name} {data['help']}")
+            lines.append(f"# TYPE {name} {data['type']}")
+            label_names = data["labels"]
+            for key, value in sorted(data["samples"].items()):
+                if data["type"] != "histogram":
+                    labels = _format_labels(label_names, key)
+                    lines.append(f"{name}{labels} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(data["buckets"], value):
+                    cumulative += count
+                    bound = math.inf if bound == "+Inf" else bound
+                    labels = _format_labels(
+                        [*label_names, "le"], [*key, _format_value(bound)]
+                    )
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = _format_labels(label_names, key)
+                lines.append(f"{name}_sum{labels} {_format_value(value[-2])}")
+                lines.append(f"{name}_count{labels} {_format_value(value[-1])}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds",
+    "Длительность обработки запросов API, секунды",
+    ["method", "route", "status"],
+)
+DEPENDENCY_SECONDS = REGISTRY.histogram(
+    "dependency_call_seconds",
+    "Длительность обращений к БД, брокеру и файловому хранилищу, секунды",
+    ["dependency", "operation"],
+)
+BROKER_PUBLISH = REGISTRY.counter(
+    "broker_publish_total",
+    "Отправка в брокер: сообщения (published, failed) и соединения "
+    "(connection_opened, reconnect)",
+    ["event"],
+)
+
+
+def setup_flask(app: flask.Flask, registry: MetricsRegistry = REGISTRY):
+    """Время запросов по маршрутам и выдача метрик на GET /metrics"""
+
+    @app.before_request
+    def _start_timer():
+        flask.g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe(response: flask.Response):
+        started = flask.g.pop("metrics_started", None)
+        if started is not None:
+            rule = flask.request.url_rule
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=flask.request.method,
+                route=rule.rule if rule else "unmatched",
+                status=response.status_code,
+            )
+        registry.flush()
+        return response
+
+    @app.get("/metrics")
+    def _metrics():
+        registry.flush(force=True)
+        return flask.Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def start_http_server(
+    port: int, host: str = "0.0.0.0", registry: MetricsRegistry = REGISTRY
+) -> ThreadingHTTPServer:
+    """Выдача метрик на http://host:port/metrics в фоновом потоке"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    return server
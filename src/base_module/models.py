@@ -8,11 +8,15 @@ from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 
 from base_module.exceptions import ModuleException
+from base_module.serializers import CompiledSerializer, compile_serializer
 
 TV_MODEL = t.TypeVar("TV_MODEL")
 
 Base = declarative_base()
 
+# Скомпилированные dump/load по классам; False - класс обрабатывается фабрикой
+_SERIALIZERS: t.Dict[type, t.Union[CompiledSerializer, bool]] = {}
+
 
 def default_loader(value, cls, loader):
     if not isinstance(value, cls):
@@ -55,11 +59,25 @@ class Model:
         for key, schema in cls.SCHEMAS.items():
             cls.FACTORY.schemas.setdefault(key, schema)
 
+    @classmethod
+    def _serializer(cls) -> t.Optional[CompiledSerializer]:
+        serializer = _SERIALIZERS.get(cls)
+        if serializer is None:
+            cls.__improve_schemas()
+            serializer = None
+            if cls.SCHEMAS is Model.SCHEMAS:
+                serializer = compile_serializer(cls, cls.SCHEMAS, cls.FACTORY)
+            _SERIALIZERS[cls] = serializer or False
+        return serializer or None
+
     @classmethod
     def load(cls: t.Type[TV_MODEL], data: dict) -> TV_MODEL:
-        cls.__improve_schemas()
         if isinstance(data, cls):
             return data
+        serializer = cls._serializer()
+        if serializer:
+            return serializer.load(data)
+        cls.__improve_schemas()
         return cls.FACTORY.load(data, cls)
 
     def validate(self):
@@ -69,6 +87,9 @@ class Model:
         [setattr(self, f, v) for f, v in data.items()]
 
     def dump(self) -> dict:
+        serializer = self._serializer()
+        if serializer:
+            return serializer.dump(self)
         self.__improve_schemas()
         return self.FACTORY.dump(self)
 
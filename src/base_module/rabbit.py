@@ -23,6 +23,18 @@ class RabbitPublisherConfig(_CredentialsConfig):
     exchange: str = dc.field(default="")
     routing_key: str = dc.field(default="")
     reply_to: str = dc.field(default=None)
+    # Долгоживущие соединения отправки на процесс
+    publisher_pool_size: int = dc.field(default=2)
+    publisher_heartbeat: int = dc.field(default=60)
+    publisher_acquire_timeout: float = dc.field(default=5)
+    publish_retries: int = dc.field(default=1)
+    # Сообщения вне транзакций ждут подтверждения брокера (publisher confirms)
+    publisher_confirms: bool = dc.field(default=False)
+    # Пакет отправляется транзакциями AMQP, tx_commit на tx_batch_size сообщений.
+    # Это не publisher confirms: BlockingChannel pika ждет ack каждого сообщения
+    # отдельно, транзакция подтверждает пакет за один обмен с брокером
+    publisher_transactions: bool = dc.field(default=False)
+    tx_batch_size: int = dc.field(default=500)
 
 
 @dc.dataclass
@@ -32,6 +44,9 @@ class RabbitConsumerConfig(_CredentialsConfig):
     queue_name: str = dc.field(default="")
     error_timeout: int = dc.field(default=10)
     max_priority: int = dc.field(default=5)
+    prefetch_count: int = dc.field(default=1)
+    # Время ожидания подтверждения уже полученных сообщений при остановке
+    drain_timeout: int = dc.field(default=60)
 
 
 @dc.dataclass
@@ -70,6 +85,10 @@ class _TaskIdentModel(Model):
     """."""
 
     task_id: int = dc.field()
+    # Метаданные файла, уже полученные отправителем, чтобы не запрашивать их повторно
+    file_info: t.Optional[dict] = dc.field(default=None)
+    # Задача создана с запросом профилирования (заголовок X-Profile-Task)
+    profile: bool = dc.field(default=False)
 
 
 @dc.dataclass
@@ -0,0 +1,215 @@
+"""Скомпилированные сериализаторы dataclass-моделей.
+
+План преобразования строится один раз на класс по аннотациям полей и дает тот
+же результат dump/load, что и dataclass_factory, без обхода фабрики на каждом
+вызове. Для типов, которые план не поддерживает, класс целиком остается на
+фабрике (compile_serializer возвращает None).
+"""
+
+import dataclasses as dc
+import typing as t
+from enum import Enum
+from operator import attrgetter
+
+import dataclass_factory
+
+PRIMITIVES = (str, bytes, bytearray, int, float, complex, bool, type(None))
+CHECKED_TYPES = (str, bytes, bytearray)
+CAST_TYPES = (int, float, complex, bool)
+
+
+class UnsupportedType(Exception):
+    """."""
+
+
+@dc.dataclass(frozen=True)
+class CompiledSerializer:
+    """."""
+
+    dump: t.Callable[[t.Any], dict]
+    load: t.Callable[[dict], t.Any]
+
+
+def _stub(value):
+    return value
+
+
+def _checked(tp: type):
+    def parser(value):
+        if isinstance(value, tp):
+            return value
+        raise ValueError("data type is not %s" % tp)
+
+    return parser
+
+
+class _Compiler:
+    """Построение функций dump/load для dataclass и вложенных типов"""
+
+    def __init__(self, schemas: dict, factory: dataclass_factory.Factory):
+        self._schemas = schemas
+        self._factory = factory
+        self._dynamic_cache = {}
+        self._compiled: t.Dict[type, CompiledSerializer] = {}
+
+    # --- dump ---
+
+    def dump_any(self, value):
+        """Сериализация по фактическому типу значения (Any, Optional, Union)"""
+        tp = type(value)
+        serializer = self._dynamic_cache.get(tp)
+        if serializer is None:
+            serializer = self._dynamic_cache[tp] = self._dynamic_serializer(tp)
+        return serializer(value)
+
+    def _dynamic_serializer(self, tp: type):
+        if tp in self._schemas and self._schemas[tp].serializer:
+            return self._schemas[tp].serializer
+        if tp in PRIMITIVES:
+            return _stub
+        if issubclass(tp, Enum):
+            return attrgetter("value")
+        dump_any = self.dump_any
+        if tp is dict:
+            return lambda data: {dump_any(k): dump_any(v) for k, v in data.items()}
+        if tp is list:
+            return lambda data: [dump_any(x) for x in data]
+        if tp is tuple:
+            return list
+        return self._factory.serializer(tp)
+
+    def dumper(self, tp) -> t.Optional[t.Callable]:
+        """Сериализатор объявленного типа поля, None - значение без изменений"""
+        if tp in self._schemas and self._schemas.get(tp).serializer:
+            return self._schemas[tp].serializer
+        if tp in PRIMITIVES:
+            return None
+        if tp is t.Any:
+            return self.dump_any
+        if isinstance(tp, type) and issubclass(tp, Enum):
+            return attrgetter("value")
+
+        origin = t.get_origin(tp)
+        args = t.get_args(tp)
+        if origin is t.Union:
+            return self.dump_any
+        if tp in (list, t.List) or (origin is list and not args):
+            dump_any = self.dump_any
+            return lambda data: [dump_any(x) for x in data]
+        if origin is list:
+            item = self.dumper(args[0]) or _stub
+            return lambda data: [item(x) for x in data]
+        if tp in (dict, t.Dict) or (origin is dict and not args):
+            dump_any = self.dump_any
+            return lambda data: {dump_any(k): dump_any(v) for k, v in data.items()}
+        if origin is dict:
+            key = self.dumper(args[0]) or _stub
+            value = self.dumper(args[1]) or _stub
+            return lambda data: {key(k): value(v) for k, v in data.items()}
+        if isinstance(tp, type) and dc.is_dataclass(tp):
+            return self.compile(tp).dump
+        raise UnsupportedType(tp)
+
+    # --- load ---
+
+    def loader(self, tp) -> t.Callable:
+        if tp in self._schemas and self._schemas.get(tp).parser:
+            return self._schemas[tp].parser
+        if tp is t.Any:
+            return _stub
+        if tp in CHECKED_TYPES:
+            return _checked(tp)
+        if tp in CAST_TYPES:
+            return tp
+        if isinstance(tp, type) and issubclass(tp, Enum):
+            return tp
+
+        origin = t.get_origin(tp)
+        args = t.get_args(tp)
+        if origin is t.Union:
+            not_none = [arg for arg in args if arg is not type(None)]
+            if len(not_none) != 1 or len(not_none) == len(args):
+                raise UnsupportedType(tp)
+            parser = self.loader(not_none[0])
+            return lambda data: parser(data) if data is not None else None
+        if tp in (list, t.List) or (origin is list and not args):
+            return list
+        if origin is list:
+            item = self.loader(args[0])
+            return lambda data: [item(x) for x in data]
+        if tp in (dict, t.Dict) or (origin is dict and not args):
+            return lambda data: {k: v for k, v in data.items()}
+        if origin is dict:
+            key = self.loader(args[0])
+            value = self.loader(args[1])
+            return lambda data: {key(k): value(v) for k, v in data.items()}
+        if isinstance(tp, type) and dc.is_dataclass(tp):
+            return self.compile(tp).load
+        raise UnsupportedType(tp)
+
+    # --- dataclass ---
+
+    def compile(self, cls: type) -> CompiledSerializer:
+        if cls in self._compiled:
+            return self._compiled[cls]
+        if getattr(cls, "__parameters__", None):
+            raise UnsupportedType(cls)
+        nested_schemas = getattr(cls, "SCHEMAS", self._schemas)
+        if nested_schemas is not self._schemas:
+            raise UnsupportedType(cls)
+
+        # Ссылка на себя во вложенных типах разрешается через позднее связывание
+        holder = {}
+        self._compiled[cls] = CompiledSerializer(
+            dump=lambda obj: holder["dump"](obj),
+            load=lambda data: holder["load"](data),
+        )
+        try:
+            hints = t.get_type_hints(cls)
+            fields = dc.fields(cls)
+            if any(not field.init for field in fields):
+                raise UnsupportedType(cls)
+
+            namespace = {"cls": cls}
+            dump_items = []
+            load_lines = []
+            for index, field in enumerate(fields):
+                tp = hints[field.name]
+                dumper = self.dumper(tp)
+                if dumper is None:
+                    dump_items.append(f"{field.name!r}: obj.{field.name}")
+                else:
+                    namespace[f"d{index}"] = dumper
+                    dump_items.append(f"{field.name!r}: d{index}(obj.{field.name})")
+
+                namespace[f"l{index}"] = self.loader(tp)
+                load_lines.append(
+                    f"    if {field.name!r} in data:\n"
+                    f"        kw[{field.name!r}] = l{index}(data[{field.name!r}])\n"
+                )
+
+            source = (
+                "def dump(obj):\n"
+                f"    return {{{', '.join(dump_items)}}}\n"
+                "def load(data):\n"
+                "    kw = {}\n" + "".join(load_lines) + "    return cls(**kw)\n"
+            )
+            exec(compile(source, f"<serializer {cls.__qualname__}>", "exec"), namespace)
+        except Exception:
+            self._compiled.pop(cls, None)
+            raise
+
+        holder.update(dump=namespace["dump"], load=namespace["load"])
+        compiled = CompiledSerializer(dump=namespace["dump"], load=namespace["load"])
+        self._compiled[cls] = compiled
+        return compiled
+
+
+def compile_serializer(
+    cls: type, schemas: dict, factory: dataclass_factory.Factory
+) -> t.Optional[CompiledSerializer]:
+    """Скомпилированные dump/load для класса или None, если нужна фабрика"""
+    try:
+        return _Compiler(schemas, factory).compile(cls)
+    except (UnsupportedType, NameError, TypeError):
+        return None
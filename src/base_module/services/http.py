@@ -0,0 +1,231 @@
+import os
+import threading
+import typing as t
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.fields import format_multipart_header_param
+
+from base_module.http import HttpClientConfig
+from base_module.logger import ClassesLoggerAdapter
+
+
+class MultipartStream:
+    """Потоковое тело multipart/form-data с известной длиной.
+
+    Файл читается блоками при отправке, а не собирается в памяти целиком,
+    как это делает requests для параметра files.
+    """
+
+    def __init__(
+        self,
+        fields: dict,
+        file_field: str,
+        file_name: str,
+        file_obj: t.BinaryIO,
+        content_type: str,
+        chunk_size: int,
+    ):
+        """."""
+        self.boundary = uuid.uuid4().hex
+        self._file = file_obj
+        self._chunk_size = chunk_size
+
+        preamble = b""
+        for name, value in fields.items():
+            if value is None:
+                continue
+            preamble += self._part_header(format_multipart_header_param("name", name))
+            preamble += str(value).encode() + b"\r\n"
+        preamble += self._part_header(
+            format_multipart_header_param("name", file_field)
+            + "; "
+            + format_multipart_header_param("filename", file_name),
+            content_type,
+        )
+        self._preamble = preamble
+        self._epilogue = f"\r\n--{self.boundary}--\r\n".encode()
+
+        start = file_obj.tell()
+        file_obj.seek(0, os.SEEK_END)
+        self._file_size = file_obj.tell() - start
+        file_obj.seek(start)
+
+        self._reader: t.Optional[t.Iterator[bytes]] = None
+        # Прочитанная часть буфера отбрасывается только при дочитывании блока,
+        # а не копированием остатка на каждом read
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def _part_header(self, disposition: str, content_type: str = None) -> bytes:
+        header = (
+            f"--{self.boundary}\r\nContent-Disposition: form-data; {disposition}\r\n"
+        )
+        if content_type:
+            header += f"Content-Type: {content_type}\r\n"
+        return (header + "\r\n").encode()
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._preamble) + self._file_size + len(self._epilogue)
+
+    def __iter__(self):
+        yield self._preamble
+        while chunk := self._file.read(self._chunk_size):
+            yield chunk
+        yield self._epilogue
+
+    def read(self, size: int = -1) -> bytes:
+        if self._reader is None:
+            self._reader = iter(self)
+        while size < 0 or len(self._buffer) - self._offset < size:
+            chunk = next(self._reader, None)
+            if chunk is None:
+                break
+            del self._buffer[: self._offset]
+            self._offset = 0
+            self._buffer += chunk
+        end = len(self._buffer) if size < 0 else self._offset + size
+        with memoryview(self._buffer) as view:
+            result = bytes(view[self._offset : end])
+        self._offset += len(result)
+        return result
+
+
+class HttpClient:
+    """Общий для процесса пул HTTP-соединений с keep-alive.
+
+    Сессия создается заново в дочернем процессе после fork (uWSGI, пулы
+    процессов), чтобы процессы не делили одни и те же сокеты.
+    """
+
+    _sessions: t.Dict[tuple, requests.Session] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config: HttpClientConfig):
+        """."""
+        self._config = config
+        self._logger = ClassesLoggerAdapter.create(self)
+
+    @property
+    def config(self) -> HttpClientConfig:
+        return self._config
+
+    def _session_key(self, retries: int) -> tuple:
+        return (
+            os.getpid(),
+            self._config.url,
+            self._config.pool_connections,
+            self._config.pool_maxsize,
+            retries,
+        )
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session(self._config.retries)
+
+    def _session(self, retries: int) -> requests.Session:
+        key = self._session_key(retries)
+        session = self._sessions.get(key)
+        if session:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if not session:
+                for stale_key in [k for k in self._sessions if k[0] != key[0]]:
+                    # Сокеты родительского процесса не закрываем, только забываем
+                    self._sessions.pop(stale_key)
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self._config.pool_connections,
+                    pool_maxsize=self._config.pool_maxsize,
+                    max_retries=retries,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+            return session
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault(
+            "timeout", (self._config.connect_timeout, self._config.read_timeout)
+        )
+        return self.session.request(method, f"{self._config.url}{path}", **kwargs)
+
+    def upload(
+        self,
+        path: str,
+        fields: dict,
+        file_field: str,
+        file_name: str,
+        file_obj: t.BinaryIO,
+        content_type: str,
+    ) -> requests.Response:
+        """Потоковая отправка файла в multipart/form-data.
+
+        Тело читается один раз, поэтому повтор на уровне соединения отправил
+        бы его пустым или обрезанным: запрос идет через сессию без повторов,
+        а после ошибки установки соединения тело собирается заново с начала
+        файла. Прочие ошибки не повторяются: хранилище могло уже сохранить
+        файл, и повтор создал бы его копию.
+        """
+        start = file_obj.tell()
+        for attempt in range(self._config.retries + 1):
+            file_obj.seek(start)
+            body = MultipartStream(
+                fields,
+                file_field,
+                file_name,
+                file_obj,
+                content_type,
+                self._config.chunk_size,
+            )
+            try:
+                return self._session(0).request(
+                    "POST",
+                    f"{self._config.url}{path}",
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=(self._config.connect_timeout, self._config.read_timeout),
+                )
+            except requests.ConnectionError as e:
+                if attempt >= self._config.retries or not self._not_sent(e):
+                    raise
+                self._logger.warning(
+                    "Повтор отправки файла после ошибки соединения",
+                    extra={"path": path, "attempt": attempt + 1, "e": e},
+                )
+
+    @staticmethod
+    def _not_sent(error: requests.ConnectionError) -> bool:
+        """Ошибка до отправки запроса: соединение не установлено"""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0] if error.args else None, "reason", None)
+        return isinstance(reason, NewConnectionError)
+
+    def stats(self) -> dict:
+        """Счетчики переиспользования соединений текущего процесса"""
+        requests_count = 0
+        connections = 0
+        for retries in {self._config.retries, 0}:
+            session = self._sessions.get(self._session_key(retries))
+            if not session:
+                continue
+            adapter = session.get_adapter(self._config.url or "http://")
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool:
+                    requests_count += pool.num_requests
+                    connections += pool.num_connections
+        return {
+            "requests": requests_count,
+            "connections_opened": connections,
+            "connections_reused": max(requests_count - connections, 0),
+        }
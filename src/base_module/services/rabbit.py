@@ -1,5 +1,8 @@
 import datetime
 import json
+import os
+import queue
+import threading
 import time
 import typing as t
 from contextlib import contextmanager
@@ -10,9 +13,15 @@ from uuid import UUID
 import pika
 from pika import BlockingConnection, ConnectionParameters, PlainCredentials, spec
 from pika.adapters.blocking_connection import BlockingChannel
+from pika.exceptions import (
+    AMQPConnectionError,
+    ChannelClosed,
+    ChannelWrongStateError,
+)
 
 from base_module.exceptions import ModuleException
 from base_module.logger import ClassesLoggerAdapter
+from base_module.metrics import BROKER_PUBLISH, DEPENDENCY_SECONDS
 from base_module.models import Model
 from base_module.rabbit import (
     JsonMessageModel,
@@ -53,6 +62,219 @@ class FormatDumps(json.JSONEncoder):
             return str(o)
 
 
+class _PublisherConnection:
+    """Соединение отправки с основным каналом и каналом транзакций"""
+
+    def __init__(self, parameters: ConnectionParameters, confirms: bool):
+        """."""
+        self.connection = BlockingConnection(parameters)
+        self.channel = self.connection.channel()
+        if confirms:
+            self.channel.confirm_delivery()
+        self._tx_channel: t.Optional[BlockingChannel] = None
+
+    @property
+    def tx_channel(self) -> BlockingChannel:
+        if self._tx_channel is None:
+            self._tx_channel = self.connection.channel()
+            self._tx_channel.tx_select()
+        return self._tx_channel
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection.is_open and self.channel.is_open
+
+    def keepalive(self):
+        """Обработка heartbeat и закрытий, накопившихся за время простоя"""
+        self.connection.process_data_events(time_limit=0)
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+
+
+class PublisherPool:
+    """Общий для процесса пул долгоживущих соединений отправки.
+
+    Соединение берется из пула на время одной отправки, поэтому каждое
+    используется одним потоком. Пул создается заново в дочернем процессе
+    после fork (uWSGI), оборванное соединение заменяется новым.
+    """
+
+    # Ошибки соединения, после которых отправку можно повторить
+    RETRYABLE = (
+        AMQPConnectionError,
+        ChannelClosed,
+        ChannelWrongStateError,
+        OSError,
+    )
+
+    _pools: t.Dict[tuple, "PublisherPool"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config: RabbitPublisherConfig):
+        """."""
+        self._config = config
+        self._logger = ClassesLoggerAdapter.create(self)
+        self._parameters = ConnectionParameters(
+            host=config.host,
+            port=config.port,
+            credentials=PlainCredentials(
+                username=config.user, password=config.password
+            ),
+            heartbeat=config.publisher_heartbeat,
+        )
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(config.publisher_pool_size, 1))
+
+    @classmethod
+    def get(cls, config: RabbitPublisherConfig) -> "PublisherPool":
+        key = (
+            os.getpid(),
+            config.host,
+            config.port,
+            config.user,
+            config.publisher_pool_size,
+            config.publisher_heartbeat,
+            config.publisher_confirms,
+            config.publisher_transactions,
+        )
+        pool = cls._pools.get(key)
+        if pool:
+            return pool
+
+        with cls._lock:
+            pool = cls._pools.get(key)
+            if not pool:
+                for stale_key in [k for k in cls._pools if k[0] != key[0]]:
+                    # Сокеты родительского процесса не закрываем, только забываем
+                    cls._pools.pop(stale_key)
+                pool = cls._pools[key] = cls(config)
+            return pool
+
+    def _connect(self) -> _PublisherConnection:
+        connection = _PublisherConnection(
+            self._parameters, self._config.publisher_confirms
+        )
+        BROKER_PUBLISH.inc(event="connection_opened")
+        return connection
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула на время одной отправки"""
+        if not self._slots.acquire(timeout=self._config.publisher_acquire_timeout):
+            raise ModuleException(
+                ("Нет свободного соединения отправки").encode("utf-8"), code=503
+            )
+
+        connection = None
+        try:
+            try:
+                connection = self._idle.get_nowait()
+                connection.keepalive()
+            except queue.Empty:
+                pass
+            except self.RETRYABLE:
+                connection.close()
+                connection = None
+                BROKER_PUBLISH.inc(event="reconnect")
+
+            if connection is None or not connection.is_open:
+                connection = self._connect()
+            yield connection
+        except Exception:
+            if connection:
+                connection.close()
+                connection = None
+            raise
+        finally:
+            if connection:
+                self._idle.put(connection)
+            self._slots.release()
+
+    def _send(
+        self,
+        connection: _PublisherConnection,
+        exchange: str,
+        routing_key: str,
+        bodies: t.List[bytes],
+        properties: pika.BasicProperties,
+    ) -> t.Iterator[int]:
+        """Отправка, отдает число сообщений, уже принятых брокером"""
+        if not self._config.publisher_transactions or len(bodies) == 1:
+            for body in bodies:
+                connection.channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties,
+                )
+                yield 1
+            return
+
+        # Транзакция AMQP, а не publisher confirms: tx_commit на tx_batch_size
+        # сообщений, брокер принимает их все или ни одного
+        channel = connection.tx_channel
+        batch_size = max(self._config.tx_batch_size, 1)
+        for start in range(0, len(bodies), batch_size):
+            batch = bodies[start : start + batch_size]
+            for body in batch:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties,
+                )
+            channel.tx_commit()
+            yield len(batch)
+
+    def publish(
+        self,
+        exchange: str,
+        routing_key: str,
+        bodies: t.List[bytes],
+        properties: pika.BasicProperties,
+    ) -> float:
+        """Отправка с переподключением при обрыве соединения.
+
+        Повтор продолжается с первого сообщения, которое не было отправлено
+        (или не вошло в подтвержденную транзакцию), чтобы не дублировать уже
+        принятые брокером. Возвращает время отправки в секундах.
+        """
+        started = time.perf_counter()
+        attempt = 0
+        done = 0
+        while True:
+            try:
+                with self.connection() as connection:
+                    for accepted in self._send(
+                        connection, exchange, routing_key, bodies[done:], properties
+                    ):
+                        done += accepted
+                break
+            except self.RETRYABLE as e:
+                if attempt >= self._config.publish_retries:
+                    BROKER_PUBLISH.inc(len(bodies) - done, event="failed")
+                    raise
+                attempt += 1
+                BROKER_PUBLISH.inc(event="reconnect")
+                self._logger.warn(
+                    "Переподключение для отправки",
+                    extra={"attempt": attempt, "sent": done, "e": e},
+                )
+            except Exception:
+                BROKER_PUBLISH.inc(len(bodies) - done, event="failed")
+                raise
+
+        latency = time.perf_counter() - started
+        DEPENDENCY_SECONDS.observe(latency, dependency="broker", operation="publish")
+        BROKER_PUBLISH.inc(len(bodies), event="published")
+        return latency
+
+
 class RabbitService:
     """."""
 
@@ -77,6 +299,15 @@ class RabbitService:
         """."""
         self._config = config
         self._logger = ClassesLoggerAdapter.create(self)
+        self._stopping = threading.Event()
+        self._consume_channel: t.Optional[BlockingChannel] = None
+        # Сообщения, подтверждение которых отложено обработчиком.
+        # Изменяется только в потоке соединения
+        self._pending = 0
+
+    @property
+    def _publisher(self) -> PublisherPool:
+        return PublisherPool.get(self._config)
 
     @contextmanager
     def _queue_connection(self):
@@ -143,15 +374,17 @@ class RabbitService:
         properties = self._make_properties(properties)
 
         try:
-            with self._queue_connection() as channel:
-                channel.basic_publish(
-                    exchange=exchange,
-                    routing_key=publish_to,
-                    body=json.dumps(message, cls=FormatDumps).encode(),
-                    properties=properties,
-                )
-                self._logger.info("Отправлено сообщение", extra={"queue": publish_to})
-                return True
+            latency = self._publisher.publish(
+                exchange,
+                publish_to,
+                [json.dumps(message, cls=FormatDumps).encode()],
+                properties,
+            )
+            self._logger.info(
+                "Отправлено сообщение",
+                extra={"queue": publish_to, "latency_ms": round(latency * 1000, 3)},
+            )
+            return True
         except Exception as e:
             self._logger.error(
                 "Ошибка отправки сообщения",
@@ -183,18 +416,21 @@ class RabbitService:
         properties = self._make_properties(properties)
 
         try:
-            with self._queue_connection() as channel:
-                for message in messages:
-                    self._logger.info(
-                        "Отправлено сообщение", extra={"queue": publish_to}
-                    )
-                    channel.basic_publish(
-                        exchange=exchange,
-                        routing_key=publish_to,
-                        body=json.dumps(message, cls=FormatDumps).encode(),
-                        properties=properties,
-                    )
-                return True
+            latency = self._publisher.publish(
+                exchange,
+                publish_to,
+                [json.dumps(message, cls=FormatDumps).encode() for message in messages],
+                properties,
+            )
+            self._logger.info(
+                "Отправлены сообщения",
+                extra={
+                    "queue": publish_to,
+                    "count": len(messages),
+                    "latency_ms": round(latency * 1000, 3),
+                },
+            )
+            return True
         except Exception as e:
             self._logger.error(
                 "Ошибка отправки сообщений",
@@ -230,7 +466,10 @@ class RabbitService:
                 message_handled = receiver(
                     message=message, channel=ch, method=method, properties=properties
                 )
-                not message_handled and ch.basic_ack(method.delivery_tag)
+                if message_handled:
+                    self._pending += 1
+                else:
+                    ch.basic_ack(method.delivery_tag)
             except Exception as e:
                 self._logger.error(
                     "Ошибка обработки сообщения",
@@ -241,6 +480,45 @@ class RabbitService:
 
         return _handle_message
 
+    def ack_threadsafe(
+        self, channel: BlockingChannel, delivery_tag: int, ack: bool = True
+    ):
+        """Подтверждение отложенного сообщения из любого потока"""
+
+        def _ack():
+            self._pending -= 1
+            if ack:
+                channel.basic_ack(delivery_tag)
+            else:
+                channel.basic_nack(delivery_tag)
+
+        try:
+            channel.connection.add_callback_threadsafe(_ack)
+        except Exception as e:
+            self._logger.error(
+                "Ошибка подтверждения сообщения",
+                extra={"delivery_tag": delivery_tag, "e": e},
+                exc_info=True,
+            )
+
+    def stop_consume(self):
+        """Остановка прослушивания очереди, можно вызывать из любого потока"""
+        self._stopping.set()
+        channel = self._consume_channel
+        if channel:
+            channel.connection.add_callback_threadsafe(channel.stop_consuming)
+
+    def _drain(self, channel: BlockingChannel):
+        """Ожидание подтверждения уже полученных сообщений"""
+        deadline = time.monotonic() + self._config.drain_timeout
+        while self._pending > 0 and time.monotonic() < deadline:
+            channel.connection.process_data_events(time_limit=1)
+        if self._pending > 0:
+            self._logger.warn(
+                "Остановка с неподтвержденными сообщениями",
+                extra={"pending": self._pending},
+            )
+
     def run_consume(
         self, receiver, message_type: t.Type[MessageModel] = JsonMessageModel
     ):
@@ -249,14 +527,16 @@ class RabbitService:
                 ("Конфиг не соответствует конфигу прослушивания").encode("utf-8")
             )
 
-        while True:
+        while not self._stopping.is_set():
             try:
                 self._logger.info(
                     "Запуск прослушивания очереди",
                     extra={"queue": self._config.queue_name},
                 )
                 with self._queue_connection() as channel:
-                    channel.basic_qos(prefetch_count=1)
+                    self._pending = 0
+                    self._consume_channel = channel
+                    channel.basic_qos(prefetch_count=self._config.prefetch_count)
                     channel.queue_declare(
                         queue=self._config.queue_name,
                         durable=True,
@@ -270,13 +550,23 @@ class RabbitService:
                             receiver, message_type
                         ),
                     )
-                    channel.start_consuming()
+                    if not self._stopping.is_set():
+                        channel.start_consuming()
+                    self._consume_channel = None
+                    self._drain(channel)
 
             except Exception as e:
+                self._consume_channel = None
                 self._logger.error(
                     "Ошибка подключения или прослушивания очереди",
                     extra={"queue": self._config.queue_name, "e": e},
                     exc_info=True,
                 )
 
-            time.sleep(self._config.error_timeout)
+            if not self._stopping.is_set():
+                time.sleep(self._config.error_timeout)
+
+        self._logger.info(
+            "Прослушивание очереди остановлено",
+            extra={"queue": self._config.queue_name},
+        )
@@ -1,8 +1,10 @@
 import dataclasses as dc
 import os
+import typing as t
 
 import yaml
 
+from base_module.http import HttpClientConfig
 from base_module.models import Model
 from base_module.rabbit import RabbitFullConfig
 
@@ -21,13 +23,204 @@ class PgConfig(Model):
     schema: str = dc.field(default="public")
 
 
+@dc.dataclass
+class FileStorageConfig(HttpClientConfig):
+    """."""
+
+    url: str = dc.field(default="http://file-sync:5001")
+
+
+@dc.dataclass
+class ProcessingConfig(Model):
+    """."""
+
+    in_memory: bool = dc.field(default=True)
+    spool_max_size: int = dc.field(default=32 * 1024 * 1024)
+    scale_policy: str = dc.field(default="balanced")
+    fast_scale_max_percent: int = dc.field(default=50)
+    # Одинаковые задачи, пока выполняется первая, ждут ее результат
+    coalesce_in_flight: bool = dc.field(default=False)
+    # Память на обработку одного изображения, байт; 0 - без ограничения
+    memory_budget: int = dc.field(default=0)
+
+
+@dc.dataclass
+class EncodingProfile(Model):
+    """."""
+
+    # jpeg | png | webp, пусто - формат исходного файла
+    format: str = dc.field(default="")
+    # Не задано - значение Pillow по умолчанию
+    quality: t.Optional[int] = dc.field(default=None)
+    # fast | balanced | small - скорость кодирования против размера файла
+    speed: str = dc.field(default="")
+    optimize: t.Optional[bool] = dc.field(default=None)
+    progressive: t.Optional[bool] = dc.field(default=None)
+    # PNG, 0-9
+    compress_level: t.Optional[int] = dc.field(default=None)
+
+
+@dc.dataclass
+class EncodingConfig(Model):
+    """."""
+
+    default: EncodingProfile = dc.field(default_factory=EncodingProfile)
+    # Именованные профили, задача выбирает их полем output
+    profiles: t.Dict[str, EncodingProfile] = dc.field(default_factory=dict)
+
+
+@dc.dataclass
+class ResultCacheConfig(Model):
+    """."""
+
+    enabled: bool = dc.field(default=False)
+    # Время жизни записи, секунды
+    ttl: int = dc.field(default=7 * 24 * 3600)
+    # Максимум записей, сверх него удаляются давно не запрошенные (LRU)
+    max_entries: int = dc.field(default=100000)
+    # Очистка выполняется раз в указанное число сохранений
+    evict_every: int = dc.field(default=500)
+    # Проверять наличие обработанного файла в хранилище при попадании
+    validate_hits: bool = dc.field(default=False)
+
+
+@dc.dataclass
+class SourceCacheConfig(Model):
+    """."""
+
+    enabled: bool = dc.field(default=False)
+    # Каталог кэша, пусто - <temp_dir>/sources
+    dir: str = dc.field(default="")
+    # Объем файлов, сверх него удаляются давно не использованные (LRU)
+    max_bytes: int = dc.field(default=1024 * 1024 * 1024)
+
+
+@dc.dataclass
+class BatchConfig(Model):
+    """."""
+
+    max_items: int = dc.field(default=5000)
+    # Параллельные запросы к хранилищу при проверке файлов
+    check_concurrency: int = dc.field(default=16)
+
+
+@dc.dataclass
+class PageConfig(Model):
+    """."""
+
+    default_size: int = dc.field(default=100)
+    max_size: int = dc.field(default=500)
+
+
+@dc.dataclass
+class QueueConfig(Model):
+    """."""
+
+    # rabbit - задачи через брокер, postgres - воркер выбирает их из таблицы
+    backend: str = dc.field(default="rabbit")
+    # Задач, захватываемых воркером за один запрос (postgres)
+    batch_size: int = dc.field(default=10)
+    # Проверка таблицы без уведомления, секунды (postgres)
+    poll_interval: float = dc.field(default=5)
+    notify_channel: str = dc.field(default="image_processing_task_new")
+
+
+@dc.dataclass
+class OutboxConfig(Model):
+    """."""
+
+    # Сообщения о задачах пишутся в таблицу вместе с задачей, отправляет их воркер
+    enabled: bool = dc.field(default=False)
+    # Сообщений за одну отправку
+    batch_size: int = dc.field(default=500)
+    # Проверка таблицы без уведомления, секунды
+    poll_interval: float = dc.field(default=1)
+    notify_channel: str = dc.field(default="image_processing_outbox")
+    # Наличие файла в хранилище проверяет воркер, а не API
+    defer_file_check: bool = dc.field(default=False)
+
+
+@dc.dataclass
+class PriorityConfig(Model):
+    """."""
+
+    # Приоритет сообщения по оценке стоимости задачи и полю priority запроса
+    enabled: bool = dc.field(default=False)
+    # Границы стоимости (мегапиксели исходника с весами операций) по возрастанию
+    cost_levels: t.List[float] = dc.field(default_factory=lambda: [2, 12, 50, 200])
+    # Приоритет задачи без метаданных файла
+    unknown_priority: int = dc.field(default=2)
+
+
+@dc.dataclass
+class MetricsConfig(Model):
+    """."""
+
+    # Общий каталог снимков метрик процессов uWSGI, пусто - только свой процесс
+    multiprocess_dir: str = dc.field(default="")
+    # Порт выдачи метрик воркера, 0 - не запускать
+    worker_port: int = dc.field(default=9100)
+
+
+@dc.dataclass
+class ProfilingConfig(Model):
+    """."""
+
+    # Выключено - воркер не проверяет условия профилирования вовсе
+    enabled: bool = dc.field(default=False)
+    # Каждая N-я задача процесса, 0 - без выборки
+    sample_every: int = dc.field(default=0)
+    task_ids: list[int] = dc.field(default_factory=list)
+    # Задачи, созданные с заголовком X-Profile-Task: 1. Заголовок может передать
+    # любой клиент API, поэтому по умолчанию он не учитывается
+    on_request: bool = dc.field(default=False)
+    # Пусто - каталог profiles внутри temp_dir
+    dump_dir: str = dc.field(default="")
+    # Пик и места выделения памяти (tracemalloc)
+    memory: bool = dc.field(default=True)
+    top: int = dc.field(default=25)
+
+
+@dc.dataclass
+class WorkerConfig(Model):
+    """."""
+
+    # single - одна задача за раз, concurrent - пулы потоков и процессов
+    mode: str = dc.field(default="single")
+    # 0 - по числу rabbit.prefetch_count
+    io_threads: int = dc.field(default=0)
+    # 0 - по числу ядер
+    cpu_processes: int = dc.field(default=0)
+    # Аренда задачи, секунды: дольше воркер не может обрабатывать одну задачу
+    lease_timeout: int = dc.field(default=600)
+    # Период поиска задач с устаревшей арендой, секунды
+    reclaim_interval: int = dc.field(default=60)
+    # Передача исходника и результата в пул процессов через разделяемую память
+    shared_memory: bool = dc.field(default=True)
+    # Сегменты в простое, байт; остальные удаляются после задачи
+    shared_memory_idle: int = dc.field(default=256 * 1024 * 1024)
+    profiling: ProfilingConfig = dc.field(default_factory=ProfilingConfig)
+
+
 @dc.dataclass
 class ProjectConfig(Model):
     """."""
 
     pg: PgConfig = dc.field(default_factory=PgConfig)
     temp_dir: str = dc.field(default="/tmp")
+    processing: ProcessingConfig = dc.field(default_factory=ProcessingConfig)
+    encoding: EncodingConfig = dc.field(default_factory=EncodingConfig)
+    worker: WorkerConfig = dc.field(default_factory=WorkerConfig)
+    queue: QueueConfig = dc.field(default_factory=QueueConfig)
+    outbox: OutboxConfig = dc.field(default_factory=OutboxConfig)
+    priority: PriorityConfig = dc.field(default_factory=PriorityConfig)
+    metrics: MetricsConfig = dc.field(default_factory=MetricsConfig)
+    result_cache: ResultCacheConfig = dc.field(default_factory=ResultCacheConfig)
+    source_cache: SourceCacheConfig = dc.field(default_factory=SourceCacheConfig)
+    batch: BatchConfig = dc.field(default_factory=BatchConfig)
+    page: PageConfig = dc.field(default_factory=PageConfig)
     rabbit: RabbitFullConfig = dc.field(default=None)
+    file_storage: FileStorageConfig = dc.field(default_factory=FileStorageConfig)
 
 
 config: ProjectConfig = ProjectConfig.load(
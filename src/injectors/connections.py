@@ -1,5 +1,6 @@
 from config import config
 from injectors.pg import PgConnectionInj
 from models import *
+from models.migrations import MIGRATIONS
 
-pg = PgConnectionInj(conf=config.pg)
+pg = PgConnectionInj(conf=config.pg, migrate_statements=MIGRATIONS)
@@ -9,6 +9,7 @@ from sqlalchemy_utils import create_database, database_exists
 
 from base_module.exceptions import ModuleException
 from base_module.logger import ClassesLoggerAdapter
+from base_module.metrics import DEPENDENCY_SECONDS
 from base_module.models import BaseOrmModel
 from base_module.singletons import ThreadIsolatedSingleton
 from config import PgConfig
@@ -35,6 +36,7 @@ class PgConnectionInj(metaclass=ThreadIsolatedSingleton):
         acquire_attempts: int = 5,
         acquire_error_timeout: int = 5,
         init_statements: list = None,
+        migrate_statements: list = None,
     ):
         """."""
         self._conf = conf
@@ -42,6 +44,7 @@ class PgConnectionInj(metaclass=ThreadIsolatedSingleton):
         self._acquire_attempts = acquire_attempts
         self._acquire_error_timeout = acquire_error_timeout
         self._init_statements = init_statements or list()
+        self._migrate_statements = migrate_statements or list()
         self._pg: t.Union[sa.orm.scoped_session, Session, None] = None
         self._logger = ClassesLoggerAdapter.create(self)
 
@@ -80,6 +83,29 @@ class PgConnectionInj(metaclass=ThreadIsolatedSingleton):
                         schemas.append(col.type.schema)
         return schemas
 
+    @staticmethod
+    def _instrument(engine: sa.engine.Engine):
+        """Время запросов к БД в метриках, по первому слову запроса"""
+
+        @sa.event.listens_for(engine, "before_cursor_execute")
+        def _before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+        @sa.event.listens_for(engine, "after_cursor_execute")
+        def _after(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info["metrics_started"].pop()
+            operation = statement.lstrip().split(None, 1)[0].upper()
+            DEPENDENCY_SECONDS.observe(
+                time.perf_counter() - started, dependency="db", operation=operation
+            )
+
+        @sa.event.listens_for(engine, "handle_error")
+        def _error(context):
+            connection = context.connection
+            stack = connection.info.get("metrics_started") if connection else None
+            if stack:
+                stack.pop()
+
     def _init_db(self):
         engine = sa.create_engine(
             sa.engine.URL.create(
@@ -93,6 +119,7 @@ class PgConnectionInj(metaclass=ThreadIsolatedSingleton):
             echo=self._conf.debug,
             query_cache_size=0,
         )
+        self._instrument(engine)
         if not database_exists(engine.url):
             create_database(engine.url)
         schemas = self.__set_schemas()
@@ -110,6 +137,11 @@ class PgConnectionInj(metaclass=ThreadIsolatedSingleton):
 
                 BaseOrmModel.REGISTRY.metadata.create_all(connection)
 
+                for statement in self._migrate_statements:
+                    connection.execute(
+                        sa.text(statement.format(schema=self._conf.schema))
+                    )
+
         session_fabric = sessionmaker(engine, expire_on_commit=False)
         self._pg = sa.orm.scoped_session(session_fabric)
 
@@ -1,14 +1,25 @@
+import os
+
+from base_module.metrics import REGISTRY
 from base_module.services.rabbit import RabbitService
 from config import config
 
+from services.concurrent_worker import ConcurrentTasksWorker
+from services.outbox import OutboxRelay
+from services.pg_queue_worker import PgQueueWorker
+from services.priority import TaskPriority
+from services.result_cache import ResultCache
 from services.services import FileStorageData, ImageProcessor
+from services.profiling import TaskProfiler
+from services.shared_buffers import SharedBufferPool
+from services.source_cache import SourceCache
+from services.task_repository import TaskRepository
 from services.task_worker import TasksWorker
 from services.tasks import ImageProcessing
 
 from . import connections
 
 
-
 def rabbit() -> RabbitService:
     """."""
     return RabbitService(config.rabbit)
@@ -16,12 +27,41 @@ def rabbit() -> RabbitService:
 
 def image_processor() -> ImageProcessor:
     """."""
-    return ImageProcessor()
+    return ImageProcessor(
+        scale_policy=config.processing.scale_policy,
+        fast_scale_max_percent=config.processing.fast_scale_max_percent,
+        memory_budget=config.processing.memory_budget,
+        output={
+            key: value
+            for key, value in config.encoding.default.dump().items()
+            if value not in (None, "")
+        },
+    )
 
 
 def file_storage_req() -> FileStorageData:
     """."""
-    return FileStorageData()
+    return FileStorageData(config.file_storage)
+
+
+def result_cache() -> ResultCache:
+    """."""
+    return ResultCache(
+        pg_connection=connections.pg.acquire_session(),
+        config=config.result_cache,
+        file_request=file_storage_req(),
+    )
+
+
+def task_priority() -> TaskPriority | None:
+    """."""
+    if not config.priority.enabled or config.queue.backend == "postgres":
+        return None
+    return TaskPriority(
+        cost_levels=config.priority.cost_levels,
+        unknown_priority=config.priority.unknown_priority,
+        max_priority=config.rabbit.max_priority,
+    )
 
 
 def processing_injector() -> ImageProcessing:
@@ -29,17 +69,103 @@ def processing_injector() -> ImageProcessing:
     return ImageProcessing(
         pg_connection=connections.pg.acquire_session(),
         rabbit=rabbit(),
-        file_request=file_storage_req()
+        file_request=file_storage_req(),
+        result_cache=result_cache(),
+        coalesce=config.processing.coalesce_in_flight,
+        batch=config.batch,
+        page=config.page,
+        notify_channel=(
+            config.queue.notify_channel if config.queue.backend == "postgres" else None
+        ),
+        encoding=config.encoding,
+        outbox=config.outbox,
+        priority=task_priority(),
+        profile_requests=(
+            config.worker.profiling.enabled and config.worker.profiling.on_request
+        ),
+    )
+
+
+def task_profiler() -> TaskProfiler | None:
+    """."""
+    profiling = config.worker.profiling
+    if not profiling.enabled:
+        return None
+    return TaskProfiler(
+        profiling.dump_dir or os.path.join(config.temp_dir, "profiles"),
+        sample_every=profiling.sample_every,
+        task_ids=profiling.task_ids,
+        on_request=profiling.on_request,
+        memory=profiling.memory,
+        top=profiling.top,
+    )
+
+
+def shared_buffers() -> SharedBufferPool | None:
+    """."""
+    if not config.worker.shared_memory:
+        return None
+    return SharedBufferPool(config.worker.shared_memory_idle)
+
+
+def source_cache() -> SourceCache | None:
+    """."""
+    if not config.source_cache.enabled:
+        return None
+    return SourceCache(
+        config.source_cache.dir or os.path.join(config.temp_dir, "sources"),
+        config.source_cache.max_bytes,
+    )
+
+
+def outbox_relay() -> OutboxRelay | None:
+    """."""
+    if not config.outbox.enabled or config.queue.backend == "postgres":
+        return None
+    return OutboxRelay(
+        pg_connection=connections.pg.acquire_session(),
+        rabbit=rabbit(),
+        notify_channel=config.outbox.notify_channel,
+        batch_size=config.outbox.batch_size,
+        poll_interval=config.outbox.poll_interval,
     )
 
 
 def tasks_mule() -> TasksWorker:
     """."""
-    return TasksWorker(
+    REGISTRY.configure(config.metrics.multiprocess_dir)
+    pg_connection = connections.pg.acquire_session()
+    kwargs = dict(
         rabbit=rabbit(),
-        pg_connection=connections.pg.acquire_session(),
+        pg_connection=pg_connection,
         file_request=file_storage_req(),
         image_proc=image_processor(),
-        temp_dir=config.temp_dir
+        temp_dir=config.temp_dir,
+        processing=config.processing,
+        result_cache=result_cache(),
+        repository=TaskRepository(
+            pg_connection, lease_timeout=config.worker.lease_timeout
+        ),
+        reclaim_interval=config.worker.reclaim_interval,
+        metrics_port=config.metrics.worker_port,
+        profiler=task_profiler(),
+        source_cache=source_cache(),
+        outbox_relay=outbox_relay(),
     )
-
+    if config.queue.backend == "postgres":
+        kwargs["rabbit"] = None
+        return PgQueueWorker(
+            notify_channel=config.queue.notify_channel,
+            batch_size=config.queue.batch_size,
+            poll_interval=config.queue.poll_interval,
+            io_threads=config.worker.io_threads or 1,
+            **kwargs,
+        )
+    if config.worker.mode == "concurrent":
+        return ConcurrentTasksWorker(
+            io_threads=config.worker.io_threads or config.rabbit.prefetch_count,
+            cpu_processes=config.worker.cpu_processes,
+            shared_buffers=shared_buffers(),
+            **kwargs,
+        )
+    return TasksWorker(**kwargs)
@@ -0,0 +1,22 @@
+"""Изменения схемы для уже существующих баз (create_all не изменяет таблицы)"""
+
+MIGRATIONS = [
+    "ALTER TYPE \"{schema}\".\"Image_processing_type\" ADD VALUE IF NOT EXISTS 'PIPELINE'",
+    "ALTER TYPE \"{schema}\".\"Image_processing_type\" ADD VALUE IF NOT EXISTS 'RENDITIONS'",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS operations JSONB",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS operation_key VARCHAR(64)",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS leader_task_id INTEGER",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(128)",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS leased_at TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS output JSONB",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS result_meta JSONB",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS processed_file_ids JSONB",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS priority INTEGER",
+    "ALTER TABLE \"{schema}\".image_processing_task_outbox ADD COLUMN IF NOT EXISTS priority INTEGER",
+    "ALTER TABLE \"{schema}\".image_processing_task ADD COLUMN IF NOT EXISTS profile BOOLEAN DEFAULT FALSE",
+    "CREATE INDEX IF NOT EXISTS ix_image_processing_task_operation_key ON \"{schema}\".image_processing_task (operation_key)",
+    "CREATE INDEX IF NOT EXISTS ix_image_processing_task_leader_task_id ON \"{schema}\".image_processing_task (leader_task_id)",
+    "CREATE INDEX IF NOT EXISTS ix_image_processing_task_created_at_task_id ON \"{schema}\".image_processing_task (created_at, task_id)",
+    "CREATE INDEX IF NOT EXISTS ix_image_processing_task_status_created_at ON \"{schema}\".image_processing_task (status, created_at, task_id)",
+    "CREATE INDEX IF NOT EXISTS ix_image_processing_task_file_id_created_at ON \"{schema}\".image_processing_task (file_id, created_at, task_id)",
+]
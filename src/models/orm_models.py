@@ -3,6 +3,7 @@ import typing
 from datetime import datetime
 
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
 
 from base_module.models import BaseOrmModel, ValuedEnum
 
@@ -21,6 +22,10 @@ class TaskType(ValuedEnum):
 
     ROTATE = "rotate"
     SCALE = "scale"
+    # Несколько операций за одно декодирование/кодирование
+    PIPELINE = "pipeline"
+    # Несколько уменьшенных копий за одно декодирование
+    RENDITIONS = "renditions"
 
 
 @dc.dataclass
@@ -28,17 +33,75 @@ class ImageProcessingTask(BaseOrmModel):
     """."""
 
     __tablename__ = "image_processing_task"
+    # Постраничный вывод по ключу (created_at, task_id) с фильтрами
+    __table_args__ = (
+        sa.Index(
+            "ix_image_processing_task_created_at_task_id", "created_at", "task_id"
+        ),
+        sa.Index(
+            "ix_image_processing_task_status_created_at",
+            "status",
+            "created_at",
+            "task_id",
+        ),
+        sa.Index(
+            "ix_image_processing_task_file_id_created_at",
+            "file_id",
+            "created_at",
+            "task_id",
+        ),
+    )
 
     task_id: typing.Optional[int] = dc.field(
         default=None, metadata={"sa": sa.Column(sa.Integer, primary_key=True)}
     )
     file_id: int = dc.field(default=None, metadata={"sa": sa.Column(sa.Integer)})
     processed_file_id: int = dc.field(default=0, metadata={"sa": sa.Column(sa.Integer)})
+    # Все файлы результата (набор копий), processed_file_id - первый из них
+    processed_file_ids: typing.Optional[typing.List[int]] = dc.field(
+        default=None, metadata={"sa": sa.Column(JSONB)}
+    )
     task_type: TaskType = dc.field(
         default=None,
         metadata={"sa": sa.Column(sa.Enum(TaskType, name="Image_processing_type"))},
     )
-    task_type_value: int = dc.field(default=None, metadata={"sa": sa.Column(sa.Integer)})
+    task_type_value: typing.Optional[int] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer)}
+    )
+    operations: typing.Optional[typing.List[dict]] = dc.field(
+        default=None, metadata={"sa": sa.Column(JSONB)}
+    )
+    # Профиль кодирования результата, None - профиль по умолчанию
+    output: typing.Optional[dict] = dc.field(
+        default=None, metadata={"sa": sa.Column(JSONB)}
+    )
+    # Формат, MIME-тип, размер и время кодирования результата
+    result_meta: typing.Optional[dict] = dc.field(
+        default=None, metadata={"sa": sa.Column(JSONB)}
+    )
+    # Ключ источника и операций, по нему объединяются одинаковые задачи
+    operation_key: typing.Optional[str] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.String(64), index=True)}
+    )
+    # Ведущая задача, результат которой получит эта задача
+    leader_task_id: typing.Optional[int] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer, index=True)}
+    )
+    # Воркер, захвативший задачу, и время захвата (аренда задачи)
+    lease_owner: typing.Optional[str] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.String(128))}
+    )
+    leased_at: typing.Optional[datetime] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.DateTime)}
+    )
+    # Приоритет сообщения в очереди брокера, None - без приоритета
+    priority: typing.Optional[int] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer)}
+    )
+    # Профилирование задачи по запросу (заголовок X-Profile-Task)
+    profile: bool = dc.field(
+        default=False, metadata={"sa": sa.Column(sa.Boolean, default=False)}
+    )
     status: TaskStatus = dc.field(
         default=TaskStatus.NEW,
         metadata={"sa": sa.Column(sa.Enum(TaskStatus, name="Image_processing_status"))},
@@ -50,5 +113,60 @@ class ImageProcessingTask(BaseOrmModel):
         default=None, metadata={"sa": sa.Column(sa.DateTime)}
     )
 
+    def pipeline(self) -> typing.List[dict]:
+        """Упорядоченный список операций задачи"""
+        if self.operations:
+            return self.operations
+        return [{"type": self.task_type.value, "value": self.task_type_value}]
+
+
+@dc.dataclass
+class ProcessingResultCache(BaseOrmModel):
+    """Результат обработки по ключу (источник + операции)"""
+
+    __tablename__ = "image_processing_result_cache"
+
+    cache_key: str = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.String(64), primary_key=True)}
+    )
+    file_id: int = dc.field(default=None, metadata={"sa": sa.Column(sa.Integer)})
+    processed_file_id: int = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer)}
+    )
+    hits: int = dc.field(default=0, metadata={"sa": sa.Column(sa.Integer)})
+    created_at: typing.Optional[datetime] = dc.field(
+        default_factory=datetime.now, metadata={"sa": sa.Column(sa.DateTime)}
+    )
+    last_hit_at: typing.Optional[datetime] = dc.field(
+        default_factory=datetime.now,
+        metadata={"sa": sa.Column(sa.DateTime, index=True)},
+    )
+
+
+@dc.dataclass
+class TaskOutbox(BaseOrmModel):
+    """Сообщение о задаче, записанное вместе с ней и ожидающее отправки в брокер"""
+
+    __tablename__ = "image_processing_task_outbox"
+
+    outbox_id: typing.Optional[int] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer, primary_key=True)}
+    )
+    # Данные TaskIdentMessageModel: task_id, file_info, profile
+    payload: typing.Optional[dict] = dc.field(
+        default=None, metadata={"sa": sa.Column(JSONB)}
+    )
+    trace_id: typing.Optional[str] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.String)}
+    )
+    priority: typing.Optional[int] = dc.field(
+        default=None, metadata={"sa": sa.Column(sa.Integer)}
+    )
+    created_at: typing.Optional[datetime] = dc.field(
+        default_factory=datetime.now, metadata={"sa": sa.Column(sa.DateTime)}
+    )
+
 
-BaseOrmModel.REGISTRY.mapped(ImageProcessingTask)
\ No newline at end of file
+BaseOrmModel.REGISTRY.mapped(ImageProcessingTask)
+BaseOrmModel.REGISTRY.mapped(ProcessingResultCache)
+BaseOrmModel.REGISTRY.mapped(TaskOutbox)
@@ -9,15 +9,26 @@ task_router = flask.Blueprint("tasks", __name__, url_prefix="/api/")
 @task_router.post("/processing/<int:file_id>")
 def task_create(file_id):
     ts = processing_injector()
-    response = ts.create_task(file_id, request.get_json())
+    response = ts.create_task(
+        file_id,
+        request.get_json(),
+        profile=request.headers.get("X-Profile-Task") == "1",
+    )
+    return response
+
+
+@task_router.post("/processing/batch")
+def task_create_batch():
+    ts = processing_injector()
+    response = ts.create_tasks(request.get_json())
     return response
 
 
 @task_router.get("/tasks")
 def tasks_list():
     ts = processing_injector()
-    response = ts.get_all()
-    return jsonify(response)
+    response = ts.get_all(request.args.to_dict())
+    return response
 
 
 @task_router.get("/tasks/<int:task_id>")
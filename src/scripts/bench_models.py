@@ -0,0 +1,58 @@
+"""Сравнение скомпилированных dump/load моделей с путем через dataclass_factory.
+
+python src/scripts/bench_models.py [число итераций]
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+
+def cases():
+    from models.orm_models import ImageProcessingTask, TaskStatus, TaskType
+    from services.task_worker import TaskIOStats, TaskTimings
+
+    task = ImageProcessingTask(
+        task_id=1,
+        file_id=10,
+        processed_file_id=11,
+        task_type=TaskType.PIPELINE,
+        task_type_value=None,
+        operations=[{"type": "scale", "value": 50}, {"type": "rotate", "value": 90}],
+        operation_key="0" * 64,
+        status=TaskStatus.DONE,
+        created_at=datetime.now(),
+        updated_at=datetime.now(),
+    )
+    timings = TaskTimings(metadata=0.01, download=0.2, total=0.5)
+    io_stats = TaskIOStats(downloaded_bytes=1 << 20, spilled=True, peak_rss_kb=65536)
+    return [task, timings, io_stats]
+
+
+def bench(number: int):
+    for model in cases():
+        cls = type(model)
+        assert cls._serializer(), f"{cls.__name__}: нет скомпилированного плана"
+        dumped = model.dump()
+        assert dumped == cls.FACTORY.dump(model), cls.__name__
+        assert cls.load(dumped).dump() == cls.FACTORY.load(dumped, cls).dump()
+
+        results = {
+            "factory dump": timeit.timeit(
+                lambda: cls.FACTORY.dump(model), number=number
+            ),
+            "compiled dump": timeit.timeit(model.dump, number=number),
+            "factory load": timeit.timeit(
+                lambda: cls.FACTORY.load(dumped, cls), number=number
+            ),
+            "compiled load": timeit.timeit(lambda: cls.load(dumped), number=number),
+        }
+        print(cls.__name__)
+        for name, seconds in results.items():
+            print(f"  {name:<14} {seconds / number * 1e6:8.2f} мкс")
+
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,87 @@
+"""Сравнение попиксельных операций services.pixel_ops с эквивалентами Pillow
+(ImageEnhance, Image.point, ImageOps, Image.convert, Image.paste с маской).
+
+python src/scripts/bench_pixel_ops.py [ширина] [высота] [число итераций]
+"""
+
+import os
+import sys
+import timeit
+
+
+def source_image(width: int, height: int):
+    from PIL import Image
+
+    image = Image.radial_gradient("L").resize((width, height))
+    rgba = Image.merge("RGBA", (image, image.transpose(0), image.transpose(1), image))
+    return rgba.convert("RGB"), rgba
+
+
+def pillow_cases():
+    from PIL import Image, ImageEnhance, ImageOps
+
+    def gamma(image, value):
+        return image.point(lambda v: 255 * (v / 255) ** (1 / value))
+
+    def flatten(image):
+        result = Image.new("RGB", image.size, "white")
+        result.paste(image, mask=image.getchannel("A"))
+        return result
+
+    def chain(image):
+        image = ImageEnhance.Brightness(image).enhance(1.1)
+        image = ImageEnhance.Contrast(image).enhance(1.2)
+        return gamma(image, 1.5)
+
+    return {
+        "brightness": lambda image: ImageEnhance.Brightness(image).enhance(1.2),
+        "contrast": lambda image: ImageEnhance.Contrast(image).enhance(1.2),
+        "gamma": lambda image: gamma(image, 2.2),
+        "normalize": ImageOps.autocontrast,
+        "grayscale": lambda image: image.convert("L"),
+        "flatten_alpha": flatten,
+        "chain": chain,
+        "chain+grayscale": lambda image: chain(image).convert("L"),
+    }
+
+
+def engine_cases():
+    from services.pixel_ops import PIXEL_OPERATIONS, apply_pixel_operations
+
+    def case(*operations):
+        operations = [
+            {"type": name, "value": PIXEL_OPERATIONS[name].parse(value)}
+            for name, value in operations
+        ]
+        return lambda image: apply_pixel_operations(image, operations)
+
+    chain = (("brightness", 1.1), ("contrast", 1.2), ("gamma", 1.5))
+    return {
+        "brightness": case(("brightness", 1.2)),
+        "contrast": case(("contrast", 1.2)),
+        "gamma": case(("gamma", 2.2)),
+        "normalize": case(("normalize", True)),
+        "grayscale": case(("grayscale", True)),
+        "flatten_alpha": case(("flatten_alpha", True)),
+        "chain": case(*chain),
+        "chain+grayscale": case(*chain, ("grayscale", True)),
+    }
+
+
+def bench(width: int, height: int, number: int):
+    rgb, rgba = source_image(width, height)
+    print(f"{width}x{height}, мс на операцию")
+    pillow, engine = pillow_cases(), engine_cases()
+    for name in pillow:
+        image = rgba if name == "flatten_alpha" else rgb
+        row = [
+            timeit.timeit(lambda: cases[name](image), number=number) / number * 1e3
+            for cases in (pillow, engine)
+        ]
+        print(f"  {name:<16} pillow {row[0]:8.2f}  pixel_ops {row[1]:8.2f}")
+
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    args = [int(arg) for arg in sys.argv[1:]]
+    bench(*(args + [4000, 3000, 5][len(args) :]))
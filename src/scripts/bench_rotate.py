@@ -0,0 +1,105 @@
+"""Сравнение прежнего поворота (Image.rotate с expand) с поворотом на прямой угол
+перестановкой пикселей и без перекодирования (jpegtran, если он установлен).
+Перед замером проверяется, что результат jpegtran и перекодированный результат
+отображаются одинаково (с учетом тега EXIF Orientation).
+
+python src/scripts/bench_rotate.py [ширина] [высота] [число итераций]
+"""
+
+import io
+import os
+import sys
+import timeit
+
+
+def source_jpeg(width: int, height: int) -> bytes:
+    from PIL import Image
+
+    image = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def rotate_previous(data: bytes, angle: int) -> bytes:
+    """Прежний путь: декодирование, Image.rotate, кодирование по умолчанию"""
+    from PIL import Image
+
+    result = io.BytesIO()
+    Image.open(io.BytesIO(data)).rotate(angle, expand=True).save(result, "JPEG")
+    return result.getvalue()
+
+
+def rotate_current(data: bytes, angle: int, output: dict = None) -> bytes:
+    from services.services import ImageProcessor, process_image
+
+    operations = [{"type": "rotate", "value": angle}]
+    with process_image(
+        ImageProcessor(), io.BytesIO(data), operations, ".jpg", output=output
+    ) as result:
+        return result.getvalue()
+
+
+def oriented_jpeg(width: int, height: int) -> bytes:
+    """Несимметричное изображение с тегом Orientation (поворот на 90)"""
+    from PIL import Image
+
+    horizontal = Image.linear_gradient("L").transpose(Image.Transpose.TRANSPOSE)
+    image = Image.merge(
+        "RGB", (Image.linear_gradient("L"), horizontal, Image.new("L", (256, 256)))
+    ).resize((width, height))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95, exif=exif)
+    return buffer.getvalue()
+
+
+def displayed(data: bytes):
+    """Изображение так, как его покажет просмотрщик"""
+    from PIL import Image, ImageOps
+
+    return ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB")
+
+
+def check_orientation(angle: int):
+    """jpegtran и перекодирование Pillow отображаются одинаково"""
+    from PIL import ImageChops, ImageStat
+
+    from services.services import jpegtran_rotate
+
+    data = oriented_jpeg(512, 256)
+    lossless = jpegtran_rotate(data, angle)
+    if lossless is None:
+        raise SystemExit(f"jpegtran не повернул изображение на {angle}")
+    # Профиль с quality исключает путь jpegtran
+    reencoded = rotate_current(data, angle, {"quality": 95})
+    first, second = displayed(lossless), displayed(reencoded)
+    difference = max(ImageStat.Stat(ImageChops.difference(first, second)).mean)
+    if first.size != second.size or difference > 8:
+        raise SystemExit(
+            f"Поворот {angle}: jpegtran {first.size} и перекодирование "
+            f"{second.size} отображаются по-разному (разница {difference:.1f})"
+        )
+
+
+def bench(width: int, height: int, number: int):
+    from services.services import JPEGTRAN, jpegtran_rotate
+
+    data = source_jpeg(width, height)
+    print(f"{width}x{height}, {len(data)} байт, jpegtran: {JPEGTRAN or 'нет'}")
+    cases = {"previous": rotate_previous, "current": rotate_current}
+    if JPEGTRAN:
+        for angle in (90, 180, 270):
+            check_orientation(angle)
+        cases["jpegtran"] = jpegtran_rotate
+    for angle in (90, 180, 270):
+        for name, rotate in cases.items():
+            seconds = timeit.timeit(lambda: rotate(data, angle), number=number)
+            print(f"  {angle:>3} {name:<9} {seconds / number * 1e3:8.2f} мс")
+
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    args = [int(arg) for arg in sys.argv[1:]]
+    bench(*(args + [4000, 3000, 5][len(args) :]))
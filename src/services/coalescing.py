@@ -0,0 +1,72 @@
+"""Объединение одинаковых задач, пока первая (ведущая) еще выполняется.
+
+Координация через Postgres: создание задачи и завершение ведущей задачи
+выполняются под одной транзакционной advisory-блокировкой по ключу операции,
+поэтому ведомая задача либо видна при завершении ведущей, либо сама
+видит ведущую уже завершенной.
+"""
+
+from typing import Dict, Iterable, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session as PGSession
+
+from base_module import sa_operator
+from models.orm_models import ImageProcessingTask, TaskStatus
+
+IN_FLIGHT_STATUSES = [TaskStatus.NEW, TaskStatus.PROCESSING]
+
+
+def lock_operation(pg: PGSession, operation_key: str):
+    """Блокировка ключа операции до конца текущей транзакции"""
+    pg.execute(
+        sa.select(sa.func.pg_advisory_xact_lock(sa.func.hashtext(operation_key)))
+    )
+
+
+def lock_operations(pg: PGSession, operation_keys: Iterable[str]):
+    """Блокировка нескольких ключей одним запросом, в фиксированном порядке"""
+    pg.execute(
+        sa.text(
+            "SELECT pg_advisory_xact_lock(hashtext(u.key)) "
+            "FROM unnest(CAST(:keys AS text[])) WITH ORDINALITY AS u(key, n) "
+            "ORDER BY u.n"
+        ),
+        {"keys": sorted(set(operation_keys))},
+    )
+
+
+def find_leader(pg: PGSession, operation_key: str) -> Optional[int]:
+    """Выполняющаяся ведущая задача с тем же ключом операции"""
+    return pg.execute(
+        sa.select(ImageProcessingTask.task_id)
+        .where(
+            sa.and_(
+                sa_operator.eq(ImageProcessingTask.operation_key, operation_key),
+                sa_operator.in_(ImageProcessingTask.status, IN_FLIGHT_STATUSES),
+                ImageProcessingTask.leader_task_id.is_(None),
+            )
+        )
+        .order_by(ImageProcessingTask.task_id)
+        .limit(1)
+    ).scalar()
+
+
+def find_leaders(pg: PGSession, operation_keys: Iterable[str]) -> Dict[str, int]:
+    """Выполняющиеся ведущие задачи по ключам операций"""
+    rows = pg.execute(
+        sa.select(
+            ImageProcessingTask.operation_key, sa.func.min(ImageProcessingTask.task_id)
+        )
+        .where(
+            sa.and_(
+                sa_operator.in_(
+                    ImageProcessingTask.operation_key, list(operation_keys)
+                ),
+                sa_operator.in_(ImageProcessingTask.status, IN_FLIGHT_STATUSES),
+                ImageProcessingTask.leader_task_id.is_(None),
+            )
+        )
+        .group_by(ImageProcessingTask.operation_key)
+    )
+    return {key: task_id for key, task_id in rows}
@@ -0,0 +1,215 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pika.adapters.blocking_connection import BlockingChannel
+
+from base_module.logger import ClassesLoggerAdapter
+from base_module.rabbit import TaskIdentMessageModel
+from services.services import (
+    process_image_bytes,
+    process_image_shared,
+    render_renditions_bytes,
+    render_renditions_shared,
+)
+from services.shared_buffers import (
+    PICKLE_COPIES,
+    SharedBufferPool,
+    SharedSlice,
+    timed_call,
+)
+from services.task_worker import TasksWorker
+
+
+class ConcurrentTasksWorker(TasksWorker):
+    """Параллельная обработка задач.
+
+    Скачивание, загрузка и работа с БД выполняются в пуле потоков,
+    декодирование, обработка и кодирование - в ограниченном пуле процессов.
+    Сообщение подтверждается только после завершения обработки задачи.
+    Исходник и результат передаются процессам через разделяемую память
+    (shared_buffers), без нее - через канал пула.
+    """
+
+    # Емкость сегмента результата относительно исходника; больший результат
+    # возвращается через канал пула
+    RESULT_RATIO = 2
+
+    def __init__(
+        self,
+        *args,
+        io_threads: int,
+        cpu_processes: int = None,
+        shared_buffers: SharedBufferPool = None,
+        **kwargs,
+    ):
+        """Инициализация сервиса"""
+        super().__init__(*args, **kwargs)
+        self._buffers = shared_buffers
+        self._cpu_processes = cpu_processes or os.cpu_count()
+        self._io_pool = ThreadPoolExecutor(io_threads, thread_name_prefix="task-io")
+        self._cpu_pool: ProcessPoolExecutor | None = None
+        self._cpu_pool_lock = threading.Lock()
+
+    def _get_cpu_pool(self) -> ProcessPoolExecutor:
+        with self._cpu_pool_lock:
+            if self._cpu_pool is None:
+                # spawn: fork процесса с потоками и открытыми соединениями небезопасен
+                self._cpu_pool = ProcessPoolExecutor(
+                    self._cpu_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._cpu_pool
+
+    def _reset_cpu_pool(self, broken_pool: ProcessPoolExecutor):
+        """Пересоздание пула после аварийного завершения дочернего процесса"""
+        with self._cpu_pool_lock:
+            if self._cpu_pool is broken_pool:
+                self._cpu_pool = None
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit_cpu(self, stages: dict, fn, *args):
+        """Выполнение функции в пуле процессов с ожиданием результата"""
+        pool = self._get_cpu_pool()
+        submitted = time.monotonic()
+        try:
+            result, started, finished = pool.submit(timed_call, fn, *args).result()
+        except BrokenProcessPool:
+            self._logger.critical("Аварийное завершение процесса обработки")
+            self._reset_cpu_pool(pool)
+            raise
+        stages["cpu_wait"] = started - submitted
+        stages["ipc"] = time.monotonic() - finished
+        return result
+
+    def _shared_leases(self, size: int):
+        """Сегменты исходника и результата, None - передача через канал пула"""
+        if not self._buffers:
+            return None
+        try:
+            source = self._buffers.acquire(size)
+        except OSError as e:
+            self._logger.warning("Нет места в разделяемой памяти", extra={"e": e})
+            return None
+        try:
+            return source, self._buffers.acquire(size * self.RESULT_RATIO)
+        except OSError as e:
+            source.release()
+            self._logger.warning("Нет места в разделяемой памяти", extra={"e": e})
+            return None
+
+    def _run_cpu(self, source, stages: dict, shared_fn, bytes_fn, *args) -> list:
+        """Обработка в пуле процессов, результаты - файлы в порядке функции.
+
+        В stages записываются копии данных изображения (copies) и объем,
+        прошедший через канал пула (ipc_bytes).
+        """
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        source.seek(0)
+        leases = self._shared_leases(size)
+        if leases is None:
+            results, child_stages = self._submit_cpu(
+                stages, bytes_fn, self._image_proc, source.read(), *args
+            )
+            stages.update(child_stages)
+            if isinstance(results, bytes):
+                results = [results]
+            # Чтение исходника и копии результатов в процессе пула
+            stages["copies"] = (1 + PICKLE_COPIES) * (1 + len(results))
+            stages["ipc_bytes"] = size + sum(len(result) for result in results)
+            return [io.BytesIO(result) for result in results]
+
+        source_lease, target_lease = leases
+        with source_lease, target_lease:
+            data = source_lease.write(source, size)
+            target = SharedSlice(target_lease.name, 0, target_lease.capacity)
+            results, child_stages = self._submit_cpu(
+                stages, shared_fn, self._image_proc, data, target, *args
+            )
+            stages.update(child_stages)
+            returned = [result for result in results if isinstance(result, bytes)]
+            stages["copies"] = 1 + len(results) + PICKLE_COPIES * len(returned)
+            stages["ipc_bytes"] = sum(len(result) for result in returned)
+            return [
+                (
+                    target_lease.reader(result)
+                    if isinstance(result, SharedSlice)
+                    else io.BytesIO(result)
+                )
+                for result in results
+            ]
+
+    def _transform(
+        self, source, operations: list, extension: str, stages: dict, output: dict
+    ):
+        """Декодирование, обработка и кодирование в пуле процессов"""
+        (result,) = self._run_cpu(
+            source,
+            stages,
+            process_image_shared,
+            process_image_bytes,
+            operations,
+            extension,
+            output,
+        )
+        return result
+
+    def _render(
+        self, source, scales: list, extension: str, stages: dict, output: dict
+    ) -> list:
+        """Набор копий в пуле процессов"""
+        return self._run_cpu(
+            source,
+            stages,
+            render_renditions_shared,
+            render_renditions_bytes,
+            scales,
+            extension,
+            output,
+        )
+
+    def _handle_message_async(
+        self,
+        message: TaskIdentMessageModel,
+        channel: BlockingChannel,
+        delivery_tag: int,
+    ):
+        """Обработка сообщения в потоке с последующим подтверждением"""
+        ClassesLoggerAdapter.TRACE_ID.set(message.trace_id)
+        ack = True
+        try:
+            super()._handle_message(message)
+        except Exception as e:
+            ack = False
+            self._logger.error(
+                "Ошибка обработки сообщения",
+                exc_info=True,
+                extra={"task_id": message.payload.task_id, "e": e},
+            )
+        finally:
+            self._rabbit.ack_threadsafe(channel, delivery_tag, ack)
+
+    def _handle_message(
+        self, message: TaskIdentMessageModel, channel=None, method=None, **_
+    ):
+        """Передача сообщения в пул потоков, подтверждение откладывается"""
+        self._io_pool.submit(
+            self._handle_message_async, message, channel, method.delivery_tag
+        )
+        return True
+
+    def run(self):
+        """Запуск прослушивания очереди брокера сообщений"""
+        try:
+            super().run()
+        finally:
+            self._io_pool.shutdown(wait=True)
+            if self._cpu_pool:
+                self._cpu_pool.shutdown(wait=True)
+            if self._buffers:
+                self._buffers.close()
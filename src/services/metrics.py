@@ -0,0 +1,27 @@
+"""Метрики конвейера обработки изображений"""
+
+from base_module.metrics import REGISTRY
+
+TASK_STAGE_SECONDS = REGISTRY.histogram(
+    "image_task_stage_seconds",
+    "Длительность этапов обработки задачи, секунды",
+    ["stage"],
+)
+TASK_BYTES = REGISTRY.counter(
+    "image_task_bytes_total", "Байты, скачанные и загруженные воркером", ["direction"]
+)
+TASK_PIXELS = REGISTRY.counter(
+    "image_task_pixels_total",
+    "Пиксели исходных и итоговых изображений",
+    ["image"],
+)
+TASKS = REGISTRY.counter(
+    "image_tasks_total",
+    "Завершенные задачи по результату (done, error, cached, reused)",
+    ["status"],
+)
+SOURCE_CACHE = REGISTRY.counter(
+    "image_source_cache_total",
+    "Обращения к локальному кэшу исходников (hit, miss)",
+    ["result"],
+)
@@ -0,0 +1,144 @@
+"""Отправка сообщений о задачах через таблицу outbox.
+
+API записывает сообщение в image_processing_task_outbox в той же транзакции,
+что и задачу, и не ждет брокер: после commit сообщение не потеряется, а без
+commit не будет отправлено. Воркер пересылает сообщения пачками
+(FOR UPDATE SKIP LOCKED) и удаляет их в транзакции выборки после отправки.
+Если commit после отправки не прошел, сообщение уйдет повторно: повтор
+безопасен, захват задачи воркером - условный UPDATE.
+"""
+
+import itertools
+import threading
+import typing as t
+from datetime import datetime
+
+import pika
+import sqlalchemy as sa
+from sqlalchemy.orm import Session as PGSession
+
+from base_module import sa_operator
+from base_module.exceptions import ModuleException
+from base_module.logger import ClassesLoggerAdapter
+from base_module.metrics import REGISTRY
+from base_module.rabbit import TaskIdentMessageModel
+from base_module.services.rabbit import RabbitService
+from models.orm_models import TaskOutbox
+from services.metrics import TASK_STAGE_SECONDS
+from services.pg_queue import PgNotifyListener, notify_new_tasks
+
+
+def add_outbox_messages(
+    pg: PGSession,
+    payloads: t.List[TaskIdentMessageModel.T],
+    notify_channel: str,
+    priorities: t.List[t.Optional[int]] = None,
+):
+    """Запись сообщений в текущей транзакции, отправка - после commit"""
+    if not payloads:
+        return
+    now = datetime.now()
+    trace_id = ClassesLoggerAdapter.TRACE_ID.get()
+    priorities = priorities or [None] * len(payloads)
+    pg.execute(
+        sa.insert(TaskOutbox),
+        [
+            {
+                "payload": payload.dump(),
+                "trace_id": trace_id,
+                "priority": priority,
+                "created_at": now,
+            }
+            for payload, priority in zip(payloads, priorities)
+        ],
+    )
+    notify_new_tasks(pg, notify_channel)
+
+
+class OutboxRelay:
+    """Пересылка сообщений из outbox в брокер"""
+
+    def __init__(
+        self,
+        pg_connection: PGSession,
+        rabbit: RabbitService,
+        notify_channel: str,
+        batch_size: int = 500,
+        poll_interval: float = 1,
+    ):
+        """."""
+        self._pg = pg_connection
+        self._rabbit = rabbit
+        self._notify_channel = notify_channel
+        self._batch_size = max(batch_size, 1)
+        self._poll_interval = poll_interval
+        self._logger = ClassesLoggerAdapter.create(self)
+
+    def relay_batch(self) -> int:
+        """Отправка одной пачки, число отправленных сообщений"""
+        with self._pg.begin():
+            rows = self._pg.execute(
+                sa.select(TaskOutbox)
+                .order_by(TaskOutbox.outbox_id)
+                .limit(self._batch_size)
+                .with_for_update(skip_locked=True)
+            ).scalars()
+            outbox = list(rows)
+            if not outbox:
+                return 0
+
+            # Приоритет общий для сообщений одной отправки: пачка делится по
+            # приоритету, первыми уходят более важные
+            by_priority = sorted(outbox, key=lambda row: -(row.priority or 0))
+            for priority, rows in itertools.groupby(
+                by_priority, key=lambda row: row.priority or 0
+            ):
+                messages = [
+                    TaskIdentMessageModel(
+                        payload=TaskIdentMessageModel.T.load(row.payload),
+                        trace_id=row.trace_id,
+                    )
+                    for row in rows
+                ]
+                if not self._rabbit.publish_many(
+                    messages, properties=pika.BasicProperties(priority=priority)
+                ):
+                    # Откат транзакции: сообщения остаются в outbox до следующей
+                    # попытки, уже отправленные части пачки уйдут повторно
+                    raise ModuleException("Сообщения outbox не отправлены", code=503)
+            self._pg.execute(
+                sa.delete(TaskOutbox).where(
+                    sa_operator.in_(
+                        TaskOutbox.outbox_id, [row.outbox_id for row in outbox]
+                    )
+                ),
+                execution_options={"synchronize_session": False},
+            )
+
+        now = datetime.now()
+        for row in outbox:
+            TASK_STAGE_SECONDS.observe(
+                max((now - row.created_at).total_seconds(), 0), stage="outbox"
+            )
+        REGISTRY.flush()
+        return len(outbox)
+
+    def run(self, stopped: threading.Event):
+        """Пересылка, пока не установлен stopped: полные пачки подряд, затем
+        ожидание уведомления не дольше poll_interval"""
+        listener = PgNotifyListener(self._pg.get_bind(), self._notify_channel)
+        try:
+            while not stopped.is_set():
+                try:
+                    relayed = self.relay_batch()
+                except Exception as e:
+                    self._logger.error(
+                        "Ошибка отправки сообщений outbox",
+                        exc_info=True,
+                        extra={"e": e},
+                    )
+                    relayed = 0
+                if relayed < self._batch_size:
+                    listener.wait(self._poll_interval)
+        finally:
+            listener.close()
@@ -0,0 +1,74 @@
+"""Очередь задач в Postgres без брокера.
+
+Готовые задачи - строки image_processing_task со статусом NEW. Создание
+задачи будит воркеры уведомлением NOTIFY в той же транзакции (оно доставляется
+только после commit), воркеры ждут его через LISTEN, а раз в poll_interval
+проверяют таблицу и без уведомления.
+"""
+
+import select
+import time
+
+import sqlalchemy as sa
+from psycopg2.extensions import quote_ident
+from sqlalchemy.orm import Session as PGSession
+
+from base_module.logger import ClassesLoggerAdapter
+
+
+def notify_new_tasks(pg: PGSession, channel: str):
+    """Уведомление воркеров о новых задачах при commit текущей транзакции"""
+    pg.execute(sa.select(sa.func.pg_notify(channel, "")))
+
+
+class PgNotifyListener:
+    """Отдельное соединение в режиме autocommit, слушающее канал уведомлений"""
+
+    def __init__(self, engine: sa.engine.Engine, channel: str):
+        """."""
+        self._engine = engine
+        self._channel = channel
+        self._connection = None
+        self._logger = ClassesLoggerAdapter.create(self)
+
+    def _connect(self):
+        raw = self._engine.raw_connection()
+        # Соединение не возвращается в пул: оно остается в режиме LISTEN
+        raw.detach()
+        connection = raw.driver_connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {quote_ident(self._channel, cursor)}")
+        self._logger.info("Ожидание уведомлений", extra={"channel": self._channel})
+        return connection
+
+    def wait(self, timeout: float) -> bool:
+        """Ожидание уведомления не дольше timeout, True - уведомление пришло"""
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            connection = self._connection
+            if not connection.notifies:
+                select.select([connection], [], [], timeout)
+                connection.poll()
+            notified = bool(connection.notifies)
+            connection.notifies.clear()
+            return notified
+        except Exception as e:
+            self._logger.error(
+                "Ошибка соединения уведомлений",
+                exc_info=True,
+                extra={"channel": self._channel, "e": e},
+            )
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        connection = self._connection
+        self._connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
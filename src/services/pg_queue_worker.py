@@ -0,0 +1,78 @@
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from services.pg_queue import PgNotifyListener
+from services.task_worker import TasksWorker, TaskTimings
+
+
+class PgQueueWorker(TasksWorker):
+    """Обработка задач прямо из таблицы Postgres, без брокера сообщений.
+
+    Воркер захватывает пачку готовых задач (FOR UPDATE SKIP LOCKED), пока они
+    есть, затем ждет уведомления о новых задачах. Задачи упавшего воркера
+    захватываются повторно после истечения аренды.
+    """
+
+    def __init__(
+        self,
+        *args,
+        notify_channel: str,
+        batch_size: int = 10,
+        poll_interval: float = 5,
+        io_threads: int = 1,
+        **kwargs,
+    ):
+        """Инициализация сервиса"""
+        super().__init__(*args, **kwargs)
+        self._batch_size = max(batch_size, 1)
+        self._poll_interval = poll_interval
+        self._io_threads = max(io_threads, 1)
+        self._listener = PgNotifyListener(self._pg.get_bind(), notify_channel)
+
+    def _claim_batch(self, timings: TaskTimings) -> list:
+        try:
+            with timings.stage("claim"):
+                return self._repository.claim_batch(self._batch_size)
+        except Exception as e:
+            self._logger.error(
+                "Ошибка получения задач из очереди", exc_info=True, extra={"e": e}
+            )
+            self._pg.rollback()
+            return []
+
+    def _on_shutdown_signal(self, signum, _frame):
+        """Корректная остановка: новые задачи не захватываются, текущие дорабатываются"""
+        self._logger.info("Получен сигнал остановки", extra={"signal": signum})
+        self._stopped.set()
+
+    def run(self):
+        """Запуск выборки задач из очереди Postgres"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_shutdown_signal)
+        self._start_metrics_server()
+
+        pool = ThreadPoolExecutor(self._io_threads, thread_name_prefix="task-io")
+        try:
+            while not self._stopped.is_set():
+                claim_timings = TaskTimings()
+                tasks = self._claim_batch(claim_timings)
+                if tasks:
+                    self._logger.info(
+                        "Получены задачи из очереди", extra={"count": len(tasks)}
+                    )
+                    list(
+                        pool.map(
+                            lambda task: self._process_task(
+                                task, timings=TaskTimings(claim=claim_timings.claim)
+                            ),
+                            tasks,
+                        )
+                    )
+                    continue
+                # Проверка без уведомления раз в poll_interval, на случай
+                # пропущенного NOTIFY и задач с истекшей арендой
+                self._listener.wait(self._poll_interval)
+        finally:
+            pool.shutdown(wait=True)
+            self._listener.close()
+            self._logger.info("Выборка задач из очереди остановлена")
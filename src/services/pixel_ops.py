@@ -0,0 +1,247 @@
+"""Попиксельные операции: яркость, контраст, гамма, нормализация каналов,
+оттенки серого и наложение прозрачного изображения на фон.
+
+Операции подряд выполняются цепочкой над одним буфером PixelBuffer.
+Преобразования значений каналов (яркость, контраст, гамма, нормализация)
+считаются в NumPy над таблицей на 256 значений по гистограммам и проходят
+по пикселям один раз. Сами пиксели остаются в памяти Pillow: проходы его
+циклами на C быстрее NumPy и не требуют копий изображения в массив и обратно
+(см. src/scripts/bench_pixel_ops.py).
+"""
+
+import dataclasses as dc
+from typing import Any, Callable, Optional
+
+import numpy as np
+from PIL import Image, ImageColor
+
+# Режимы, с которыми работают операции; прочие приводятся к ним
+PIXEL_MODES = ("L", "LA", "RGB", "RGBA")
+# Яркость по ITU-R 601-2 в 1/65536, как в Image.convert("L")
+LUMA_WEIGHTS = (19595, 38470, 7471)
+MAX_FACTOR = 10
+
+
+@dc.dataclass(frozen=True)
+class PixelOperation:
+    """Попиксельная операция в реестре"""
+
+    apply: Callable[["PixelBuffer", Any], None]
+    # Проверка значения из запроса: нормализованное значение или ValueError
+    parse: Callable[[Any], Any]
+    # Значение, при котором операция не меняет изображение
+    identity: Any = None
+
+
+PIXEL_OPERATIONS: dict[str, PixelOperation] = {}
+
+
+def pixel_operation(name: str, parse: Callable[[Any], Any], identity=None):
+    """Регистрация попиксельной операции под типом name"""
+
+    def register(apply):
+        PIXEL_OPERATIONS[name] = PixelOperation(apply, parse, identity)
+        return apply
+
+    return register
+
+
+def is_pixel_operation(operation: dict) -> bool:
+    return operation["type"] in PIXEL_OPERATIONS
+
+
+class PixelBuffer:
+    """Изображение для цепочки попиксельных операций.
+
+    Преобразования значений каналов цвета копятся в отложенной таблице и
+    применяются к пикселям одним проходом Image.point перед операцией,
+    которой нужны сами пиксели, или в конце цепочки.
+    """
+
+    def __init__(self, image: Image.Image):
+        """."""
+        self._source = image
+        if image.mode not in PIXEL_MODES:
+            image = image.convert(self._pixel_mode(image))
+        self.image = image
+        # Таблица (каналы цвета, 256) в float32, без округления между операциями
+        self._lut: Optional[np.ndarray] = None
+        self._histograms: Optional[np.ndarray] = None
+
+    @staticmethod
+    def _pixel_mode(image: Image.Image) -> str:
+        if image.mode in ("1", "I", "F") or image.mode.startswith("I;16"):
+            return "L"
+        return "RGBA" if image.has_transparency_data else "RGB"
+
+    @property
+    def alpha(self) -> bool:
+        return self.image.mode in ("LA", "RGBA")
+
+    @property
+    def color_channels(self) -> int:
+        return len(self.image.mode) - self.alpha
+
+    def lut(self) -> np.ndarray:
+        """Текущая таблица значений каналов цвета (каналы, 256)"""
+        if self._lut is None:
+            identity = np.arange(256, dtype=np.float32)
+            return np.tile(identity, (self.color_channels, 1))
+        return self._lut.copy()
+
+    def map_values(self, lut: np.ndarray):
+        """Отложенное преобразование значений каналов цвета.
+
+        Как и при 8-битном результате каждой операции, значения ограничены
+        0-255, но не округляются до применения таблицы к пикселям.
+        """
+        self._lut = np.clip(lut, 0, 255).astype(np.float32)
+
+    def histograms(self) -> np.ndarray:
+        """Гистограммы каналов цвета (каналы, 256) с учетом таблицы"""
+        if self._histograms is None:
+            histograms = np.array(self.image.histogram(), dtype=np.int64)
+            self._histograms = histograms.reshape(-1, 256)[: self.color_channels]
+        if self._lut is None:
+            return self._histograms
+        return np.stack(
+            [
+                np.bincount(values, weights=histogram, minlength=256)
+                for values, histogram in zip(self._lut8(), self._histograms)
+            ]
+        )
+
+    def _lut8(self) -> np.ndarray:
+        return np.rint(self._lut).astype(np.uint8)
+
+    def pixels(self) -> Image.Image:
+        """Изображение с примененной таблицей"""
+        if self._lut is not None:
+            lut = self._lut8()
+            if self.alpha:
+                lut = np.vstack([lut, np.arange(256, dtype=np.uint8)])
+            self._lut = None
+            self.replace(self.image.point(lut.ravel().tolist()))
+        return self.image
+
+    def replace(self, image: Image.Image):
+        """Результат прохода по пикселям, промежуточное изображение закрывается"""
+        if self.image is not self._source:
+            self.image.close()
+        self.image = image
+        self._histograms = None
+
+
+def apply_pixel_operations(image: Image.Image, operations: list) -> Image.Image:
+    """Цепочка попиксельных операций над одним буфером"""
+    buffer = PixelBuffer(image)
+    for operation in operations:
+        PIXEL_OPERATIONS[operation["type"]].apply(buffer, operation["value"])
+    return buffer.pixels()
+
+
+def _number(value) -> bool:
+    return not isinstance(value, bool) and isinstance(value, (int, float))
+
+
+def _factor(value):
+    if not _number(value) or not 0 <= value <= MAX_FACTOR:
+        raise ValueError(value)
+    return value
+
+
+def _gamma(value):
+    if not _number(value) or not 0 < value <= MAX_FACTOR:
+        raise ValueError(value)
+    return value
+
+
+def _flag(value):
+    if value is not True:
+        raise ValueError(value)
+    return value
+
+
+def _cutoff(value):
+    if value is True:
+        return 0
+    if not _number(value) or not 0 <= value < 50:
+        raise ValueError(value)
+    return value
+
+
+def _color(value) -> list:
+    if value is True:
+        return [255, 255, 255]
+    if isinstance(value, str):
+        return list(ImageColor.getrgb(value)[:3])
+    if (
+        isinstance(value, list)
+        and len(value) == 3
+        and all(isinstance(c, int) and not isinstance(c, bool) for c in value)
+        and all(0 <= c <= 255 for c in value)
+    ):
+        return value
+    raise ValueError(value)
+
+
+@pixel_operation("brightness", _factor, identity=1)
+def _brightness(buffer: PixelBuffer, factor):
+    """Яркость как ImageEnhance.Brightness: смешение с черным"""
+    buffer.map_values(buffer.lut() * factor)
+
+
+@pixel_operation("contrast", _factor, identity=1)
+def _contrast(buffer: PixelBuffer, factor):
+    """Контраст как ImageEnhance.Contrast: смешение со средней яркостью"""
+    histograms = buffer.histograms()
+    means = histograms @ np.arange(256) / histograms[0].sum()
+    if len(means) > 1:
+        means = means @ np.array(LUMA_WEIGHTS) / 65536
+    mean = int(float(np.sum(means)) + 0.5)
+    buffer.map_values(mean + (buffer.lut() - mean) * factor)
+
+
+@pixel_operation("gamma", _gamma, identity=1)
+def _gamma_correction(buffer: PixelBuffer, gamma):
+    """Гамма-коррекция 255 * (v / 255) ** (1 / gamma): больше 1 - светлее"""
+    buffer.map_values(255 * (buffer.lut() / 255) ** (1 / gamma))
+
+
+@pixel_operation("normalize", _cutoff)
+def _normalize(buffer: PixelBuffer, cutoff):
+    """Растяжение каждого канала цвета на 0-255, как ImageOps.autocontrast;
+    cutoff - процент самых темных и самых светлых пикселей вне диапазона"""
+    histograms = buffer.histograms()
+    lut = buffer.lut()
+    for channel, histogram in enumerate(histograms):
+        cumulative = np.cumsum(histogram)
+        cut = cumulative[-1] * cutoff / 100
+        low = np.searchsorted(cumulative, cut, side="right")
+        high = np.searchsorted(cumulative, cumulative[-1] - cut)
+        if high > low:
+            lut[channel] = (lut[channel] - low) * (255 / (high - low))
+    buffer.map_values(lut)
+
+
+@pixel_operation("grayscale", _flag)
+def _grayscale(buffer: PixelBuffer, _):
+    """Оттенки серого с весами ITU-R 601-2, альфа-канал сохраняется"""
+    if buffer.color_channels > 1:
+        buffer.replace(buffer.pixels().convert("LA" if buffer.alpha else "L"))
+
+
+@pixel_operation("flatten_alpha", _color)
+def _flatten_alpha(buffer: PixelBuffer, background: list):
+    """Наложение на сплошной фон (#rrggbb или [r, g, b], true - белый),
+    результат без альфа-канала"""
+    if not buffer.alpha:
+        return
+    image = buffer.pixels()
+    if buffer.color_channels == 1:
+        mode, color = "L", (int(np.dot(background, LUMA_WEIGHTS)) + 0x8000) >> 16
+    else:
+        mode, color = "RGB", tuple(background)
+    result = Image.new(mode, image.size, color)
+    result.paste(image, mask=image.getchannel("A"))
+    buffer.replace(result)
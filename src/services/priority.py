@@ -0,0 +1,92 @@
+"""Приоритет сообщения задачи в очереди брокера (x-max-priority).
+
+Стоимость задачи оценивается по метаданным файла в file-sync: мегапиксели
+исходника (по ширине и высоте, а без них - по размеру файла) умножаются на
+вес декодирования с кодированием и операций. Чем дешевле задача, тем выше
+приоритет, поэтому мелкие задачи не ждут в очереди за крупными. Поле
+priority запроса сдвигает оценку.
+"""
+
+import typing as t
+
+from services.pixel_ops import PIXEL_OPERATIONS
+
+# Примерное число пикселей на байт сжатого файла по расширению
+PIXELS_PER_BYTE = {"jpg": 8, "jpeg": 8, "webp": 10, "png": 1}
+DEFAULT_PIXELS_PER_BYTE = 4
+# Вес на пиксель исходника: декодирование и кодирование, затем операции
+DECODE_COST = 1
+OPERATION_COST = {"scale": 1, "pixel": 0.5, "rotate_right": 0.5, "rotate": 2}
+# Сдвиг приоритета полем priority запроса
+PRIORITY_BIAS = {"low": -2, "normal": 0, "high": 2}
+
+
+def _dimension(value) -> t.Optional[int]:
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        return None
+    return value
+
+
+def source_megapixels(file_info: t.Optional[dict]) -> t.Optional[float]:
+    """Мегапиксели исходника по метаданным, None - оценить нечем"""
+    file_info = file_info or {}
+    width = _dimension(file_info.get("width"))
+    height = _dimension(file_info.get("height"))
+    if width and height:
+        return width * height / 1e6
+    size = _dimension(file_info.get("size"))
+    if not size:
+        return None
+    extension = str(file_info.get("extension") or "").lower().lstrip(".")
+    return size * PIXELS_PER_BYTE.get(extension, DEFAULT_PIXELS_PER_BYTE) / 1e6
+
+
+def operation_cost(operation: dict) -> float:
+    if operation["type"] in PIXEL_OPERATIONS:
+        return OPERATION_COST["pixel"]
+    if operation["type"] == "rotate" and operation["value"] % 90 == 0:
+        return OPERATION_COST["rotate_right"]
+    return OPERATION_COST.get(operation["type"], 1)
+
+
+def estimate_cost(file_info: t.Optional[dict], operations: list) -> t.Optional[float]:
+    """Стоимость задачи в мегапикселях исходника с весами операций"""
+    megapixels = source_megapixels(file_info)
+    if megapixels is None:
+        return None
+    return megapixels * (DECODE_COST + sum(map(operation_cost, operations)))
+
+
+def parse_priority(request_data: dict) -> int:
+    """Сдвиг приоритета из поля priority (low | normal | high), иначе ValueError"""
+    value = request_data.get("priority", "normal")
+    if value not in PRIORITY_BIAS:
+        raise ValueError(value)
+    return PRIORITY_BIAS[value]
+
+
+class TaskPriority:
+    """Приоритет сообщения 0..max_priority по стоимости задачи и сдвигу запроса.
+
+    cost_levels - границы стоимости по возрастанию: задача не дороже первой
+    границы получает len(cost_levels), дороже последней - 0. Без оценки
+    (нет метаданных) - unknown_priority.
+    """
+
+    def __init__(
+        self, cost_levels: t.List[float], unknown_priority: int, max_priority: int
+    ):
+        """."""
+        self._cost_levels = sorted(cost_levels)
+        self._unknown_priority = unknown_priority
+        self._max_priority = max_priority
+
+    def __call__(
+        self, file_info: t.Optional[dict], operations: list, bias: int = 0
+    ) -> int:
+        cost = estimate_cost(file_info, operations)
+        if cost is None:
+            priority = self._unknown_priority
+        else:
+            priority = sum(cost <= level for level in self._cost_levels)
+        return min(max(priority + bias, 0), self._max_priority)
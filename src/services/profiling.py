@@ -0,0 +1,123 @@
+"""Профилирование отдельных задач воркера.
+
+Выбранная задача обрабатывается под cProfile (время по функциям текущего
+потока) и tracemalloc (пик и крупнейшие места выделения памяти). Результат
+сохраняется в каталог дампов: `<trace_id>_<task_id>.prof` для pstats/snakeviz
+и `<trace_id>_<task_id>.txt` с кратким отчетом.
+"""
+
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import typing as t
+from contextlib import contextmanager
+
+from base_module.logger import ClassesLoggerAdapter
+
+
+class TaskProfiler:
+    """Выбор задач для профилирования и запись дампов"""
+
+    def __init__(
+        self,
+        dump_dir: str,
+        sample_every: int = 0,
+        task_ids: t.Iterable[int] = (),
+        on_request: bool = True,
+        memory: bool = True,
+        top: int = 25,
+    ):
+        """."""
+        self._dump_dir = dump_dir
+        self._sample_every = sample_every
+        self._task_ids = set(task_ids or ())
+        self._on_request = on_request
+        self._memory = memory
+        self._top = top
+        self._counter = itertools.count(1)
+        # tracemalloc общий на процесс: память снимается для одной задачи за раз
+        self._memory_lock = threading.Lock()
+        self._logger = ClassesLoggerAdapter.create(self)
+        os.makedirs(dump_dir, exist_ok=True)
+
+    def wants(self, task_id: int, requested: bool = False) -> bool:
+        """Нужно ли профилировать задачу"""
+        if task_id in self._task_ids or (requested and self._on_request):
+            return True
+        return (
+            bool(self._sample_every) and next(self._counter) % self._sample_every == 0
+        )
+
+    @contextmanager
+    def _trace_memory(self):
+        if not self._memory or not self._memory_lock.acquire(blocking=False):
+            yield None
+            return
+        result = {}
+        try:
+            tracemalloc.start()
+            try:
+                yield result
+            finally:
+                result["peak"] = tracemalloc.get_traced_memory()[1]
+                result["snapshot"] = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+        finally:
+            self._memory_lock.release()
+
+    @contextmanager
+    def profile(self, task_id: int):
+        """Профилирование блока с записью дампа по его завершении"""
+        trace_id = ClassesLoggerAdapter.TRACE_ID.get()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        with self._trace_memory() as memory:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        try:
+            self._dump(
+                task_id, trace_id, profiler, memory, time.perf_counter() - started
+            )
+        except Exception as e:
+            self._logger.error(
+                "Ошибка записи профиля задачи",
+                exc_info=True,
+                extra={"task": task_id, "e": e},
+            )
+
+    def _dump(self, task_id, trace_id, profiler, memory, elapsed: float):
+        name = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', str(trace_id))}_{task_id}"
+        base_path = os.path.join(self._dump_dir, name)
+        profiler.dump_stats(f"{base_path}.prof")
+
+        report = io.StringIO()
+        report.write(f"task_id: {task_id}\ntrace_id: {trace_id}\n")
+        report.write(f"elapsed: {elapsed:.3f} s\n")
+        if memory:
+            report.write(f"memory peak: {memory['peak'] / 1024 / 1024:.1f} MiB\n")
+            report.write(f"\nTop {self._top} allocations:\n")
+            for stat in memory["snapshot"].statistics("lineno")[: self._top]:
+                report.write(f"{stat}\n")
+        report.write(f"\nTop {self._top} functions (cumulative):\n")
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self._top)
+        with open(f"{base_path}.txt", "w") as file:
+            file.write(report.getvalue())
+
+        self._logger.info(
+            "Профиль задачи сохранен",
+            extra={
+                "task": task_id,
+                "path": base_path,
+                "memory_peak": memory["peak"] if memory else None,
+            },
+        )
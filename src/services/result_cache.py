@@ -0,0 +1,229 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session as PGSession
+
+from base_module import sa_operator
+from base_module.logger import ClassesLoggerAdapter
+from config import ResultCacheConfig
+from models.orm_models import ProcessingResultCache
+from services.services import FileStorageData
+
+# Поля метаданных file-sync, однозначно определяющие содержимое файла
+CONTENT_HASH_FIELDS = ("sha256", "md5", "hash", "etag")
+# Поля, по которым изменение файла определяется косвенно
+VERSION_FIELDS = ("size", "updated_at", "modified_at", "created_at")
+
+
+def source_fingerprint(file_info: Optional[dict]) -> dict:
+    """Идентичность содержимого исходного файла по метаданным хранилища"""
+    file_info = file_info or {}
+    for field in CONTENT_HASH_FIELDS:
+        if file_info.get(field):
+            return {field: file_info[field]}
+    return {field: file_info.get(field) for field in VERSION_FIELDS}
+
+
+def operation_key(
+    file_id: int,
+    file_info: Optional[dict],
+    operations: list,
+    output: Optional[dict] = None,
+    **extra,
+):
+    """Ключ результата: источник + упорядоченный список операций + профиль кодирования"""
+    data = {
+        "file_id": file_id,
+        "source": source_fingerprint(file_info),
+        "operations": operations,
+        **extra,
+    }
+    # Без своего профиля ключ прежний, уже сохраненные результаты остаются в силе
+    if output:
+        data["output"] = output
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class ResultCache:
+    """Кэш результатов обработки в Postgres, общий для API и воркеров"""
+
+    _counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+    _counters_lock = threading.Lock()
+
+    def __init__(
+        self,
+        pg_connection: PGSession,
+        config: ResultCacheConfig,
+        file_request: FileStorageData = None,
+    ):
+        """."""
+        self._pg = pg_connection
+        self._config = config
+        self._f_req = file_request
+        self._logger = ClassesLoggerAdapter.create(self)
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.enabled
+
+    @classmethod
+    def _count(cls, name: str, value: int = 1):
+        with cls._counters_lock:
+            cls._counters[name] += value
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Счетчики попаданий и промахов текущего процесса"""
+        with cls._counters_lock:
+            counters = dict(cls._counters)
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / lookups if lookups else 0
+        return counters
+
+    def lookup(self, cache_key: str) -> Optional[int]:
+        """processed_file_id по ключу, попадание продлевает запись в LRU"""
+        if not self.enabled:
+            return
+
+        now = datetime.now()
+        processed_file_id = self._pg.execute(
+            sa.update(ProcessingResultCache)
+            .where(
+                sa.and_(
+                    sa_operator.eq(ProcessingResultCache.cache_key, cache_key),
+                    ProcessingResultCache.created_at
+                    > now - timedelta(seconds=self._config.ttl),
+                )
+            )
+            .values(last_hit_at=now, hits=ProcessingResultCache.hits + 1)
+            .returning(ProcessingResultCache.processed_file_id)
+        ).scalar()
+        self._pg.commit()
+
+        if processed_file_id and self._config.validate_hits and self._f_req:
+            if not self._f_req.file_info_data(processed_file_id):
+                self._invalidate(cache_key)
+                processed_file_id = None
+
+        self._count("hits" if processed_file_id else "misses")
+        if processed_file_id:
+            self._logger.info(
+                "Результат найден в кэше",
+                extra={"processed_file_id": processed_file_id, **self.stats()},
+            )
+        return processed_file_id
+
+    def lookup_many(self, cache_keys: Iterable[str]) -> Dict[str, int]:
+        """Пакетный вариант lookup одним запросом"""
+        cache_keys = list(set(cache_keys))
+        if not self.enabled or not cache_keys:
+            return {}
+
+        now = datetime.now()
+        rows = self._pg.execute(
+            sa.update(ProcessingResultCache)
+            .where(
+                sa.and_(
+                    sa_operator.in_(ProcessingResultCache.cache_key, cache_keys),
+                    ProcessingResultCache.created_at
+                    > now - timedelta(seconds=self._config.ttl),
+                )
+            )
+            .values(last_hit_at=now, hits=ProcessingResultCache.hits + 1)
+            .returning(
+                ProcessingResultCache.cache_key,
+                ProcessingResultCache.processed_file_id,
+            )
+        ).all()
+        self._pg.commit()
+
+        found = {key: processed_file_id for key, processed_file_id in rows}
+        if self._config.validate_hits and self._f_req:
+            for key, processed_file_id in list(found.items()):
+                if not self._f_req.file_info_data(processed_file_id):
+                    self._invalidate(key)
+                    found.pop(key)
+
+        self._count("hits", len(found))
+        self._count("misses", len(cache_keys) - len(found))
+        return found
+
+    def store(self, cache_key: str, file_id: int, processed_file_id: int):
+        """Сохранение результата обработки"""
+        if not self.enabled or not processed_file_id:
+            return
+
+        now = datetime.now()
+        statement = pg_insert(ProcessingResultCache).values(
+            cache_key=cache_key,
+            file_id=file_id,
+            processed_file_id=processed_file_id,
+            hits=0,
+            created_at=now,
+            last_hit_at=now,
+        )
+        self._pg.execute(
+            statement.on_conflict_do_update(
+                index_elements=[ProcessingResultCache.cache_key],
+                set_={
+                    "processed_file_id": statement.excluded.processed_file_id,
+                    "created_at": now,
+                    "last_hit_at": now,
+                },
+            )
+        )
+        self._pg.commit()
+
+        self._count("stores")
+        if self.stats()["stores"] % self._config.evict_every == 0:
+            self.evict()
+
+    def _invalidate(self, cache_key: str):
+        self._pg.execute(
+            sa.delete(ProcessingResultCache).where(
+                sa_operator.eq(ProcessingResultCache.cache_key, cache_key)
+            )
+        )
+        self._pg.commit()
+
+    def evict(self):
+        """Удаление устаревших записей и записей сверх max_entries (LRU)"""
+        expired = self._pg.execute(
+            sa.delete(ProcessingResultCache).where(
+                ProcessingResultCache.created_at
+                < datetime.now() - timedelta(seconds=self._config.ttl)
+            )
+        ).rowcount
+
+        overflow = (
+            self._pg.execute(
+                sa.select(sa.func.count()).select_from(ProcessingResultCache)
+            ).scalar()
+            - self._config.max_entries
+        )
+        evicted = 0
+        if overflow > 0:
+            oldest = (
+                sa.select(ProcessingResultCache.cache_key)
+                .order_by(sa.asc(ProcessingResultCache.last_hit_at))
+                .limit(overflow)
+            )
+            evicted = self._pg.execute(
+                sa.delete(ProcessingResultCache).where(
+                    sa_operator.in_(ProcessingResultCache.cache_key, oldest)
+                )
+            ).rowcount
+        self._pg.commit()
+
+        self._count("evictions", expired + evicted)
+        self._logger.info(
+            "Очистка кэша результатов",
+            extra={"expired": expired, "evicted": evicted},
+        )
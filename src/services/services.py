@@ -1,50 +1,800 @@
+import dataclasses as dc
+import io
+import itertools
 import json
-from typing import Optional
+import math
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import BinaryIO, Optional, Union
 
 import requests
-from PIL import Image
+from PIL import Image, JpegImagePlugin
+
+from base_module.exceptions import ModuleException
+from base_module.http import HttpClientConfig
+from base_module.metrics import DEPENDENCY_SECONDS
+from base_module.services.http import HttpClient
+from services.pixel_ops import (
+    PIXEL_OPERATIONS,
+    apply_pixel_operations,
+    is_pixel_operation,
+)
+from services.shared_buffers import SharedSlice, read_shared, store_shared
+
+FILE_STORAGE_URL = "http://file-sync:5001"
 
 
 class FileStorageData:
     """."""
 
+    def __init__(self, config: HttpClientConfig = None):
+        """."""
+        self._http = HttpClient(config or HttpClientConfig(url=FILE_STORAGE_URL))
+
+    @staticmethod
+    def _timer(operation: str):
+        return DEPENDENCY_SECONDS.time(dependency="file_sync", operation=operation)
+
     def file_info_data(self, file_id) -> Optional[dict]:
-        url = f"http://file-sync:5001/api/files/{file_id}"
-        response = requests.request("GET", url)
+        with self._timer("info"):
+            response = self._http.request("GET", f"/api/files/{file_id}")
         if response.status_code == 200:
             return json.loads(response.text)
 
     def file_download(self, file_id) -> requests.Response:
-        url = f"http://file-sync:5001/api/files/{file_id}/download"
-        response = requests.request("GET", url)
+        with self._timer("download"):
+            response = self._http.request("GET", f"/api/files/{file_id}/download")
         return response
 
-    def file_upload(self, file_name, file_path, upload_path=None) -> dict:
-        url = "http://file-sync:5001/api/upload"
+    def file_download_to(self, file_id, buffer: BinaryIO) -> int:
+        """Потоковое скачивание файла в буфер, возвращает размер в байтах"""
+        size = 0
+        with self._timer("download"), self._http.request(
+            "GET", f"/api/files/{file_id}/download", stream=True
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(self._http.config.chunk_size):
+                buffer.write(chunk)
+                size += len(chunk)
+        buffer.seek(0)
+        return size
 
+    def file_upload(
+        self,
+        file_name,
+        file: Union[str, BinaryIO],
+        upload_path=None,
+        content_type: str = "image/jpeg",
+    ) -> dict:
         payload = {"upload_path": upload_path}
-        files = [("", (file_name, open(file_path, "rb"), "image/jpeg"))]
-        response = requests.request("POST", url, data=payload, files=files)
+        if isinstance(file, str):
+            with open(file, "rb") as file_obj, self._timer("upload"):
+                response = self._http.upload(
+                    "/api/upload", payload, "", file_name, file_obj, content_type
+                )
+        else:
+            with self._timer("upload"):
+                response = self._http.upload(
+                    "/api/upload", payload, "", file_name, file, content_type
+                )
         return json.loads(response.text)
 
+    def stats(self) -> dict:
+        """Счетчики пула соединений с файловым хранилищем"""
+        return self._http.stats()
+
+
+def spooled_buffer(
+    max_size: int, temp_dir: str = None
+) -> tempfile.SpooledTemporaryFile:
+    """Буфер в памяти, который сбрасывается на диск при превышении max_size"""
+    return tempfile.SpooledTemporaryFile(max_size=max_size, mode="w+b", dir=temp_dir)
+
+
+def image_format(extension: str, default: str = "JPEG") -> str:
+    """Формат Pillow по расширению файла"""
+    extension = (extension or "").lower()
+    if extension and not extension.startswith("."):
+        extension = f".{extension}"
+    return Image.registered_extensions().get(extension, default)
+
+
+# Форматы результата: MIME-тип и расширение файла
+OUTPUT_FORMATS = {
+    "JPEG": ("image/jpeg", ".jpg"),
+    "PNG": ("image/png", ".png"),
+    "WEBP": ("image/webp", ".webp"),
+}
+# Параметры Image.save, которые понимает кодировщик формата
+FORMAT_OPTIONS = {
+    "JPEG": ("quality", "optimize", "progressive"),
+    "PNG": ("optimize", "compress_level"),
+    "WEBP": ("quality", "method"),
+}
+# Скорость кодирования против размера файла
+SPEED_PRESETS = {
+    "fast": {"optimize": False, "compress_level": 1, "method": 0},
+    "balanced": {"optimize": False, "compress_level": 6, "method": 4},
+    "small": {"optimize": True, "compress_level": 9, "method": 6},
+}
+# Режимы, которые JPEG сохраняет без преобразования
+JPEG_MODES = ("1", "L", "RGB", "CMYK")
+# Поворот на прямой угол перестановкой пикселей (против часовой, как Image.rotate)
+RIGHT_ANGLE_TRANSPOSE = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+# Поворот JPEG без перекодирования, если утилита есть в системе
+JPEGTRAN = shutil.which("jpegtran")
+JPEGTRAN_TIMEOUT = 60
+
+
+def normalize_angle(angle):
+    """Угол поворота в диапазоне [0, 360): 450 -> 90, -90 -> 270"""
+    return angle % 360
+
+
+def simplify_operations(operations: list) -> list:
+    """Операции без пустых (поворот на 0, масштаб 100%, яркость 1 и т.п.),
+    соседние повороты на прямой угол объединяются в один"""
+    result = []
+    for operation in operations:
+        pixel_operation = PIXEL_OPERATIONS.get(operation["type"])
+        if pixel_operation:
+            if operation["value"] != pixel_operation.identity:
+                result.append(operation)
+            continue
+        if operation["type"] == "rotate":
+            angle = normalize_angle(operation["value"])
+            previous = result[-1] if result else None
+            if (
+                angle % 90 == 0
+                and previous
+                and previous["type"] == "rotate"
+                and previous["value"] % 90 == 0
+            ):
+                angle = normalize_angle(previous["value"] + angle)
+                result.pop()
+            if angle == 0:
+                continue
+            operation = {"type": "rotate", "value": angle}
+        elif operation["type"] == "scale" and operation["value"] == 100:
+            continue
+        result.append(operation)
+    return result
+
+
+def operation_steps(operations: list):
+    """Операции по шагам: попиксельные подряд - одним шагом (списком)"""
+    for pixels, group in itertools.groupby(operations, key=is_pixel_operation):
+        if pixels:
+            yield list(group)
+        else:
+            yield from group
+
+
+def reuses_source(operations: list, output: dict = None) -> bool:
+    """Операции не меняют изображение, а формат не задан: результат - исходный файл"""
+    return not simplify_operations(operations) and not (output or {}).get("format")
+
+
+def output_format(source_format: str, extension: str, output: dict = None) -> str:
+    """Формат результата: из профиля кодирования, иначе формат исходника"""
+    target = (output or {}).get("format")
+    if target:
+        return target.upper()
+    return source_format or image_format(extension)
+
+
+def output_mime_type(format_name: str) -> str:
+    return OUTPUT_FORMATS.get(format_name, (Image.MIME.get(format_name),))[0]
+
+
+def output_extension(format_name: str, default: str) -> str:
+    if format_name in OUTPUT_FORMATS:
+        return OUTPUT_FORMATS[format_name][1]
+    return default
+
+
+def save_options(format_name: str, output: dict = None) -> dict:
+    """Параметры Image.save по профилю кодирования"""
+    output = output or {}
+    options = dict(SPEED_PRESETS.get(output.get("speed"), {}))
+    options.update({key: value for key, value in output.items() if value is not None})
+    allowed = FORMAT_OPTIONS.get(format_name, ())
+    return {key: value for key, value in options.items() if key in allowed}
+
+
+def save_image(
+    image: Image.Image, target, format_name: str, output: dict = None, **options
+):
+    """Сохранение в файл или буфер с параметрами профиля кодирования"""
+    if format_name == "JPEG" and image.mode not in JPEG_MODES:
+        image = image.convert("RGB")
+    options = {**options, **save_options(format_name, output)}
+    image.save(target, format=format_name, **options)
+
+
+def jpeg_keep_options(image: Image.Image) -> dict:
+    """Таблицы квантования и субдискретизация исходного JPEG: повторное
+    кодирование неизмененных пикселей почти не добавляет потерь"""
+    quantization = getattr(image, "quantization", None)
+    if image.format != "JPEG" or not quantization:
+        return {}
+    return {
+        "qtables": quantization,
+        "subsampling": JpegImagePlugin.get_sampling(image),
+    }
+
+
+def jpegtran_rotate(data: bytes, angle: int) -> Optional[bytes]:
+    """Поворот JPEG без перекодирования, None - утилиты нет или поворот
+    без потерь невозможен (размер не кратен блоку сжатия)"""
+    if not JPEGTRAN:
+        return None
+    # jpegtran поворачивает по часовой стрелке. Метаданные не копируются, как
+    # и при перекодировании Pillow: иначе тег Orientation и миниатюра EXIF
+    # остались бы от исходника и просмотрщик повернул бы изображение еще раз
+    command = [JPEGTRAN, "-rotate", str(360 - angle), "-perfect", "-copy", "none"]
+    try:
+        completed = subprocess.run(
+            command, input=data, capture_output=True, timeout=JPEGTRAN_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if completed.returncode != 0 or not completed.stdout:
+        return None
+    return completed.stdout
+
+
+def _right_angle_rotation(operations: list) -> Optional[int]:
+    if len(operations) == 1 and operations[0]["type"] == "rotate":
+        angle = operations[0]["value"]
+        if angle in RIGHT_ANGLE_TRANSPOSE:
+            return angle
+
+
+def transform_image(
+    image_proc: "ImageProcessor",
+    source: Union[str, BinaryIO],
+    operations: list,
+    extension: str,
+    target: Union[str, BinaryIO],
+    stages: dict = None,
+    output: dict = None,
+):
+    """Декодирование, применение операций и кодирование в target (путь или буфер).
+
+    В stages записываются длительности decode/transform/encode, число
+    пикселей исходного и итогового изображения, формат и размер результата.
+    Поворот JPEG на прямой угол без смены формата и качества выполняется без
+    перекодирования (jpegtran), иначе - с таблицами квантования исходника.
+    """
+    stages = {} if stages is None else stages
+    output = output or image_proc.output
+    operations = simplify_operations(operations)
+    image = Image.open(source)
+    format_name = output_format(image.format, extension, output)
+    stages["format"] = format_name
+
+    keep_options = {}
+    angle = _right_angle_rotation(operations)
+    if angle and image.format == format_name == "JPEG" and "quality" not in output:
+        if not output.get("progressive") and _write_lossless(
+            image, source, target, angle, stages
+        ):
+            return
+        keep_options = jpeg_keep_options(image)
+
+    changed_image = image_proc.image_pipeline(image, operations, stages)
+    started = time.perf_counter()
+    save_image(changed_image, target, format_name, output, **keep_options)
+    stages["encode"] = time.perf_counter() - started
+    stages["result_pixels"] = changed_image.width * changed_image.height
+    stages["result_size"] = changed_image.size
+
+
+def _write_lossless(image, source, target, angle: int, stages: dict) -> bool:
+    started = time.perf_counter()
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            data = file.read()
+    else:
+        source.seek(0)
+        data = source.read()
+    result = jpegtran_rotate(data, angle)
+    if result is None:
+        return False
+
+    if isinstance(target, str):
+        with open(target, "wb") as file:
+            file.write(result)
+    else:
+        target.write(result)
+    width, height = image.size
+    result_size = (height, width) if angle in (90, 270) else (width, height)
+    stages.update(
+        decode=0,
+        transform=time.perf_counter() - started,
+        encode=0,
+        source_pixels=width * height,
+        result_pixels=width * height,
+        result_size=result_size,
+        lossless=True,
+    )
+    return True
+
+
+def process_image(
+    image_proc: "ImageProcessor",
+    source: BinaryIO,
+    operations: list,
+    extension: str,
+    stages: dict = None,
+    output: dict = None,
+) -> io.BytesIO:
+    """Вариант transform_image с результатом в буфере в памяти"""
+    result = io.BytesIO()
+    transform_image(image_proc, source, operations, extension, result, stages, output)
+    result.seek(0)
+    return result
+
+
+def render_renditions(
+    image_proc: "ImageProcessor",
+    source: BinaryIO,
+    scales: list,
+    extension: str,
+    stages: dict = None,
+    output: dict = None,
+) -> list:
+    """Набор уменьшенных копий за одно декодирование, буферы в порядке scales"""
+    stages = {} if stages is None else stages
+    output = output or image_proc.output
+    image = Image.open(source)
+    format_name = output_format(image.format, extension, output)
+    stages["format"] = format_name
+    renditions = image_proc.renditions(image, scales, stages)
+
+    started = time.perf_counter()
+    results = []
+    for rendition in renditions:
+        result = io.BytesIO()
+        save_image(rendition, result, format_name, output)
+        result.seek(0)
+        results.append(result)
+    stages["encode"] = time.perf_counter() - started
+    stages["result_pixels"] = sum(r.width * r.height for r in renditions)
+    stages["result_size"] = renditions[0].size
+    stages["rendition_sizes"] = [rendition.size for rendition in renditions]
+    for rendition in renditions:
+        rendition.close()
+    return results
+
+
+def render_renditions_bytes(
+    image_proc: "ImageProcessor",
+    source: bytes,
+    scales: list,
+    extension: str,
+    output: dict = None,
+) -> tuple[list, dict]:
+    """Вариант render_renditions для пула процессов: байты и stages на выходе"""
+    stages = {}
+    results = render_renditions(
+        image_proc, io.BytesIO(source), scales, extension, stages, output
+    )
+    return [result.getvalue() for result in results], stages
+
+
+def process_image_bytes(
+    image_proc: "ImageProcessor",
+    source: bytes,
+    operations: list,
+    extension: str,
+    output: dict = None,
+) -> tuple[bytes, dict]:
+    """Вариант process_image для пула процессов: байты и stages на выходе"""
+    stages = {}
+    with process_image(
+        image_proc, io.BytesIO(source), operations, extension, stages, output
+    ) as result:
+        return result.getvalue(), stages
+
+
+def process_image_shared(
+    image_proc: "ImageProcessor",
+    source: SharedSlice,
+    target: SharedSlice,
+    operations: list,
+    extension: str,
+    output: dict = None,
+) -> tuple[list, dict]:
+    """Вариант process_image для пула процессов: исходник и результат в
+    разделяемой памяти, через канал пула передаются только их описания"""
+    stages = {}
+    with read_shared(source) as file, process_image(
+        image_proc, file, operations, extension, stages, output
+    ) as result:
+        return store_shared(target, [result]), stages
+
+
+def render_renditions_shared(
+    image_proc: "ImageProcessor",
+    source: SharedSlice,
+    target: SharedSlice,
+    scales: list,
+    extension: str,
+    output: dict = None,
+) -> tuple[list, dict]:
+    """Вариант render_renditions для пула процессов с разделяемой памятью"""
+    stages = {}
+    with read_shared(source) as file:
+        results = render_renditions(image_proc, file, scales, extension, stages, output)
+    try:
+        return store_shared(target, results), stages
+    finally:
+        for result in results:
+            result.close()
+
+
+@dc.dataclass(frozen=True)
+class ScalePolicy:
+    """Политика масштабирования: качество против скорости"""
+
+    # Уменьшение при декодировании JPEG (draft) и Image.reduce
+    fast_path: bool
+    # Запас кратности, оставляемый для финального фильтра (reducing_gap)
+    reducing_gap: Optional[float]
+    resample: Image.Resampling
+
+
+SCALE_POLICIES = {
+    "quality": ScalePolicy(
+        fast_path=False, reducing_gap=None, resample=Image.Resampling.LANCZOS
+    ),
+    "balanced": ScalePolicy(
+        fast_path=True, reducing_gap=3.0, resample=Image.Resampling.LANCZOS
+    ),
+    "fast": ScalePolicy(
+        fast_path=True, reducing_gap=2.0, resample=Image.Resampling.BILINEAR
+    ),
+}
+
+
+# Байт на пиксель во внутреннем представлении Pillow, для прочих режимов - 4
+PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+
+
+@dc.dataclass(frozen=True)
+class MemoryPlan:
+    """Оценка памяти обработки изображения и выбранный способ выполнения"""
+
+    peak_bytes: int
+    # Запрошенный размер уменьшения JPEG при декодировании, None - без draft
+    draft_size: Optional[tuple] = None
+    # Высота полос масштабирования, 0 - изображение целиком
+    strip_rows: int = 0
+    # Операции в порядке выполнения, None - в порядке запроса
+    operations: Optional[list] = None
+
 
 class ImageProcessor:
     """."""
 
-    def image_process(self, image, task_type, task_type_value):
+    STRIP_ROWS = 256
+
+    def __init__(
+        self,
+        scale_policy: str = "balanced",
+        fast_scale_max_percent=50,
+        memory_budget: int = 0,
+        output: dict = None,
+    ):
+        """."""
+        self._scale_policy = SCALE_POLICIES.get(
+            scale_policy, SCALE_POLICIES["balanced"]
+        )
+        self._fast_scale_max_percent = fast_scale_max_percent
+        # Память на обработку одного изображения, байт; 0 - без ограничения
+        self._memory_budget = memory_budget
+        # Профиль кодирования по умолчанию для задач без своего профиля
+        self.output = output or {}
+
+    def image_process(
+        self, image, task_type, task_type_value, base_size=None, strip_rows=0
+    ):
+        """Одна операция: геометрия - методами процессора, остальное - по
+        реестру попиксельных операций (services.pixel_ops)"""
         if task_type == "scale":
-            return self._image_scale(image, task_type_value)
+            return self._image_scale(image, task_type_value, base_size, strip_rows)
         elif task_type == "rotate":
             return self._image_rotate(image, task_type_value)
+        return apply_pixel_operations(
+            image, [{"type": task_type, "value": task_type_value}]
+        )
+
+    def image_pipeline(self, image, operations: list, stages: dict = None):
+        """Последовательное применение операций к одному декодированному изображению.
+
+        Декодирование выполняется явно до операций (с уменьшением JPEG под
+        первое масштабирование), чтобы его длительность учитывалась отдельно.
+        Промежуточные изображения, включая исходное, закрываются сразу после
+        следующей операции. Попиксельные операции подряд выполняются одной
+        цепочкой над общим буфером.
+        """
+        started = time.perf_counter()
+        source_size = image.size
+        operations = simplify_operations(operations)
+        plan = self.memory_plan(image, operations)
+        operations = plan.operations or operations
+        if plan.draft_size:
+            image.draft(image.mode, plan.draft_size)
+        image.load()
+        decoded = time.perf_counter()
+
+        for index, step in enumerate(operation_steps(operations)):
+            if isinstance(step, list):
+                result = apply_pixel_operations(image, step)
+            else:
+                result = self.image_process(
+                    image,
+                    step["type"],
+                    step["value"],
+                    # Первое масштабирование считается от размера до уменьшения draft
+                    source_size if index == 0 else None,
+                    plan.strip_rows,
+                )
+            if result is not image:
+                image.close()
+            image = result
+
+        if stages is not None:
+            stages["decode"] = decoded - started
+            stages["transform"] = time.perf_counter() - decoded
+            stages["source_pixels"] = source_size[0] * source_size[1]
+            stages["memory_estimate"] = plan.peak_bytes
+        return image
 
-    def _image_scale(self, image, scale_percent):
+    def renditions(self, image, scales: list, stages: dict = None) -> list:
+        """Уменьшенные копии каскадом: каждая следующая строится из предыдущей.
+
+        scales - проценты от исходного размера по убыванию. Исходник
+        декодируется один раз (JPEG - сразу уменьшенным под самую большую
+        копию), каждое следующее масштабирование обрабатывает меньше пикселей.
+        """
+        started = time.perf_counter()
+        source_size = image.size
+        plan = self.memory_plan(image, [{"type": "scale", "value": scales[0]}])
+        if plan.draft_size:
+            image.draft(image.mode, plan.draft_size)
+        image.load()
+        decoded = time.perf_counter()
+
+        results = []
+        previous = image
+        for scale in scales:
+            rendition = self._image_scale(previous, scale, source_size, plan.strip_rows)
+            if previous is image and rendition is not image:
+                image.close()
+            results.append(rendition)
+            previous = rendition
+
+        if stages is not None:
+            stages["decode"] = decoded - started
+            stages["transform"] = time.perf_counter() - decoded
+            stages["source_pixels"] = source_size[0] * source_size[1]
+            stages["memory_estimate"] = plan.peak_bytes
+        return results
+
+    def memory_plan(self, image, operations: list) -> MemoryPlan:
+        """Оценка пиковой памяти по заголовку изображения, до декодирования.
+
+        Оценка учитывает все операции. Если она выше бюджета, масштабирование
+        выполняется полосами, затем JPEG уменьшается при декодировании сразу до
+        итогового размера; уменьшение после поворотов и попиксельных операций
+        переносится в начало, чтобы они шли над меньшим изображением. Если не
+        помещается и так (в том числе при увеличении) - ModuleException с
+        кодом 413.
+        """
+        first = operations[0] if operations else None
+        scale = first["value"] if first and first["type"] == "scale" else None
+        draft_size = None
+        if scale is not None and self._fast_scale(scale):
+            draft_size = self._draft_size(self._scale_size(image.size, scale))
+
+        plan = MemoryPlan(self._estimate(image, operations, draft_size), draft_size)
+        if not self._memory_budget or plan.peak_bytes <= self._memory_budget:
+            return plan
+
+        candidates = [(None, draft_size)]
+        if scale is not None and image.format == "JPEG":
+            candidates.append((None, self._scale_size(image.size, scale)))
+        reordered = self._scale_first(operations)
+        if reordered:
+            scale = reordered[0]["value"]
+            new_size = self._scale_size(image.size, scale)
+            if self._fast_scale(scale):
+                candidates.append((reordered, self._draft_size(new_size)))
+            else:
+                candidates.append((reordered, None))
+            if image.format == "JPEG":
+                candidates.append((reordered, new_size))
+        for order, draft_size in candidates:
+            plan = MemoryPlan(
+                self._estimate(image, order or operations, draft_size, self.STRIP_ROWS),
+                draft_size,
+                self.STRIP_ROWS,
+                order,
+            )
+            if plan.peak_bytes <= self._memory_budget:
+                return plan
+
+        raise ModuleException(
+            "Изображение не помещается в бюджет памяти",
+            data={
+                "size": image.size,
+                "mode": image.mode,
+                "memory_estimate": plan.peak_bytes,
+                "memory_budget": self._memory_budget,
+            },
+            code=413,
+        )
+
+    def _estimate(
+        self, image, operations: list, draft_size=None, strip_rows: int = 0
+    ) -> int:
+        """Пиковая память операций: вход, выход и промежуточные буферы Pillow"""
+        pixel_bytes = PIXEL_BYTES.get(image.mode, 4)
+        size = self._decoded_size(image, draft_size)
+        peak = size[0] * size[1]
+        for index, operation in enumerate(operations):
+            temp = 0
+            if operation["type"] == "scale":
+                base_size = image.size if index == 0 else size
+                new_size = self._scale_size(base_size, operation["value"])
+                # Результат горизонтального прохода: по всей высоте или по полосе
+                rows = size[1]
+                if strip_rows and self._strips_supported(image.mode):
+                    rows = min(rows, math.ceil(strip_rows * size[1] / new_size[1]))
+                temp = new_size[0] * rows
+                if image.mode in ("LA", "RGBA"):
+                    # Копии с предумноженной альфой до и после масштабирования
+                    temp += size[0] * size[1] + new_size[0] * new_size[1]
+            elif is_pixel_operation(operation):
+                # Приведение режима и результат прохода по пикселям
+                new_size = size
+                temp = size[0] * size[1]
+            else:
+                new_size = self._rotated_size(size, operation["value"])
+            peak = max(peak, size[0] * size[1] + new_size[0] * new_size[1] + temp)
+            size = new_size
+        return peak * pixel_bytes
+
+    @staticmethod
+    def _scale_first(operations: list) -> Optional[list]:
+        """Операции с первым уменьшением в начале, если до него только повороты
+        и попиксельные операции: размер результата от порядка не зависит.
+        None - переставлять нечего"""
+        for index, operation in enumerate(operations):
+            if operation["type"] == "scale":
+                if not index or operation["value"] >= 100:
+                    return None
+                return [operation, *operations[:index], *operations[index + 1 :]]
+            if operation["type"] != "rotate" and not is_pixel_operation(operation):
+                return None
+        return None
+
+    @staticmethod
+    def _decoded_size(image, draft_size) -> tuple:
+        """Размер после декодирования с draft (JPEG уменьшается в 2/4/8 раз)"""
+        if not draft_size or image.format != "JPEG":
+            return image.size
+        width, height = image.size
+        scale = min(width // max(draft_size[0], 1), height // max(draft_size[1], 1))
+        for reduce in (8, 4, 2, 1):
+            if scale >= reduce:
+                break
+        return (width + reduce - 1) // reduce, (height + reduce - 1) // reduce
+
+    @staticmethod
+    def _rotated_size(size: tuple, angle) -> tuple:
+        """Размер после поворота с expand=True"""
+        angle = angle % 360
+        if angle in (0, 180):
+            return size
+        if angle in (90, 270):
+            return size[1], size[0]
+        radians = math.radians(angle)
+        cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+        return (
+            math.ceil(size[0] * cos + size[1] * sin),
+            math.ceil(size[0] * sin + size[1] * cos),
+        )
+
+    @staticmethod
+    def _strips_supported(mode: str) -> bool:
+        # Палитра и альфа масштабируются Pillow через преобразование всего изображения
+        return mode not in ("1", "P", "LA", "RGBA")
+
+    @staticmethod
+    def _scale_size(size: tuple, scale_percent) -> tuple:
+        return (
+            max(1, int(size[0] * (scale_percent / 100))),
+            max(1, int(size[1] * (scale_percent / 100))),
+        )
+
+    def _fast_scale(self, scale_percent) -> bool:
+        return (
+            self._scale_policy.fast_path
+            and scale_percent <= self._fast_scale_max_percent
+        )
+
+    def _draft_size(self, new_size: tuple) -> tuple:
+        # JPEG декодируется сразу в уменьшенном в 2/4/8 раз виде, но не меньше
+        # target * reducing_gap, чтобы финальному фильтру хватило данных
+        return tuple(int(side * self._scale_policy.reducing_gap) for side in new_size)
+
+    def _draft(self, image, new_size: tuple):
+        """Уменьшение JPEG при декодировании (до image.load)"""
+        image.draft(image.mode, self._draft_size(new_size))
+
+    def _image_scale(self, image, scale_percent, base_size=None, strip_rows=0):
         """Масштабирование изображения"""
-        new_width = int(image.size[0] * (scale_percent / 100))
-        new_height = int(image.size[1] * (scale_percent / 100))
-        new_size = (new_width, new_height)
-        resized_image = image.resize(new_size, Image.Resampling.LANCZOS)
-        return resized_image
+        new_size = self._scale_size(base_size or image.size, scale_percent)
+
+        policy = self._scale_policy
+        if not self._fast_scale(scale_percent):
+            return self._resize(image, new_size, Image.Resampling.LANCZOS, strip_rows)
+
+        self._draft(image, new_size)
+        # reducing_gap: сначала Image.reduce целым шагом, затем точный фильтр
+        return self._resize(
+            image, new_size, policy.resample, strip_rows, policy.reducing_gap
+        )
+
+    def _resize(self, image, new_size, resample, strip_rows=0, reducing_gap=None):
+        """Масштабирование целиком или полосами по strip_rows строк результата.
+
+        Полоса читает исходник через box, фильтр берет соседние строки за
+        границей полосы, поэтому швов нет, а промежуточный буфер Pillow
+        ограничен высотой полосы.
+        """
+        if (
+            not strip_rows
+            or strip_rows >= new_size[1]
+            or not self._strips_supported(image.mode)
+        ):
+            return image.resize(new_size, resample, reducing_gap=reducing_gap)
+
+        if reducing_gap:
+            # Целый шаг Image.reduce - один раз для всего изображения, как в
+            # Image.resize: по полосам сетка усреднения сдвигалась бы
+            factor = (
+                int(image.width / new_size[0] / reducing_gap) or 1,
+                int(image.height / new_size[1] / reducing_gap) or 1,
+            )
+            if factor != (1, 1):
+                image = image.reduce(factor)
+
+        result = Image.new(image.mode, new_size)
+        ratio = image.height / new_size[1]
+        for top in range(0, new_size[1], strip_rows):
+            bottom = min(top + strip_rows, new_size[1])
+            box = (0, top * ratio, image.width, bottom * ratio)
+            result.paste(
+                image.resize((new_size[0], bottom - top), resample, box), (0, top)
+            )
+        return result
 
     def _image_rotate(self, image, rotate_angle):
-        """Поворот изображения"""
-        return image.rotate(rotate_angle, expand=True)
+        """Поворот изображения, на прямой угол - без интерполяции"""
+        angle = normalize_angle(rotate_angle)
+        if angle == 0:
+            return image
+        if angle in RIGHT_ANGLE_TRANSPOSE:
+            return image.transpose(RIGHT_ANGLE_TRANSPOSE[angle])
+        return image.rotate(angle, expand=True)
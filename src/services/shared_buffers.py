@@ -0,0 +1,260 @@
+"""Передача данных изображений между потоками воркера и пулом процессов
+через разделяемую память.
+
+Сегменты создает, переиспользует и удаляет только процесс воркера
+(SharedBufferPool), процессы пула подключаются к ним по имени на время одного
+вызова: иначе удаленный воркером сегмент занимал бы /dev/shm, пока его
+держит процесс пула. Через канал пула передаются только описания SharedSlice.
+При остановке воркера сегменты удаляются (и при выходе процесса, atexit), при
+аварийном завершении - resource_tracker multiprocessing, с которым
+зарегистрирован каждый сегмент; при падении процесса пула сегменты остаются
+у воркера и возвращаются в пул.
+"""
+
+import atexit
+import dataclasses as dc
+import io
+import os
+import threading
+import time
+import typing as t
+from contextlib import suppress
+from multiprocessing.shared_memory import SharedMemory
+
+# Копии данных при передаче через канал пула: сериализация и чтение в процессе
+PICKLE_COPIES = 2
+
+
+@dc.dataclass(frozen=True)
+class SharedSlice:
+    """Данные в сегменте разделяемой памяти"""
+
+    name: str
+    offset: int
+    size: int
+
+
+class SharedReader(io.RawIOBase):
+    """Файл только для чтения поверх memoryview, без копирования данных"""
+
+    def __init__(self, view: memoryview, on_close: t.Callable[[], None] = None):
+        """."""
+        self._view = view
+        self._position = 0
+        self._on_close = on_close
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self._view) - self._position)
+        buffer[:size] = self._view[self._position : self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position}
+        self._position = max(0, base.get(whence, len(self._view)) + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def getbuffer(self) -> memoryview:
+        return self._view
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._on_close:
+                self._on_close()
+        super().close()
+
+
+class SharedLease:
+    """Сегмент, выданный задаче; возвращается в пул, когда закрыты все
+    читатели результата и завершен блок with"""
+
+    def __init__(self, pool: "SharedBufferPool", segment: SharedMemory):
+        """."""
+        self.segment = segment
+        self._pool = pool
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.segment.name
+
+    @property
+    def capacity(self) -> int:
+        return self.segment.size
+
+    def write(self, source: t.BinaryIO, size: int) -> SharedSlice:
+        """Копирование size байт из файла в начало сегмента"""
+        view = self.segment.buf
+        position = 0
+        while position < size:
+            chunk = source.read(min(size - position, self._pool.CHUNK_SIZE))
+            if not chunk:
+                break
+            view[position : position + len(chunk)] = chunk
+            position += len(chunk)
+        return SharedSlice(self.name, 0, position)
+
+    def reader(self, data: SharedSlice) -> SharedReader:
+        """Читатель данных сегмента; сегмент не вернется в пул до его закрытия"""
+        with self._lock:
+            self._refs += 1
+        view = self.segment.buf[data.offset : data.offset + data.size]
+        return SharedReader(view, self.release)
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs:
+                return
+        self._pool.release(self.segment)
+
+    def __enter__(self) -> "SharedLease":
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+class SharedBufferPool:
+    """Сегменты разделяемой памяти процесса воркера.
+
+    Размер сегмента округляется вверх до степени двойки, освобожденные
+    сегменты переиспользуются, в простое их не больше max_idle_bytes.
+    Память сегмента резервируется при создании: при нехватке места в
+    /dev/shm acquire сразу бросает OSError, а не SIGBUS при записи.
+    """
+
+    MIN_SEGMENT = 1 << 20
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, max_idle_bytes: int = 256 << 20):
+        """."""
+        self._max_idle_bytes = max_idle_bytes
+        self._idle: t.Dict[int, t.List[SharedMemory]] = {}
+        self._idle_bytes = 0
+        self._leased: t.Dict[str, SharedMemory] = {}
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "reused": 0, "unlinked": 0}
+        atexit.register(self.close)
+
+    def _segment_size(self, size: int) -> int:
+        return max(self.MIN_SEGMENT, 1 << max(size - 1, 0).bit_length())
+
+    def acquire(self, size: int) -> SharedLease:
+        """Сегмент не меньше size байт"""
+        segment_size = self._segment_size(size)
+        with self._lock:
+            idle = self._idle.get(segment_size)
+            segment = idle.pop() if idle else None
+            if segment:
+                self._idle_bytes -= segment_size
+                self.stats["reused"] += 1
+        if segment is None:
+            segment = self._create(segment_size)
+        with self._lock:
+            self._leased[segment.name] = segment
+        return SharedLease(self, segment)
+
+    def _create(self, size: int) -> SharedMemory:
+        segment = SharedMemory(create=True, size=size)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                # Дескриптор сегмента доступен только как _fd
+                os.posix_fallocate(segment._fd, 0, size)
+        except OSError:
+            self._unlink(segment)
+            raise
+        with self._lock:
+            self.stats["created"] += 1
+        return segment
+
+    def release(self, segment: SharedMemory):
+        """Возврат сегмента в пул или удаление сверх лимита простоя"""
+        with self._lock:
+            self._leased.pop(segment.name, None)
+            keep = self._idle_bytes + segment.size <= self._max_idle_bytes
+            if keep:
+                self._idle.setdefault(segment.size, []).append(segment)
+                self._idle_bytes += segment.size
+        if not keep:
+            self._unlink(segment)
+
+    def _unlink(self, segment: SharedMemory):
+        try:
+            segment.close()
+        except BufferError:
+            # Остались ссылки на память сегмента: закроется при сборке мусора
+            pass
+        segment.unlink()
+        with self._lock:
+            self.stats["unlinked"] += 1
+
+    def close(self):
+        """Удаление всех сегментов, в том числе еще выданных; повторный вызов
+        ничего не делает"""
+        with self._lock:
+            segments = [s for idle in self._idle.values() for s in idle]
+            segments += list(self._leased.values())
+            self._idle.clear()
+            self._leased.clear()
+            self._idle_bytes = 0
+        for segment in segments:
+            self._unlink(segment)
+
+
+def _detach(segment: SharedMemory):
+    # Остались ссылки на память сегмента: отключится при сборке мусора
+    with suppress(BufferError):
+        segment.close()
+
+
+def read_shared(data: SharedSlice) -> SharedReader:
+    """Читатель данных сегмента в процессе пула, закрытие отключает сегмент"""
+    segment = SharedMemory(name=data.name)
+    view = segment.buf[data.offset : data.offset + data.size]
+    return SharedReader(view, lambda: _detach(segment))
+
+
+def store_shared(
+    target: SharedSlice, results: t.List[io.BytesIO]
+) -> t.List[t.Union[SharedSlice, bytes]]:
+    """Запись результатов подряд в сегмент target (size - емкость).
+
+    Если результаты не помещаются, возвращаются байтами и передаются через
+    канал пула.
+    """
+    sizes = [result.getbuffer().nbytes for result in results]
+    if sum(sizes) > target.size:
+        return [result.getvalue() for result in results]
+
+    segment = SharedMemory(name=target.name)
+    stored = []
+    offset = target.offset
+    try:
+        for result, size in zip(results, sizes):
+            with result.getbuffer() as data:
+                segment.buf[offset : offset + size] = data
+            stored.append(SharedSlice(target.name, offset, size))
+            offset += size
+    finally:
+        _detach(segment)
+    return stored
+
+
+def timed_call(fn: t.Callable, *args):
+    """Вызов в процессе пула с отметками начала и конца (time.monotonic
+    общее для процессов): по ним воркер отделяет ожидание и передачу от работы"""
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic()
@@ -0,0 +1,195 @@
+"""Локальный кэш исходных файлов хранилища на диске.
+
+Запись - файл <file_id>-<отпечаток метаданных file-sync>: у измененного в
+хранилище файла другой отпечаток, и прежняя запись удаляется. Файл
+скачивается во временный и переименовывается, поэтому в кэше видны только
+полные записи. Одну запись скачивает один поток одного процесса (блокировка
+flock на файл с именем записи), остальные ждут и читают готовую запись;
+скачивание других записей блокировка не задерживает. Записи читаются через
+mmap: вытесненная запись остается доступной задачам, уже открывшим ее.
+"""
+
+import dataclasses as dc
+import fcntl
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import time
+import typing as t
+from contextlib import contextmanager, suppress
+
+from services.result_cache import source_fingerprint
+
+TEMP_PREFIX = ".tmp-"
+# Временные файлы старше этого (секунды) остались от упавших процессов
+TEMP_MAX_AGE = 3600
+
+
+@dc.dataclass
+class CachedSource:
+    """Исходник из кэша"""
+
+    data: t.Union[mmap.mmap, io.BytesIO]
+    size: int
+    # False - файл скачан этой задачей
+    hit: bool
+
+
+class SourceCache:
+    """Кэш исходных файлов с вытеснением давно не использованных (LRU по
+    времени изменения файла) сверх max_bytes"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        """."""
+        self._directory = directory
+        self._locks_dir = os.path.join(directory, ".locks")
+        self._max_bytes = max_bytes
+        os.makedirs(self._locks_dir, exist_ok=True)
+
+    @staticmethod
+    def entry_name(file_id: int, file_info: t.Optional[dict]) -> t.Optional[str]:
+        """Имя записи, None - по метаданным нельзя проверить актуальность"""
+        fingerprint = source_fingerprint(file_info)
+        if not any(fingerprint.values()):
+            return None
+        digest = hashlib.sha256(
+            json.dumps(fingerprint, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return f"{file_id}-{digest[:16]}"
+
+    @contextmanager
+    def open(
+        self,
+        file_id: int,
+        file_info: t.Optional[dict],
+        download: t.Callable[[t.BinaryIO], int],
+    ) -> t.Iterator[t.Optional[CachedSource]]:
+        """Исходник из кэша; при промахе download скачивает файл в переданный
+        буфер. None - файл не кэшируется"""
+        name = self.entry_name(file_id, file_info)
+        if name is None:
+            yield None
+            return
+
+        path = os.path.join(self._directory, name)
+        expected_size = (file_info or {}).get("size")
+        hit = True
+        file = self._open_entry(path, expected_size)
+        if file is None:
+            with self._lock(name):
+                # Пока ждали блокировку, файл мог скачать другой поток или процесс
+                file = self._open_entry(path, expected_size)
+                if file is None:
+                    hit = False
+                    file = self._store(file_id, path, download)
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if not size:
+                yield CachedSource(io.BytesIO(), size, hit)
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield CachedSource(data, size, hit)
+
+    @staticmethod
+    def _open_entry(path: str, expected_size) -> t.Optional[t.BinaryIO]:
+        """Открытая запись, None - записи нет или размер не совпадает с
+        метаданными хранилища"""
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        size = os.fstat(file.fileno()).st_size
+        if isinstance(expected_size, int) and size != expected_size:
+            file.close()
+            return None
+        # Время изменения - время последнего использования для вытеснения
+        with suppress(OSError):
+            os.utime(path)
+        return file
+
+    @contextmanager
+    def _lock(self, name: str):
+        """Блокировка скачивания записи. Файл блокировки удаляется после
+        скачивания, поэтому захваченная блокировка действительна, только если
+        файл по пути остался тем же"""
+        lock_path = os.path.join(self._locks_dir, name)
+        while True:
+            lock = open(lock_path, "ab")
+            try:
+                # flock открытых отдельно файлов исключает и потоки одного процесса
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(lock_path)
+                except FileNotFoundError:
+                    current = None
+                if current and os.path.samestat(current, os.fstat(lock.fileno())):
+                    try:
+                        yield
+                    finally:
+                        # Ждущие запись найдут ее готовой или повторят блокировку
+                        with suppress(FileNotFoundError):
+                            os.unlink(lock_path)
+                    return
+            finally:
+                lock.close()
+
+    def _store(
+        self, file_id: int, path: str, download: t.Callable[[t.BinaryIO], int]
+    ) -> t.BinaryIO:
+        """Скачивание во временный файл и атомарная замена записи"""
+        with tempfile.NamedTemporaryFile(
+            dir=self._directory, prefix=TEMP_PREFIX, delete=False
+        ) as temp:
+            try:
+                download(temp)
+                temp.flush()
+                # Открытие до переименования: запись могут сразу вытеснить
+                file = open(temp.name, "rb")
+                os.replace(temp.name, path)
+            except BaseException:
+                with suppress(OSError):
+                    os.unlink(temp.name)
+                raise
+        self._evict(file_id, path)
+        return file
+
+    def _evict(self, file_id: int, keep: str):
+        """Удаление прежних версий файла, брошенных временных файлов и давно
+        не использованных записей сверх max_bytes"""
+        now = time.time()
+        prefix = f"{file_id}-"
+        entries = []
+        total = 0
+        with os.scandir(self._directory) as scan:
+            for entry in scan:
+                if not entry.is_file(follow_symlinks=False) or entry.path == keep:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(TEMP_PREFIX):
+                    if now - stat.st_mtime > TEMP_MAX_AGE:
+                        self._discard(entry.path)
+                elif entry.name.startswith(prefix):
+                    self._discard(entry.path)
+                else:
+                    total += stat.st_size
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        with suppress(OSError):
+            total += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            self._discard(path)
+            total -= size
+
+    @staticmethod
+    def _discard(path: str):
+        with suppress(FileNotFoundError):
+            os.unlink(path)
@@ -0,0 +1,233 @@
+"""Переходы статуса задачи одним условным UPDATE ... RETURNING.
+
+Захват задачи выдает аренду (lease_owner, leased_at): задачу в работе может
+захватить другой воркер, только если аренда устарела. Завершить задачу может
+только владелец аренды, поэтому результат воркера, у которого задачу уже
+перехватили, не перезапишет статус.
+"""
+
+import os
+import socket
+import typing as t
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session as PGSession
+
+from base_module import sa_operator
+from models.orm_models import ImageProcessingTask, TaskStatus
+from services.coalescing import IN_FLIGHT_STATUSES, lock_operation
+
+TASK_COLUMNS = list(ImageProcessingTask.__table__.c)
+
+
+class TaskRepository:
+    """Захват и завершение задач воркером"""
+
+    def __init__(
+        self, pg_connection: PGSession, owner: str = None, lease_timeout: int = 600
+    ):
+        """."""
+        self._pg = pg_connection
+        self._owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._lease_timeout = timedelta(seconds=lease_timeout)
+
+    @property
+    def owner(self) -> str:
+        return self._owner
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция сессии потока. После ошибки БД сессия сбрасывается:
+        иначе она остается в прерванной транзакции и все следующие запросы
+        потока тоже завершаются ошибкой"""
+        try:
+            with self._pg.begin():
+                yield
+        except SQLAlchemyError:
+            self._pg.rollback()
+            raise
+
+    def _returning(self, statement) -> t.Optional[ImageProcessingTask]:
+        row = self._pg.execute(
+            statement.returning(*TASK_COLUMNS),
+            execution_options={"synchronize_session": False},
+        ).first()
+        return ImageProcessingTask.load(dict(row._mapping)) if row else None
+
+    def _claimable(self, now: datetime):
+        """Новая задача или задача в работе без действующей аренды"""
+        return sa.or_(
+            sa_operator.eq(ImageProcessingTask.status, TaskStatus.NEW),
+            sa.and_(
+                sa_operator.eq(ImageProcessingTask.status, TaskStatus.PROCESSING),
+                # Без аренды - ручное восстановление или
+                # задача, возвращенная reclaim_stale
+                sa.or_(
+                    ImageProcessingTask.lease_owner.is_(None),
+                    ImageProcessingTask.leased_at.is_(None),
+                    ImageProcessingTask.leased_at < now - self._lease_timeout,
+                ),
+            ),
+        )
+
+    def _lease_values(self, now: datetime) -> dict:
+        return dict(
+            status=TaskStatus.PROCESSING,
+            lease_owner=self._owner,
+            leased_at=now,
+            updated_at=now,
+        )
+
+    def claim(self, task_id: int) -> t.Optional[ImageProcessingTask]:
+        """Захват новой задачи или задачи с устаревшей (снятой) арендой"""
+        now = datetime.now()
+        with self._transaction():
+            return self._returning(
+                sa.update(ImageProcessingTask)
+                .where(
+                    sa.and_(
+                        sa_operator.eq(ImageProcessingTask.task_id, task_id),
+                        self._claimable(now),
+                    )
+                )
+                .values(**self._lease_values(now))
+            )
+
+    def claim_batch(self, limit: int) -> t.List[ImageProcessingTask]:
+        """Захват до limit готовых задач в порядке создания.
+
+        Строки, уже заблокированные другим воркером, пропускаются
+        (FOR UPDATE SKIP LOCKED), поэтому воркеры не ждут друг друга и не
+        получают одну задачу дважды. Ведомые задачи не захватываются.
+        """
+        now = datetime.now()
+        ready = (
+            sa.select(ImageProcessingTask.task_id)
+            .where(
+                sa.and_(
+                    self._claimable(now),
+                    ImageProcessingTask.leader_task_id.is_(None),
+                )
+            )
+            .order_by(ImageProcessingTask.created_at, ImageProcessingTask.task_id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        with self._transaction():
+            rows = self._pg.execute(
+                sa.update(ImageProcessingTask)
+                .where(sa_operator.in_(ImageProcessingTask.task_id, ready))
+                .values(**self._lease_values(now))
+                .returning(*TASK_COLUMNS),
+                execution_options={"synchronize_session": False},
+            )
+            tasks = [ImageProcessingTask.load(dict(row._mapping)) for row in rows]
+        return sorted(tasks, key=lambda task: (task.created_at, task.task_id))
+
+    def finish(
+        self,
+        task: ImageProcessingTask,
+        status: TaskStatus,
+        processed_file_id: int = 0,
+        result_meta: dict = None,
+        processed_file_ids: t.List[int] = None,
+    ) -> t.Tuple[t.Optional[ImageProcessingTask], int]:
+        """Завершение задачи владельцем аренды и число ведомых задач.
+
+        Ведомые задачи получают тот же результат в том же запросе. Блокировка
+        ключа операции берется отдельным запросом до него: иначе снимок данных
+        запроса может не увидеть ведомую задачу, созданную перед блокировкой.
+        """
+        now = datetime.now()
+        done = (
+            sa.update(ImageProcessingTask)
+            .where(
+                sa.and_(
+                    sa_operator.eq(ImageProcessingTask.task_id, task.task_id),
+                    sa_operator.eq(ImageProcessingTask.status, TaskStatus.PROCESSING),
+                    sa_operator.eq(ImageProcessingTask.lease_owner, self._owner),
+                )
+            )
+            .values(
+                status=status,
+                processed_file_id=processed_file_id,
+                lease_owner=None,
+                updated_at=now,
+            )
+        )
+        if result_meta is not None:
+            done = done.values(result_meta=result_meta)
+        if processed_file_ids is not None:
+            done = done.values(processed_file_ids=processed_file_ids)
+
+        with self._transaction():
+            if not task.operation_key:
+                return self._returning(done), 0
+
+            lock_operation(self._pg, task.operation_key)
+            done = done.returning(*TASK_COLUMNS).cte("done")
+            released = (
+                sa.update(ImageProcessingTask)
+                .where(
+                    sa.and_(
+                        sa_operator.eq(
+                            ImageProcessingTask.leader_task_id, done.c.task_id
+                        ),
+                        sa_operator.in_(ImageProcessingTask.status, IN_FLIGHT_STATUSES),
+                    )
+                )
+                .values(
+                    status=done.c.status,
+                    processed_file_id=done.c.processed_file_id,
+                    result_meta=done.c.result_meta,
+                    processed_file_ids=done.c.processed_file_ids,
+                    updated_at=now,
+                )
+                .returning(ImageProcessingTask.task_id)
+                .cte("released")
+            )
+            row = self._pg.execute(
+                sa.select(
+                    done,
+                    sa.select(sa.func.count())
+                    .select_from(released)
+                    .scalar_subquery()
+                    .label("followers"),
+                )
+            ).first()
+        if not row:
+            return None, 0
+        return ImageProcessingTask.load(dict(row._mapping)), row.followers
+
+    def reclaim_stale(self, limit: int = 100) -> t.List[int]:
+        """Снятие устаревших аренд, задачи нужно отправить в очередь заново.
+
+        Аренда продлевается без владельца, поэтому задачу можно захватить
+        сразу, а повторно она вернется сюда не раньше чем через lease_timeout.
+        """
+        now = datetime.now()
+        stale = (
+            sa.select(ImageProcessingTask.task_id)
+            .where(
+                sa.and_(
+                    sa_operator.eq(ImageProcessingTask.status, TaskStatus.PROCESSING),
+                    ImageProcessingTask.leased_at < now - self._lease_timeout,
+                )
+            )
+            .order_by(ImageProcessingTask.leased_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        with self._transaction():
+            return list(
+                self._pg.execute(
+                    sa.update(ImageProcessingTask)
+                    .where(sa_operator.in_(ImageProcessingTask.task_id, stale))
+                    .values(lease_owner=None, leased_at=now, updated_at=now)
+                    .returning(ImageProcessingTask.task_id),
+                    execution_options={"synchronize_session": False},
+                ).scalars()
+            )
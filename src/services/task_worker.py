@@ -1,19 +1,107 @@
+import dataclasses as dc
+import io
 import os
+import resource
 import shutil
-from datetime import datetime
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
-import sqlalchemy as sa
-from PIL import Image
 from sqlalchemy.orm import Session as PGSession
 
-from base_module import sa_operator
 from base_module.exceptions import ModuleException
 from base_module.logger import ClassesLoggerAdapter
+from base_module.metrics import REGISTRY, start_http_server
+from base_module.models import Model
 from base_module.mule import BaseMule
 from base_module.rabbit import TaskIdentMessageModel
 from base_module.services.rabbit import RabbitService
-from models.orm_models import ImageProcessingTask, TaskStatus
-from services.services import FileStorageData, ImageProcessor
+from config import ProcessingConfig
+from models.orm_models import ImageProcessingTask, TaskStatus, TaskType
+from services.metrics import (
+    SOURCE_CACHE,
+    TASK_BYTES,
+    TASK_PIXELS,
+    TASK_STAGE_SECONDS,
+    TASKS,
+)
+from services.outbox import OutboxRelay
+from services.profiling import TaskProfiler
+from services.result_cache import ResultCache, operation_key
+from services.services import (
+    FileStorageData,
+    ImageProcessor,
+    output_extension,
+    output_mime_type,
+    process_image,
+    render_renditions,
+    reuses_source,
+    spooled_buffer,
+    transform_image,
+)
+from services.source_cache import SourceCache
+from services.task_repository import TaskRepository
+
+
+@dc.dataclass
+class TaskIOStats(Model):
+    """Учет ввода-вывода и памяти по задаче"""
+
+    downloaded_bytes: int = dc.field(default=0)
+    uploaded_bytes: int = dc.field(default=0)
+    disk_written_bytes: int = dc.field(default=0)
+    disk_read_bytes: int = dc.field(default=0)
+    buffered_bytes: int = dc.field(default=0)
+    spilled: bool = dc.field(default=False)
+    peak_rss_kb: int = dc.field(default=0)
+    # Полные копии данных изображения при передаче в пул процессов и обратно
+    copies: int = dc.field(default=0)
+    # Данные изображения, прошедшие через канал пула процессов
+    ipc_bytes: int = dc.field(default=0)
+    # hit - исходник из локального кэша, miss - скачан в кэш, пусто - без кэша
+    source_cache: str = dc.field(default="")
+
+
+@dc.dataclass
+class TaskTimings(Model):
+    """Длительность этапов обработки задачи, секунды"""
+
+    # От создания задачи до захвата воркером
+    queue_wait: float = dc.field(default=0)
+    claim: float = dc.field(default=0)
+    metadata: float = dc.field(default=0)
+    download: float = dc.field(default=0)
+    decode: float = dc.field(default=0)
+    transform: float = dc.field(default=0)
+    encode: float = dc.field(default=0)
+    # Вся работа с изображением, вместе с передачей в пул процессов
+    image: float = dc.field(default=0)
+    # Пул процессов: ожидание свободного процесса вместе с передачей аргументов,
+    # затем возврат результата
+    cpu_wait: float = dc.field(default=0)
+    ipc: float = dc.field(default=0)
+    upload: float = dc.field(default=0)
+    db_update: float = dc.field(default=0)
+    total: float = dc.field(default=0)
+    # message - метаданные файла пришли в сообщении, fetched - запрошены у хранилища
+    metadata_source: str = dc.field(default="message")
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, name, getattr(self, name) + time.perf_counter() - started)
+
+    def observe(self):
+        """Запись длительностей этапов в метрики"""
+        for field in dc.fields(self):
+            value = getattr(self, field.name)
+            if field.type is float and value:
+                TASK_STAGE_SECONDS.observe(value, stage=field.name)
 
 
 class TasksWorker(BaseMule):
@@ -26,14 +114,33 @@ class TasksWorker(BaseMule):
         file_request: FileStorageData,
         image_proc: ImageProcessor,
         temp_dir: str,
+        processing: ProcessingConfig = None,
+        result_cache: ResultCache = None,
+        repository: TaskRepository = None,
+        reclaim_interval: int = 60,
+        metrics_port: int = 0,
+        profiler: TaskProfiler = None,
+        source_cache: SourceCache = None,
+        outbox_relay: OutboxRelay = None,
     ):
         """Инициализация сервиса"""
         self._rabbit = rabbit
         self._pg = pg_connection
+        self._repository = repository or TaskRepository(pg_connection)
+        self._reclaim_interval = reclaim_interval
+        self._metrics_port = metrics_port
+        self._profiler = profiler
+        self._stopped = threading.Event()
         self._image_proc = image_proc
         self._temp_dir = temp_dir
+        self._processing = processing or ProcessingConfig()
+        self._result_cache = result_cache
+        self._source_cache = source_cache
+        self._outbox_relay = outbox_relay
         self._logger = ClassesLoggerAdapter.create(self)
         self._f_req = file_request
+        self._meta_pool = ThreadPoolExecutor(thread_name_prefix="task-meta")
+        self._upload_pool = ThreadPoolExecutor(thread_name_prefix="task-upload")
 
     def _task_temp_dir(self, task_id: int) -> str:
         """Создание временной папки"""
@@ -41,39 +148,81 @@ class TasksWorker(BaseMule):
         os.makedirs(task_temp_dir, exist_ok=True)
         return task_temp_dir
 
-    def _handle(self, task: ImageProcessingTask):
+    def _handle(
+        self,
+        task: ImageProcessingTask,
+        file_info: dict = None,
+        timings: TaskTimings = None,
+    ):
         """Обработка задачи"""
         self._logger.info("Обработка задачи", extra={"task": task.task_id})
-        task = ImageProcessingTask.load(task.dump())
-        task_temp_dir = self._task_temp_dir(task.task_id)
-        file_id = task.file_id
-
-        try:
-            data = self._f_req.file_download(file_id)
-            storage_file_data = self._f_req.file_info_data(file_id)
-
-            temp_file = f"{file_id}_{str(task.task_id)}{storage_file_data.get('extension', 'jpg')}"
-            temp_file_path = os.path.join(task_temp_dir, temp_file)
-
-            with open(temp_file_path, "wb") as f:
-                f.write(data.content)
-
-            image = Image.open(temp_file_path)
-            task_type = task.task_type.value
-            task_type_value = task.task_type_value
-
-            changed_image = self._image_proc.image_process(
-                image, task_type, task_type_value
+        stats = TaskIOStats()
+        timings = timings or TaskTimings()
+        stages = {}
+        if task.created_at and task.leased_at:
+            timings.queue_wait = max(
+                (task.leased_at - task.created_at).total_seconds(), 0
             )
+        status = "error"
+        renditions = task.task_type == TaskType.RENDITIONS
+        new_file_ids = None
 
-            new_name = f"{storage_file_data.get('name')}_{str(task.task_id)}{storage_file_data.get('extension', 'jpg')}"
-            new_path = os.path.join(self._temp_dir, new_name)
-            changed_image.save(new_path)
+        try:
+            if not renditions and reuses_source(
+                task.pipeline(), task.output or self._image_proc.output
+            ):
+                # Поворот на 0 и масштаб 100%: результат - сам исходный файл
+                self._update_task_info(task, TaskStatus.DONE, task.file_id)
+                status = "reused"
+                return
 
-            upload_file = self._f_req.file_upload(new_name, new_path)
+            if not renditions and self._result_cache:
+                if file_info is None:
+                    # Метаданных нет в сообщении (в том числе при проверке файла
+                    # воркером): без них нет ключа кэша
+                    timings.metadata_source = "fetched"
+                    file_info = self._fetch_file_info(task.file_id, timings)
+                cached_file_id = self._result_cache.lookup(
+                    operation_key(task.file_id, file_info, task.pipeline(), task.output)
+                )
+                if cached_file_id:
+                    self._update_task_info(task, TaskStatus.DONE, cached_file_id)
+                    status = "cached"
+                    return
 
-            new_file_id = upload_file.get("file_id")
-            self._update_task_info(task, TaskStatus.DONE, new_file_id)
+            with timings.stage("total"):
+                if renditions:
+                    new_file_ids, file_info = self._process_renditions(
+                        task, stats, timings, stages, file_info
+                    )
+                    new_file_id = new_file_ids[0]
+                elif self._processing.in_memory:
+                    new_file_id, file_info = self._process_in_memory(
+                        task, stats, timings, stages, file_info
+                    )
+                else:
+                    new_file_id, file_info = self._process_on_disk(
+                        task, stats, timings, stages, file_info
+                    )
+            # Запись в кэш до статуса DONE: новые запросы, не заставшие ведущую
+            # задачу в работе, уже найдут результат в кэше
+            if not renditions and self._result_cache:
+                self._result_cache.store(
+                    operation_key(
+                        task.file_id, file_info, task.pipeline(), task.output
+                    ),
+                    task.file_id,
+                    new_file_id,
+                )
+            with timings.stage("db_update"):
+                self._update_task_info(
+                    task,
+                    TaskStatus.DONE,
+                    new_file_id,
+                    self._result_meta(stats, stages),
+                    new_file_ids,
+                )
+            status = "done"
 
         except Exception as e:
             self._logger.critical(
@@ -81,72 +230,373 @@ class TasksWorker(BaseMule):
                 exc_info=True,
                 extra={"e": e, "task": task.task_id},
             )
+            # Ошибка БД оставляет сессию потока в прерванной транзакции
+            self._pg.rollback()
             self._update_task_info(task, TaskStatus.ERROR)
         finally:
-            shutil.rmtree(task_temp_dir, ignore_errors=True)
+            stats.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            for stage in ("decode", "transform", "encode", "cpu_wait", "ipc"):
+                setattr(timings, stage, stages.get(stage, 0))
+            stats.copies = stages.get("copies", 0)
+            stats.ipc_bytes = stages.get("ipc_bytes", 0)
+            timings.observe()
+            TASKS.inc(status=status)
+            TASK_BYTES.inc(stats.downloaded_bytes, direction="download")
+            TASK_BYTES.inc(stats.uploaded_bytes, direction="upload")
+            TASK_BYTES.inc(stats.ipc_bytes, direction="ipc")
+            if stats.source_cache:
+                SOURCE_CACHE.inc(result=stats.source_cache)
+            TASK_PIXELS.inc(stages.get("source_pixels", 0), image="source")
+            TASK_PIXELS.inc(stages.get("result_pixels", 0), image="result")
+            REGISTRY.flush()
             self._logger.info(
-                "Обработка задачи завершена", extra={"task": task.task_id}
+                "Обработка задачи завершена",
+                extra={
+                    "task": task.task_id,
+                    "io": stats.dump(),
+                    "timings": timings.dump(),
+                    "http": self._f_req.stats(),
+                },
+            )
+
+    @staticmethod
+    def _result_meta(stats: TaskIOStats, stages: dict) -> dict:
+        """Сведения о результате для задачи"""
+        width, height = stages.get("result_size") or (None, None)
+        return {
+            "format": stages.get("format"),
+            "mime_type": output_mime_type(stages.get("format")),
+            "size": stats.uploaded_bytes,
+            "width": width,
+            "height": height,
+            "encode_seconds": round(stages.get("encode", 0), 4),
+            # JPEG повернут без перекодирования
+            "lossless": stages.get("lossless", False),
+            "renditions": stages.get("renditions"),
+        }
+
+    def _fetch_file_info(self, file_id: int, timings: TaskTimings) -> dict:
+        """Запрос метаданных файла у хранилища"""
+        with timings.stage("metadata"):
+            file_info = self._f_req.file_info_data(file_id)
+        if not file_info:
+            raise ModuleException("Файл не найден", code=404)
+        return file_info
+
+    def _file_info_future(
+        self, file_id: int, file_info: dict, timings: TaskTimings
+    ) -> Future:
+        """Метаданные из сообщения либо запрос параллельно со скачиванием"""
+        if file_info is not None:
+            future = Future()
+            future.set_result(file_info)
+            return future
+
+        timings.metadata_source = "fetched"
+        return self._meta_pool.submit(self._fetch_file_info, file_id, timings)
+
+    def _process_in_memory(
+        self,
+        task: ImageProcessingTask,
+        stats: TaskIOStats,
+        timings: TaskTimings,
+        stages: dict,
+        file_info: dict = None,
+    ):
+        """Обработка без промежуточных файлов: буфер -> Pillow -> буфер -> загрузка"""
+        file_info_future = self._file_info_future(task.file_id, file_info, timings)
+
+        with self._source(task.file_id, file_info_future, stats, timings) as (
+            source,
+            storage_file_data,
+        ):
+            extension = storage_file_data.get("extension", "jpg")
+            with timings.stage("image"):
+                result = self._transform(
+                    source, task.pipeline(), extension, stages, task.output
+                )
+
+        with result, timings.stage("upload"):
+            stats.uploaded_bytes = result.getbuffer().nbytes
+            stats.buffered_bytes += stats.uploaded_bytes
+            new_extension = output_extension(stages["format"], extension)
+            new_name = (
+                f"{storage_file_data.get('name')}_{str(task.task_id)}{new_extension}"
             )
+            upload_file = self._f_req.file_upload(
+                new_name, result, content_type=output_mime_type(stages["format"])
+            )
+
+        return upload_file.get("file_id"), storage_file_data
+
+    @contextmanager
+    def _source(
+        self, file_id: int, file_info_future: Future, stats: TaskIOStats, timings
+    ):
+        """Исходник и метаданные файла: из локального кэша либо скачанный в
+        буфер. Запись кэша проверяется по метаданным, поэтому кэш действует,
+        только когда они уже есть (из сообщения): иначе скачивание не ждет
+        запроса метаданных и идет параллельно с ним"""
+        if self._source_cache and file_info_future.done():
+            storage_file_data = file_info_future.result()
+            with self._source_cache.open(
+                file_id,
+                storage_file_data,
+                lambda target: self._download_cached(file_id, target, timings),
+            ) as cached:
+                if cached:
+                    stats.source_cache = "hit" if cached.hit else "miss"
+                    if cached.hit:
+                        stats.disk_read_bytes += cached.size
+                    else:
+                        stats.downloaded_bytes = cached.size
+                        stats.disk_written_bytes += cached.size
+                    yield cached.data, storage_file_data
+                    return
+
+        with spooled_buffer(self._processing.spool_max_size, self._temp_dir) as source:
+            self._download_to(file_id, source, stats, timings)
+            yield source, file_info_future.result()
+
+    def _download_cached(self, file_id: int, target, timings: TaskTimings) -> int:
+        """Скачивание исходника в файл кэша"""
+        with timings.stage("download"):
+            return self._f_req.file_download_to(file_id, target)
+
+    def _download_to(self, file_id: int, source, stats: TaskIOStats, timings):
+        """Скачивание исходника в буфер, сбрасываемый на диск сверх spool_max_size"""
+        max_size = self._processing.spool_max_size
+        with timings.stage("download"):
+            stats.downloaded_bytes = self._f_req.file_download_to(file_id, source)
+        if stats.downloaded_bytes > max_size:
+            stats.spilled = True
+            stats.disk_written_bytes += stats.downloaded_bytes
+            stats.disk_read_bytes += stats.downloaded_bytes
+        stats.buffered_bytes = min(stats.downloaded_bytes, max_size)
+
+    def _process_renditions(
+        self,
+        task: ImageProcessingTask,
+        stats: TaskIOStats,
+        timings: TaskTimings,
+        stages: dict,
+        file_info: dict = None,
+    ):
+        """Набор копий за одно скачивание и декодирование, загрузка всех копий
+        параллельно. Всегда в памяти: копии меньше исходника"""
+        file_id = task.file_id
+        scales = [operation["value"] for operation in task.pipeline()]
+        file_info_future = self._file_info_future(file_id, file_info, timings)
+
+        with self._source(file_id, file_info_future, stats, timings) as (
+            source,
+            storage_file_data,
+        ):
+            extension = storage_file_data.get("extension", "jpg")
+            with timings.stage("image"):
+                results = self._render(source, scales, extension, stages, task.output)
+
+        format_name = stages["format"]
+        new_extension = output_extension(format_name, extension)
+        sizes = [result.getbuffer().nbytes for result in results]
+        stats.uploaded_bytes = sum(sizes)
+        stats.buffered_bytes += stats.uploaded_bytes
+        with timings.stage("upload"):
+            futures = [
+                self._upload_pool.submit(
+                    self._f_req.file_upload,
+                    f"{storage_file_data.get('name')}_{task.task_id}_{scale}{new_extension}",
+                    result,
+                    content_type=output_mime_type(format_name),
+                )
+                for scale, result in zip(scales, results)
+            ]
+            try:
+                uploaded = [future.result() for future in futures]
+            finally:
+                for result in results:
+                    result.close()
+
+        file_ids = [upload_file.get("file_id") for upload_file in uploaded]
+        stages["renditions"] = [
+            {
+                "scale": scale,
+                "file_id": new_file_id,
+                "width": width,
+                "height": height,
+                "size": size,
+            }
+            for scale, new_file_id, (width, height), size in zip(
+                scales, file_ids, stages["rendition_sizes"], sizes
+            )
+        ]
+        return file_ids, storage_file_data
+
+    def _render(
+        self, source, scales: list, extension: str, stages: dict, output: dict
+    ) -> list:
+        """Декодирование, набор копий и кодирование"""
+        return render_renditions(
+            self._image_proc, source, scales, extension, stages, output
+        )
+
+    def _transform(
+        self, source, operations: list, extension: str, stages: dict, output: dict
+    ) -> io.BytesIO:
+        """Декодирование, обработка и кодирование изображения"""
+        return process_image(
+            self._image_proc, source, operations, extension, stages, output
+        )
+
+    def _process_on_disk(
+        self,
+        task: ImageProcessingTask,
+        stats: TaskIOStats,
+        timings: TaskTimings,
+        stages: dict,
+        file_info: dict = None,
+    ):
+        """Обработка через временные файлы"""
+        task_temp_dir = self._task_temp_dir(task.task_id)
+        file_id = task.file_id
+        file_info_future = self._file_info_future(file_id, file_info, timings)
+
+        try:
+            with timings.stage("download"):
+                data = self._f_req.file_download(file_id)
+            storage_file_data = file_info_future.result()
+            stats.downloaded_bytes = len(data.content)
+            stats.buffered_bytes = stats.downloaded_bytes
+
+            temp_file = f"{file_id}_{str(task.task_id)}{storage_file_data.get('extension', 'jpg')}"
+            temp_file_path = os.path.join(task_temp_dir, temp_file)
+
+            with open(temp_file_path, "wb") as f:
+                f.write(data.content)
+            stats.disk_written_bytes += stats.downloaded_bytes
+
+            extension = storage_file_data.get("extension", "jpg")
+            new_path = os.path.join(task_temp_dir, f"result_{task.task_id}")
+            with timings.stage("image"):
+                transform_image(
+                    self._image_proc,
+                    temp_file_path,
+                    task.pipeline(),
+                    extension,
+                    new_path,
+                    stages,
+                    task.output,
+                )
+            stats.disk_read_bytes += stats.downloaded_bytes
+            format_name = stages["format"]
+            new_name = f"{storage_file_data.get('name')}_{str(task.task_id)}{output_extension(format_name, extension)}"
+            stats.uploaded_bytes = os.path.getsize(new_path)
+            stats.disk_written_bytes += stats.uploaded_bytes
+            stats.disk_read_bytes += stats.uploaded_bytes
+
+            with timings.stage("upload"):
+                upload_file = self._f_req.file_upload(
+                    new_name, new_path, content_type=output_mime_type(format_name)
+                )
+            return upload_file.get("file_id"), storage_file_data
+        finally:
+            shutil.rmtree(task_temp_dir, ignore_errors=True)
 
     def _update_task_info(
-        self, task: ImageProcessingTask, status: TaskStatus, processed_file_id=0
+        self,
+        task: ImageProcessingTask,
+        status: TaskStatus,
+        processed_file_id=0,
+        result_meta: dict = None,
+        processed_file_ids: list = None,
     ):
         """Обновление статуса задачи"""
-        task.status = status
-        updated = datetime.now()
-        task.updated_at = updated
-        task.processed_file_id = processed_file_id
         self._logger.info(
             "Обновление данных задачи",
             extra={
                 "task_id": task.task_id,
-                "status": task.status,
+                "status": status,
                 "processed_file_id": processed_file_id,
             },
         )
-        if self._pg.get(ImageProcessingTask, task.task_id, with_for_update=True):
-            self._pg.merge(task)
-            self._pg.commit()
-            return task.reload()
+        finished, followers = self._repository.finish(
+            task, status, processed_file_id, result_meta, processed_file_ids
+        )
+        if not finished:
+            self._logger.warn(
+                "Аренда задачи потеряна, статус не изменен",
+                extra={"task_id": task.task_id, "owner": self._repository.owner},
+            )
+            return
+        followers and self._logger.info(
+            "Результат передан ожидающим задачам",
+            extra={"task_id": task.task_id, "followers": followers},
+        )
+        return finished
 
     def _get_task(self, task_id: int) -> ImageProcessingTask | None:
-        """Получение задачи из БД"""
-        with self._pg.begin():
-            task: ImageProcessingTask = self._pg.execute(
-                sa.select(ImageProcessingTask)
-                .filter(
-                    sa.and_(
-                        sa_operator.eq(ImageProcessingTask.task_id, task_id),
-                        sa_operator.in_(
-                            ImageProcessingTask.status,
-                            [
-                                TaskStatus.NEW,
-                                # В случае ручного восстановления работы
-                                TaskStatus.PROCESSING,
-                            ],
-                        ),
-                    )
-                )
-                .limit(1)
-            ).scalar()
-            if not task:
-                return
+        """Захват задачи воркером"""
+        return self._repository.claim(task_id)
 
-            task.status = TaskStatus.PROCESSING
-            task.updated_at = datetime.now()
-            self._pg.merge(task)
-            return task.reload()
+    def _reclaim_stale(self):
+        """Повторная отправка задач, аренда которых устарела (воркер упал)"""
+        while not self._stopped.wait(self._reclaim_interval):
+            try:
+                task_ids = self._repository.reclaim_stale()
+                if not task_ids:
+                    continue
+                self._logger.warn(
+                    "Задачи с устаревшей арендой возвращены в очередь",
+                    extra={"task_ids": task_ids},
+                )
+                self._rabbit.publish_many(
+                    [
+                        TaskIdentMessageModel.lazy_load(
+                            TaskIdentMessageModel.T(task_id)
+                        )
+                        for task_id in task_ids
+                    ]
+                )
+            except Exception as e:
+                self._logger.error(
+                    "Ошибка возврата задач с устаревшей арендой",
+                    exc_info=True,
+                    extra={"e": e},
+                )
 
     def _handle_message(self, message: TaskIdentMessageModel, **_):
         """Обработка сообщения от брокера"""
         task_id = message.payload.task_id
-        task = self._get_task(task_id)
+        timings = TaskTimings()
+        with timings.stage("claim"):
+            task = self._get_task(task_id)
         if not task:
             self._logger.warn("Задача не найдена", extra={"task_id": task_id})
             return
 
+        self._process_task(
+            task,
+            file_info=message.payload.file_info,
+            timings=timings,
+            profile=message.payload.profile,
+        )
+
+    def _process_task(
+        self,
+        task: ImageProcessingTask,
+        file_info: dict = None,
+        timings: TaskTimings = None,
+        profile: bool = False,
+    ):
+        """Обработка захваченной задачи. Запрос профилирования - из сообщения
+        либо из самой задачи (очередь postgres)"""
+        profile = profile or bool(task.profile)
         try:
-            self._handle(task)
+            if self._profiler and self._profiler.wants(task.task_id, profile):
+                with self._profiler.profile(task.task_id):
+                    self._handle(task, file_info=file_info, timings=timings)
+            else:
+                self._handle(task, file_info=file_info, timings=timings)
         except Exception as e:
             exc_data = {"e": e}
             if isinstance(e, ModuleException):
@@ -156,8 +606,41 @@ class TasksWorker(BaseMule):
                 extra=exc_data,
                 exc_info=True,
             )
+            self._pg.rollback()
             self._update_task_info(task, TaskStatus.ERROR)
 
+    def _start_metrics_server(self):
+        if not self._metrics_port:
+            return
+        try:
+            start_http_server(self._metrics_port)
+        except OSError as e:
+            self._logger.error(
+                "Ошибка запуска выдачи метрик",
+                extra={"port": self._metrics_port, "e": e},
+            )
+
+    def _on_shutdown_signal(self, signum, _frame):
+        """Корректная остановка: новые сообщения не принимаются, текущие дорабатываются"""
+        self._logger.info("Получен сигнал остановки", extra={"signal": signum})
+        self._rabbit.stop_consume()
+
     def run(self):
         """Запуск прослушивания очереди брокера сообщений"""
-        self._rabbit.run_consume(self._handle_message, TaskIdentMessageModel)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_shutdown_signal)
+        threading.Thread(
+            target=self._reclaim_stale, name="task-reclaim", daemon=True
+        ).start()
+        if self._outbox_relay:
+            threading.Thread(
+                target=self._outbox_relay.run,
+                args=(self._stopped,),
+                name="task-outbox",
+                daemon=True,
+            ).start()
+        self._start_metrics_server()
+        try:
+            self._rabbit.run_consume(self._handle_message, TaskIdentMessageModel)
+        finally:
+            self._stopped.set()
@@ -1,3 +1,9 @@
+import base64
+import dataclasses as dc
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from typing import Optional
 from flask import jsonify
 import pika
@@ -8,87 +14,639 @@ from base_module import sa_operator
 from base_module.exceptions import ModuleException
 from base_module.rabbit import TaskIdentMessageModel
 from base_module.services.rabbit import RabbitService
+from config import (
+    BatchConfig,
+    EncodingConfig,
+    EncodingProfile,
+    OutboxConfig,
+    PageConfig,
+)
 from models.orm_models import ImageProcessingTask, TaskStatus, TaskType
-from services.services import FileStorageData
+from services.coalescing import (
+    find_leader,
+    find_leaders,
+    lock_operation,
+    lock_operations,
+)
+from services.outbox import add_outbox_messages
+from services.pg_queue import notify_new_tasks
+from services.pixel_ops import PIXEL_OPERATIONS
+from services.priority import TaskPriority, parse_priority
+from services.result_cache import ResultCache, operation_key
+from services.services import (
+    OUTPUT_FORMATS,
+    SPEED_PRESETS,
+    FileStorageData,
+    reuses_source,
+)
 
 
 class ImageProcessing:
 
+    GEOMETRY_TYPES = (TaskType.SCALE.value, TaskType.ROTATE.value)
+    OPERATION_TYPES = (*GEOMETRY_TYPES, *PIXEL_OPERATIONS)
+    MAX_OPERATIONS = 10
+    MAX_RENDITIONS = 10
+
     def __init__(
         self,
         pg_connection: PGSession,
         rabbit: RabbitService,
-        file_request: FileStorageData
+        file_request: FileStorageData,
+        result_cache: ResultCache = None,
+        coalesce: bool = False,
+        batch: BatchConfig = None,
+        page: PageConfig = None,
+        notify_channel: str = None,
+        encoding: EncodingConfig = None,
+        outbox: OutboxConfig = None,
+        priority: TaskPriority = None,
+        profile_requests: bool = False,
     ):
         self._pg = pg_connection
         self._rabbit = rabbit
         self._f_req = file_request
+        self._result_cache = result_cache
+        self._coalesce = coalesce
+        self._batch = batch or BatchConfig()
+        self._page = page or PageConfig()
+        # Очередь в Postgres: задача в таблице уже поставлена, брокер не нужен
+        self._notify_channel = notify_channel
+        self._encoding = encoding or EncodingConfig()
+        outbox = outbox or OutboxConfig()
+        # Сообщения о задачах в таблице outbox вместо отправки в брокер из запроса
+        self._outbox_channel = outbox.notify_channel if outbox.enabled else None
+        self._defer_file_check = outbox.defer_file_check
+        self._priority = priority
+        # Учитывать запрос профилирования задачи от клиента
+        self._profile_requests = profile_requests
 
     def check_exists(self, file_id: int) -> Optional[dict]:
         check_response = self._f_req.file_info_data(file_id)
         return check_response
     
-    def _task_type_checker(self, request_data: dict) -> dict:
-        req_task_type = None
-        task_type_value = None
-
-        if "rotate" in request_data:
-            req_task_type = 'rotate'
-        elif "scale" in request_data:
-            req_task_type = 'scale'
-        
-        if req_task_type:
-            task_type_value = request_data.get(req_task_type)
-
-        if req_task_type and task_type_value:
-            return {'task_type': TaskType.from_value(req_task_type), 'task_type_value': task_type_value}
-        else:
+    def _operations_parser(self, request_data: dict) -> Optional[list]:
+        """Разбор упорядоченного списка операций из запроса.
+
+        Поддерживаются форматы:
+        {"operations": [{"type": "scale", "value": 50}, {"rotate": 90}]}
+        {"scale": 50, "rotate": 90} - операции в порядке ключей
+        """
+        if not isinstance(request_data, dict):
+            return
+
+        raw_operations = request_data.get("operations")
+        if raw_operations is None:
+            raw_operations = [
+                {key: value}
+                for key, value in request_data.items()
+                if key in self.OPERATION_TYPES
+            ]
+        if not isinstance(raw_operations, list) or not raw_operations:
+            return
+        if len(raw_operations) > self.MAX_OPERATIONS:
+            return
+
+        operations = []
+        for raw_operation in raw_operations:
+            if not isinstance(raw_operation, dict):
+                return
+            if "type" in raw_operation:
+                op_type = raw_operation.get("type")
+                op_value = raw_operation.get("value")
+            elif len(raw_operation) == 1:
+                op_type, op_value = next(iter(raw_operation.items()))
+            else:
+                return
+
+            if op_type not in self.OPERATION_TYPES:
+                return
+            if op_type in PIXEL_OPERATIONS:
+                try:
+                    op_value = PIXEL_OPERATIONS[op_type].parse(op_value)
+                except ValueError:
+                    return
+            elif isinstance(op_value, bool) or not isinstance(op_value, int):
+                return
+            if op_type == TaskType.SCALE.value and op_value <= 0:
+                return
+            operations.append({"type": op_type, "value": op_value})
+
+        return operations
+
+    def _renditions_parser(self, request_data: dict) -> Optional[list]:
+        """Разбор набора копий {"renditions": [50, 25, 10]} (проценты от исходника).
+
+        Копии упорядочиваются от крупной к мелкой: каждая строится из предыдущей
+        """
+        scales = request_data.get("renditions")
+        if not isinstance(scales, list) or not scales:
+            return
+        if len(scales) > self.MAX_RENDITIONS:
             return
+        for scale in scales:
+            if isinstance(scale, bool) or not isinstance(scale, int):
+                return
+            if not 0 < scale <= 100:
+                return
+        return [
+            {"type": TaskType.SCALE.value, "value": scale}
+            for scale in sorted(set(scales), reverse=True)
+        ]
+
+    def _request_parser(self, request_data: dict) -> tuple[Optional[list], bool]:
+        """Операции задачи и признак набора копий"""
+        if isinstance(request_data, dict) and "renditions" in request_data:
+            return self._renditions_parser(request_data), True
+        return self._operations_parser(request_data), False
+
+    @staticmethod
+    def _operation_key(
+        file_id: int, file_info: dict, operations: list, output, renditions: bool
+    ) -> str:
+        extra = {"renditions": True} if renditions else {}
+        return operation_key(file_id, file_info, operations, output, **extra)
+
+    def _output_parser(self, request_data: dict) -> Optional[dict]:
+        """Профиль кодирования результата из поля output, None - по умолчанию.
+
+        Поддерживаются форматы:
+        {"output": "web"} - именованный профиль из encoding.profiles
+        {"output": {"profile": "web", "quality": 70}} - профиль с уточнениями
+        {"output": {"format": "webp", "quality": 80, "speed": "fast"}}
+        Ошибка в профиле - ValueError.
+        """
+        raw_output = request_data.get("output")
+        if raw_output is None:
+            return None
+        if isinstance(raw_output, str):
+            raw_output = {"profile": raw_output}
+        if not isinstance(raw_output, dict):
+            raise ValueError(raw_output)
+
+        raw_output = dict(raw_output)
+        name = raw_output.pop("profile", None)
+        layers = [self._encoding.default]
+        if name is not None:
+            if name not in self._encoding.profiles:
+                raise ValueError(name)
+            layers.append(self._encoding.profiles[name])
+        if set(raw_output) - {field.name for field in dc.fields(EncodingProfile)}:
+            raise ValueError(raw_output)
+        layers.append(EncodingProfile.load(raw_output))
+
+        output = {}
+        for layer in layers:
+            output.update(
+                {
+                    key: value
+                    for key, value in layer.dump().items()
+                    if value not in (None, "")
+                }
+            )
+        output_format = output.get("format", "").upper().replace("JPG", "JPEG")
+        if output_format:
+            output["format"] = output_format.lower()
+        if output_format and output_format not in OUTPUT_FORMATS:
+            raise ValueError(output_format)
+        if output.get("speed") and output["speed"] not in SPEED_PRESETS:
+            raise ValueError(output["speed"])
+        if not 1 <= output.get("quality", 1) <= 100:
+            raise ValueError(output["quality"])
+        if not 0 <= output.get("compress_level", 0) <= 9:
+            raise ValueError(output["compress_level"])
+        return output or None
+
+    def _task_priority(
+        self, file_info: Optional[dict], operations: list, bias: int
+    ) -> Optional[int]:
+        """Приоритет сообщения задачи, None - приоритеты выключены"""
+        if not self._priority:
+            return None
+        return self._priority(file_info, operations, bias)
+
+    def _reuses_source(self, operations: list, output: Optional[dict]) -> bool:
+        """Поворот на 0 и масштаб 100% без смены формата - результат уже есть"""
+        return reuses_source(operations, output or self._encoding.default.dump())
+
+    def _new_task(
+        self, file_id: int, operations: list, renditions: bool = False, **fields
+    ) -> ImageProcessingTask:
+        if renditions:
+            task_type = TaskType.RENDITIONS
+            task_type_value = None
+        elif len(operations) == 1 and operations[0]["type"] in self.GEOMETRY_TYPES:
+            task_type = TaskType.from_value(operations[0]["type"])
+            task_type_value = operations[0]["value"]
+        else:
+            task_type = TaskType.PIPELINE
+            task_type_value = None
+
+        return ImageProcessingTask(
+            file_id=file_id,
+            task_type=task_type,
+            task_type_value=task_type_value,
+            operations=operations,
+            **fields,
+        )
 
     def create_task(
-        self, file_id: int, request_data: dict
+        self, file_id: int, request_data: dict, profile: bool = False
     ) -> ImageProcessingTask:
 
-        task_proc_type = self._task_type_checker(request_data)
-        if not task_proc_type:
+        operations, renditions = self._request_parser(request_data)
+        try:
+            output = self._output_parser(request_data) if operations else None
+            bias = parse_priority(request_data) if operations else 0
+        except Exception:
+            operations = None
+        if not operations:
             return jsonify({"error": "Проверьте введенные данные"}), 400
 
-        task_type = task_proc_type.get('task_type')
-        task_type_value = task_proc_type.get('task_type_value')
-            
-        if self.check_exists(file_id): 
-            task = ImageProcessingTask(
-                file_id=file_id,
-                task_type=task_type,
-                task_type_value=task_type_value
+        profile = profile and self._profile_requests
+        file_info = None if self._defer_file_check else self.check_exists(file_id)
+        processed_file_id = None
+        key = None
+        if file_info:
+            key = self._operation_key(
+                file_id, file_info, operations, output, renditions
+            )
+        # Набор копий всегда строится: в кэше хранится только один файл результата
+        if key and not renditions:
+            if self._reuses_source(operations, output):
+                processed_file_id = file_id
+            elif self._result_cache:
+                processed_file_id = self._result_cache.lookup(key)
+
+        if processed_file_id:
+            task = self._new_task(
+                file_id,
+                operations,
+                output=output,
+                processed_file_id=processed_file_id,
+                status=TaskStatus.DONE,
+                updated_at=datetime.now(),
+            )
+            self._pg.add(task)
+            self._pg.commit()
+            return task.dump()
+
+        if file_info or self._defer_file_check:
+            task = self._new_task(
+                file_id,
+                operations,
+                renditions,
+                output=output,
+                operation_key=key,
+                priority=self._task_priority(file_info, operations, bias),
+                profile=profile,
             )
         else:
-            task = ImageProcessingTask(
-                file_id=file_id,
-                task_type=task_type,
-                task_type_value=task_type_value,
-                status=TaskStatus.ERROR,
+            task = self._new_task(
+                file_id, operations, renditions, output=output, status=TaskStatus.ERROR
             )
 
+        # Профилируемая задача выполняется сама, а не ждет результат другой
+        if key and self._coalesce and not profile:
+            # Одинаковая задача уже выполняется: ждем ее результат без публикации
+            lock_operation(self._pg, key)
+            task.leader_task_id = find_leader(self._pg, key)
+
         self._pg.add(task)
+        if (
+            self._notify_channel
+            and task.status == TaskStatus.NEW
+            and not task.leader_task_id
+        ):
+            notify_new_tasks(self._pg, self._notify_channel)
+        elif (
+            self._outbox_channel
+            and task.status == TaskStatus.NEW
+            and not task.leader_task_id
+        ):
+            self._pg.flush()
+            add_outbox_messages(
+                self._pg,
+                [
+                    TaskIdentMessageModel.T(
+                        task.task_id, file_info=file_info, profile=profile
+                    )
+                ],
+                self._outbox_channel,
+                [task.priority],
+            )
         self._pg.commit()
+        if task.leader_task_id or self._notify_channel or self._outbox_channel:
+            return task.dump()
 
-        message = TaskIdentMessageModel.lazy_load(TaskIdentMessageModel.T(task.task_id))
+        message = TaskIdentMessageModel.lazy_load(
+            TaskIdentMessageModel.T(task.task_id, file_info=file_info, profile=profile)
+        )
 
-        published = self._rabbit.publish(message, properties=pika.BasicProperties())
+        published = self._rabbit.publish(
+            message, properties=pika.BasicProperties(priority=task.priority)
+        )
         if published:
             return task.dump()
 
+        # Задача уже видна другим запросам и могла получить ведомые задачи:
+        # вместо удаления завершаем ошибкой ее вместе с ведомыми
+        self._fail_unpublished([task])
+        task.status = TaskStatus.ERROR
+        return task.dump()
+
+    def _fail_unpublished(self, leaders: list[ImageProcessingTask]):
+        """Ошибка для неотправленных задач и ожидающих их ведомых задач.
+
+        Блокировка ключей исключает новые ведомые задачи, присоединенные после
+        обновления статуса.
+        """
+        failed_ids = [task.task_id for task in leaders]
         with self._pg.begin():
-            self._pg.delete(task)
+            keys = {task.operation_key for task in leaders if task.operation_key}
+            if self._coalesce and keys:
+                lock_operations(self._pg, keys)
+            self._pg.execute(
+                sa.update(ImageProcessingTask)
+                .where(
+                    sa.or_(
+                        sa_operator.in_(ImageProcessingTask.task_id, failed_ids),
+                        sa_operator.in_(ImageProcessingTask.leader_task_id, failed_ids),
+                    )
+                )
+                .values(status=TaskStatus.ERROR, updated_at=datetime.now())
+            )
+
+    def _check_exists_many(self, file_ids: set) -> dict:
+        """Параллельная проверка наличия файлов в хранилище"""
+        file_ids = list(file_ids)
+        with ThreadPoolExecutor(self._batch.check_concurrency) as pool:
+            return dict(zip(file_ids, pool.map(self.check_exists, file_ids)))
+
+    def _insert_tasks(self, tasks: list[ImageProcessingTask]):
+        """Вставка задач одним INSERT ... RETURNING"""
+        if not tasks:
+            return
+        columns = [
+            field.name
+            for field in dc.fields(ImageProcessingTask)
+            if field.name != "task_id"
+        ]
+        task_ids = self._pg.scalars(
+            sa.insert(ImageProcessingTask).returning(
+                ImageProcessingTask.task_id, sort_by_parameter_order=True
+            ),
+            [{column: getattr(task, column) for column in columns} for task in tasks],
+        ).all()
+        for task, task_id in zip(tasks, task_ids):
+            task.task_id = task_id
+
+    def create_tasks(self, request_data: dict):
+        """Пакетное создание задач.
+
+        {"items": [{"file_id": 1, "operations": [...]}, {"file_id": 2, "scale": 50}]}
+        """
+        items = request_data.get("items") if isinstance(request_data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Проверьте введенные данные"}), 400
+        if len(items) > self._batch.max_items:
+            return (
+                jsonify({"error": f"Не более {self._batch.max_items} задач за запрос"}),
+                400,
+            )
+
+        results: list[Optional[dict]] = [None] * len(items)
+        parsed = []
+        for index, item in enumerate(items):
+            file_id = item.get("file_id") if isinstance(item, dict) else None
+            operations, renditions = self._request_parser(item)
+            if isinstance(file_id, bool) or not isinstance(file_id, int):
+                operations = None
+            try:
+                output = self._output_parser(item) if operations else None
+                bias = parse_priority(item) if operations else 0
+            except Exception:
+                operations = None
+            if not operations:
+                results[index] = {"index": index, "error": "Проверьте введенные данные"}
+                continue
+            parsed.append((index, file_id, operations, output, renditions, bias))
+
+        files_info = (
+            {}
+            if self._defer_file_check
+            else self._check_exists_many({item[1] for item in parsed})
+        )
+
+        tasks: list[tuple[int, ImageProcessingTask]] = []
+        for index, file_id, operations, output, renditions, bias in parsed:
+            file_info = files_info.get(file_id)
+            priority = self._task_priority(file_info, operations, bias)
+            if file_info:
+                key = self._operation_key(
+                    file_id, file_info, operations, output, renditions
+                )
+                task = self._new_task(
+                    file_id,
+                    operations,
+                    renditions,
+                    output=output,
+                    operation_key=key,
+                    priority=priority,
+                )
+            elif self._defer_file_check:
+                task = self._new_task(
+                    file_id, operations, renditions, output=output, priority=priority
+                )
+            else:
+                task = self._new_task(
+                    file_id,
+                    operations,
+                    renditions,
+                    output=output,
+                    status=TaskStatus.ERROR,
+                )
+            tasks.append((index, task))
+
+        keys = {task.operation_key for _, task in tasks if task.operation_key}
+        cached = self._result_cache.lookup_many(keys) if self._result_cache else {}
+        for _, task in tasks:
+            if task.task_type == TaskType.RENDITIONS:
+                continue
+            if task.operation_key and self._reuses_source(task.operations, task.output):
+                task.processed_file_id = task.file_id
+            elif task.operation_key in cached:
+                task.processed_file_id = cached[task.operation_key]
+            else:
+                continue
+            task.status = TaskStatus.DONE
+            task.updated_at = datetime.now()
+
+        coalesced = {
+            task.operation_key
+            for _, task in tasks
+            if task.operation_key and task.status == TaskStatus.NEW
+        }
+        leaders = {}
+        if self._coalesce and coalesced:
+            lock_operations(self._pg, coalesced)
+            leaders = find_leaders(self._pg, coalesced)
+
+        # Повторы внутри пакета ждут первую задачу пакета с тем же ключом
+        batch_leaders: dict[str, ImageProcessingTask] = {}
+        batch_followers = []
+        inserted = []
+        for _, task in tasks:
+            key = task.operation_key
+            if self._coalesce and key in coalesced:
+                if key in leaders:
+                    task.leader_task_id = leaders[key]
+                elif key in batch_leaders:
+                    batch_followers.append(task)
+                    continue
+                else:
+                    batch_leaders[key] = task
+            inserted.append(task)
+
+        self._insert_tasks(inserted)
+        for task in batch_followers:
+            task.leader_task_id = batch_leaders[task.operation_key].task_id
+        self._insert_tasks(batch_followers)
+
+        to_publish = [
+            task
+            for task in inserted
+            if task.status == TaskStatus.NEW and not task.leader_task_id
+        ]
+        if self._notify_channel:
+            if to_publish:
+                notify_new_tasks(self._pg, self._notify_channel)
+            to_publish = []
+        elif self._outbox_channel:
+            add_outbox_messages(
+                self._pg,
+                [
+                    TaskIdentMessageModel.T(
+                        task.task_id, file_info=files_info.get(task.file_id)
+                    )
+                    for task in to_publish
+                ],
+                self._outbox_channel,
+                [task.priority for task in to_publish],
+            )
+            to_publish = []
+        self._pg.commit()
+
+        # Приоритет общий для сообщений одной отправки: пакет делится по
+        # приоритету, первыми уходят более важные
+        failed_ids = []
+        to_publish.sort(key=lambda task: -(task.priority or 0))
+        for priority, group in itertools.groupby(
+            to_publish, key=lambda task: task.priority or 0
+        ):
+            group = list(group)
+            messages = [
+                TaskIdentMessageModel.lazy_load(
+                    TaskIdentMessageModel.T(
+                        task.task_id, file_info=files_info.get(task.file_id)
+                    )
+                )
+                for task in group
+            ]
+            if not self._rabbit.publish_many(
+                messages, properties=pika.BasicProperties(priority=priority)
+            ):
+                failed_ids += [task.task_id for task in group]
+        if failed_ids:
+            failed = [task for task in to_publish if task.task_id in failed_ids]
+            self._fail_unpublished(failed)
+            for _, task in tasks:
+                if task.task_id in failed_ids or task.leader_task_id in failed_ids:
+                    task.status = TaskStatus.ERROR
+
+        for index, task in tasks:
+            results[index] = {"index": index, **task.dump()}
+        return {"items": results}
+
+    @staticmethod
+    def _encode_cursor(task: ImageProcessingTask) -> str:
+        data = json.dumps([task.created_at.isoformat(), task.task_id])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(task_id)
+
+    def _list_filters(self, params: dict) -> list:
+        filters = []
+        if params.get("status"):
+            filters.append(
+                sa_operator.eq(
+                    ImageProcessingTask.status,
+                    TaskStatus.from_value(params["status"], safe=False),
+                )
+            )
+        if params.get("task_type"):
+            filters.append(
+                sa_operator.eq(
+                    ImageProcessingTask.task_type,
+                    TaskType.from_value(params["task_type"], safe=False),
+                )
+            )
+        if params.get("file_id"):
+            filters.append(
+                sa_operator.eq(ImageProcessingTask.file_id, int(params["file_id"]))
+            )
+        if params.get("created_from"):
+            filters.append(
+                ImageProcessingTask.created_at
+                >= datetime.fromisoformat(params["created_from"])
+            )
+        if params.get("created_to"):
+            filters.append(
+                ImageProcessingTask.created_at
+                < datetime.fromisoformat(params["created_to"])
+            )
+        if params.get("cursor"):
+            created_at, task_id = self._decode_cursor(params["cursor"])
+            filters.append(
+                sa.tuple_(ImageProcessingTask.created_at, ImageProcessingTask.task_id)
+                < sa.tuple_(created_at, task_id)
+            )
+        return filters
+
+    def get_all(self, params: dict = None):
+        """Страница задач от новых к старым. Тело - список задач, как и до
+        постраничной выдачи; курсор следующей страницы - в заголовке
+        X-Next-Cursor"""
+        params = params or {}
+        try:
+            limit = min(
+                int(params.get("limit") or self._page.default_size),
+                self._page.max_size,
+            )
+            filters = self._list_filters(params)
+        except Exception:
+            return jsonify({"error": "Проверьте параметры запроса"}), 400
+        if limit < 1:
+            return jsonify({"error": "Проверьте параметры запроса"}), 400
 
-    def get_all(self) -> list[ImageProcessingTask]:
-        """."""
         with self._pg.begin():
             q = self._pg.query(ImageProcessingTask)
-            q = q.order_by(sa.desc(ImageProcessingTask.created_at))
-            q_list = [q_obj.dump() for q_obj in q]
-            return q_list
+            if filters:
+                q = q.filter(sa.and_(*filters))
+            q = q.order_by(
+                sa.desc(ImageProcessingTask.created_at),
+                sa.desc(ImageProcessingTask.task_id),
+            ).limit(limit + 1)
+            tasks = q.all()
+
+        headers = {}
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            headers["X-Next-Cursor"] = self._encode_cursor(tasks[-1])
+        return jsonify([task.dump() for task in tasks]), 200, headers
 
     def get(self, task_id: int) -> ImageProcessingTask:
         with self._pg.begin():